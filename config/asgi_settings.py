@@ -0,0 +1,5 @@
+"""Settings of the ASGI deployment: the hot read endpoints are served by the async views of config.asgi_urls"""
+from config.settings import *  # noqa
+
+
+ROOT_URLCONF = 'config.asgi_urls'
@@ -0,0 +1,15 @@
+"""
+URL configuration of the ASGI deployment.
+
+The hot read endpoints are served by the async views of package.async_urls, every other URL
+is the same as in config.urls.
+"""
+from django.urls import path, include
+
+from config.urls import urlpatterns as wsgi_urlpatterns
+
+
+urlpatterns = [
+    path('', include('package.async_urls')),
+    *wsgi_urlpatterns,
+]
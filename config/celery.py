@@ -12,9 +12,18 @@ app.conf.beat_schedule = {
         'task': 'package.tasks.update_usd_rate_in_rub_task',
         'schedule': timedelta(minutes=5),
     },
-    'update-delivery-cost-for-all-packages-where-delivery-cost-is-null-every-5-min': {
+    'sweep-packages-where-delivery-cost-is-null': {
         'task': 'package.tasks.calculate_delivery_cost_for_all_packages_task',
-        'schedule': timedelta(minutes=5),
+        # new packages are priced on create, this is only a sweep for stragglers
+        'schedule': timedelta(minutes=int(os.environ.get('DELIVERY_COST_SWEEP_INTERVAL_MINUTES', 30))),
+    },
+    'release-expired-package-owners-every-hour': {
+        'task': 'package.tasks.release_expired_package_owners_task',
+        'schedule': timedelta(hours=1),
+    },
+    'archive-settled-packages-every-day': {
+        'task': 'package.tasks.archive_settled_packages_task',
+        'schedule': timedelta(days=1),
     },
 }
 app.conf.timezone = 'UTC'
@@ -0,0 +1,48 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+
+class QueueListenerHandler(QueueHandler):
+    """Puts records on an in-memory queue, a listener thread passes them to the named handlers.
+
+    Emitting never waits for a stream or a file. The listener starts on the first record of every
+    process, so forked workers get their own thread.
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handler_names = handlers
+        self.listener = None
+        self.listener_pid = None
+        self.listener_lock = threading.Lock()
+
+    def start_listener(self):
+        with self.listener_lock:
+            if self.listener_pid == os.getpid():
+                return
+            # handlers are looked up by name here, dictConfig creates them after this one
+            handlers = [logging._handlers[name] for name in self.handler_names]
+            self.queue = queue.SimpleQueue()
+            self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+            self.listener.start()
+            self.listener_pid = os.getpid()
+            atexit.register(self.stop_listener)
+
+    def stop_listener(self):
+        with self.listener_lock:
+            if self.listener is not None and self.listener_pid == os.getpid():
+                self.listener.stop()
+            self.listener = self.listener_pid = None
+
+    def emit(self, record):
+        if self.listener_pid != os.getpid():
+            self.start_listener()
+        super().emit(record)
+
+    def close(self):
+        self.stop_listener()
+        super().close()
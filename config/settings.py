@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'package.metrics.MetricsMiddleware',
+    'package.db_routing.ReplicaReadsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,6 +56,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# config.asgi_settings switches to config.asgi_urls with the async package views
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
@@ -89,6 +92,17 @@ DATABASES = {
     }
 }
 
+# DB_REPLICA_HOSTS=host1,host2 adds read replicas of the default database, safe requests read from them,
+# see package.db_routing. Tests mirror them to the default database.
+DATABASE_REPLICAS = []
+for i, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(','))):
+    DATABASES[f'replica_{i}'] = {**DATABASES['default'], 'HOST': host.strip(), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{i}')
+DATABASE_ROUTERS = ['package.db_routing.PrimaryReplicaRouter']
+# reads of a client stay on the primary this long after its last write, longer than the replication lag
+DATABASE_STICKY_SECONDS = int(os.environ.get('DATABASE_STICKY_SECONDS', 5))
+DATABASE_STICKY_COOKIE_NAME = 'db_primary_until'
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
@@ -130,13 +144,20 @@ LOGGING = {
         },
         "file": {
             "level": "DEBUG",
-            "class": "logging.FileHandler",
+            "class": "logging.handlers.RotatingFileHandler",
             "filename": "debug.log",
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 5,
+        },
+        # requests only put records on a queue, a listener thread writes them to console and file
+        "queue": {
+            "()": "config.log_handlers.QueueListenerHandler",
+            "handlers": ["console", "file"],
         },
     },
     "loggers": {
         "main": {
-            "handlers": ["console", "file"],
+            "handlers": ["queue"],
             "level": "INFO",
             "propagate": True,
         },
@@ -152,6 +173,8 @@ CACHES = {
     }
 }
 
+# sessions live in signed cookies, so anonymous requests never write the session table
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.signed_cookies')
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
 # Internationalization
@@ -178,3 +201,62 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER", "amqp://localhost")
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# chords of calculate_delivery_cost_in_parallel_task need a result backend
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', REDIS_HOST)
+
+CBR_DAILY_URL = os.environ.get('CBR_DAILY_URL', 'https://www.cbr-xml-daily.ru/daily_json.js')
+# (connect, read) timeouts of the rate request in seconds
+USD_RATE_FETCH_TIMEOUT = (3.05, 5)
+USD_RATE_POOL_SIZE = 10
+# a cached rate older than this is still served but refreshed in the background
+USD_RATE_FRESH_FOR = 60 * 10
+USD_RATE_LOCAL_TTL = 30
+
+JOB_PROGRESS_TTL = 60 * 60 * 24
+
+# every process flushes its metrics to the cache this often, snapshots of exited processes expire
+METRICS_FLUSH_INTERVAL = 10
+METRICS_PROCESS_TTL = 60 * 5
+# bearer token required by /metrics if set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# lock of a running single flight task, extended by its heartbeat every third of the ttl
+SINGLE_FLIGHT_TTL = 60
+SINGLE_FLIGHT_QUEUED_TTL = 60 * 10
+
+# cached package list/detail responses, dropped earlier when the packages of the session change
+PACKAGE_RESPONSE_CACHE_TTL = 60 * 10
+
+# owner tokens of sessions are touched at most this often, they expire SESSION_COOKIE_AGE after the last touch
+PACKAGE_OWNER_TOUCH_INTERVAL = 60 * 60 * 24
+# expired owners per cleanup round and packages per detaching UPDATE
+PACKAGE_OWNER_CLEANUP_OWNER_BATCH_SIZE = 1000
+PACKAGE_OWNER_CLEANUP_BATCH_SIZE = 5000
+
+# seconds between checks of the shared reference data version by every process
+REFERENCE_DATA_CHECK_INTERVAL = 1
+
+PACKAGE_BULK_CREATE_MAX_ITEMS = 5000
+PACKAGE_BULK_CREATE_BATCH_SIZE = 500
+# packages per request and per UPDATE of the bulk company assignment
+PACKAGE_ASSIGN_MAX_IDS = 5000
+PACKAGE_ASSIGN_BATCH_SIZE = 1000
+# settled (priced and assigned) packages not changed for this long are moved to the archive in batches
+PACKAGE_ARCHIVE_AFTER = 60 * 60 * 24 * int(os.environ.get('PACKAGE_ARCHIVE_AFTER_DAYS', 90))
+PACKAGE_ARCHIVE_BATCH_SIZE = 1000
+# rows per keyset page of the streaming export
+PACKAGE_EXPORT_CHUNK_SIZE = int(os.environ.get('PACKAGE_EXPORT_CHUNK_SIZE', 2000))
+
+DELIVERY_COST_BATCH_SIZE = int(os.environ.get('DELIVERY_COST_BATCH_SIZE', 1000))
+# packages per range when calculate_delivery_cost_in_parallel_task splits the work between workers
+DELIVERY_COST_RANGE_SIZE = int(os.environ.get('DELIVERY_COST_RANGE_SIZE', 50_000))
+# python - rows are priced by the worker, sql - every batch is priced by one UPDATE in the database
+DELIVERY_COST_PRICING_MODE = os.environ.get('DELIVERY_COST_PRICING_MODE', 'python')
+# sync - new packages are priced right after commit with the cached rate, async - by a coalesced task
+DELIVERY_COST_PRICE_ON_CREATE = os.environ.get('DELIVERY_COST_PRICE_ON_CREATE', 'sync')
+# creates within this many seconds are priced by one task run
+DELIVERY_COST_COALESCE_DELAY = 1
+DELIVERY_COST_COALESCE_TTL = 60
+# seconds to sleep between batches when all packages are repriced after a rate change
+DELIVERY_COST_REPRICE_PAUSE = float(os.environ.get('DELIVERY_COST_REPRICE_PAUSE', 0.1))
+DELIVERY_COST_REPRICE_CHECKPOINT_TTL = 60 * 60 * 24
@@ -0,0 +1,17 @@
+"""Settings for running the tests without MySQL and Redis: python manage.py test --settings=config.test_settings
+
+Two local SQLite databases stand in for the primary and a read replica. The replica is not a test
+mirror, so ReplicaRoutingTests enable it with DATABASE_REPLICAS and see which database served a read.
+"""
+from config.settings import *  # noqa
+
+
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'primary.sqlite3'},
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'replica.sqlite3'},
+}
+DATABASE_REPLICAS = []
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+CELERY_TASK_ALWAYS_EAGER = True
+# test runs must not write debug.log into the working copy
+LOGGING = {**LOGGING, 'handlers': {**LOGGING['handlers'], 'file': {'class': 'logging.NullHandler'}}}
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PackageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'package'
+
+    def ready(self):
+        from package import metrics, signals  # noqa: F401
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from package import rollups
+from package.models import ArchivedPackage, Package
+from package.response_cache import invalidate_sessions
+
+
+ARCHIVED_FIELDS = tuple(field.attname for field in Package._meta.concrete_fields)
+
+
+def settled_packages(cutoff):
+    """Priced packages with a company, not changed since the cutoff"""
+    return Package.objects.filter(
+        delivery_cost__isnull=False, delivery_company__isnull=False, updated_at__lt=cutoff,
+    )
+
+
+def archive_settled_packages(age=None, batch_size=None):
+    """Moves settled packages not changed for age seconds to ArchivedPackage, returns the number of moved packages.
+
+    A reprice for a new rate does not change updated_at, so it does not postpone the archiving.
+    Every batch is copied and deleted in its own short transaction. Rows locked by a request are
+    skipped and left for the next run. Archived packages stay in the rollups, so the analytics
+    do not change.
+    """
+    cutoff = timezone.now() - timedelta(seconds=age or settings.PACKAGE_ARCHIVE_AFTER)
+    batch_size = batch_size or settings.PACKAGE_ARCHIVE_BATCH_SIZE
+    archived = 0
+    while True:
+        with transaction.atomic():
+            packages = list(
+                settled_packages(cutoff).select_for_update(skip_locked=True).order_by('updated_at')[:batch_size]
+            )
+            if not packages:
+                return archived
+            archived_at = timezone.now()
+            ArchivedPackage.objects.bulk_create([
+                ArchivedPackage(archived_at=archived_at, **{field: getattr(package, field) for field in ARCHIVED_FIELDS})
+                for package in packages
+            ], batch_size=settings.PACKAGE_BULK_CREATE_BATCH_SIZE)
+            # the deletion takes the packages out of the rollups, this puts them back
+            Package.objects.filter(pk__in=[package.pk for package in packages]).delete()
+            rollups.record(rollups.packages_delta(packages))
+        archived += len(packages)
+        invalidate_sessions({package.owner for package in packages})
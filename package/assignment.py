@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.utils import timezone
+
+from package import rollups
+from package.models import Package
+from package.response_cache import invalidate_sessions
+from package.service import iterate_keyset_values
+
+
+ASSIGNED_FIELDS = ('pk', 'owner') + rollups.ROLLUP_FIELDS
+
+
+def _record_assigned(rows, company_id):
+    """Moves the assigned packages from the rollups without company to the rollups of the company"""
+    delta = rollups.RollupDelta()
+    for _, _, type_package_id, _, weight, cost_in_usd, delivery_cost in rows:
+        delta.add(type_package_id, None, weight, cost_in_usd, delivery_cost, sign=-1)
+        delta.add(type_package_id, company_id, weight, cost_in_usd, delivery_cost)
+    rollups.record(delta)
+    owners = [row[1] for row in rows]
+    transaction.on_commit(lambda: invalidate_sessions(owners))
+
+
+def assign_company(pk, company_id):
+    """Sets the company of a package without company by one conditional UPDATE, returns whether it was set.
+
+    The affected row count tells a free package from a taken or missing one, no lock is waited for
+    by the SELECT that reads the rollup values of the package the UPDATE has just locked.
+    """
+    with transaction.atomic():
+        updated = Package.objects.filter(pk=pk, delivery_company__isnull=True).update(
+            delivery_company_id=company_id, updated_at=timezone.now(),
+        )
+        if updated:
+            _record_assigned(Package.objects.filter(pk=pk).values_list(*ASSIGNED_FIELDS), company_id)
+    return bool(updated)
+
+
+def assign_company_in_batches(queryset, company_id, batch_size):
+    """Sets the company of the queryset packages without company page by page, returns (assigned pks, taken pks).
+
+    Every page is one short transaction: free rows are locked with SKIP LOCKED, so rows being
+    assigned by a concurrent request count as taken instead of waiting, and set by one UPDATE.
+    """
+    assigned, taken = [], []
+    for page in iterate_keyset_values(queryset, ('pk', 'delivery_company_id'), batch_size):
+        free_pks = [pk for pk, delivery_company_id in page if delivery_company_id is None]
+        locked = []
+        if free_pks:
+            with transaction.atomic():
+                locked = list(
+                    Package.objects.select_for_update(skip_locked=True)
+                    .filter(pk__in=free_pks, delivery_company__isnull=True).values_list(*ASSIGNED_FIELDS)
+                )
+                if locked:
+                    Package.objects.filter(pk__in=[row[0] for row in locked]).update(
+                        delivery_company_id=company_id, updated_at=timezone.now(),
+                    )
+                    _record_assigned(locked, company_id)
+        locked_pks = {row[0] for row in locked}
+        assigned.extend(pk for pk, _ in page if pk in locked_pks)
+        taken.extend(pk for pk, _ in page if pk not in locked_pks)
+    return assigned, taken
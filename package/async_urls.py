@@ -0,0 +1,18 @@
+from django.urls import path
+
+from package.async_views import (
+    package_list, package_detail, type_package_list, type_package_detail,
+    delivery_company_list, delivery_company_detail,
+)
+
+
+# detail routes match only valid pks, so extra actions like package/bulk_create/ and
+# malformed pks fall through to the sync router
+urlpatterns = [
+    path('package/', package_list),
+    path('package/<uuid:pk>/', package_detail),
+    path('type_package/', type_package_list),
+    path('type_package/<int:pk>/', type_package_detail),
+    path('delivery_company/', delivery_company_list),
+    path('delivery_company/<int:pk>/', delivery_company_detail),
+]
@@ -0,0 +1,139 @@
+import functools
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse
+from django_filters.utils import translate_validation
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.views import exception_handler
+
+from package.filters import PackageFilter
+from package.models import Package
+from package.owners import get_owner
+from package.pagination import AsyncPageNumberPagination
+from package.reference import reference_data
+from package.response_cache import acached_response
+from package.serializers import (
+    ListPackageSerializer, RetrievePackageSerializer, TypePackageSerializer, DeliveryCompanySerializer,
+)
+from package.views import PackageViewSet, TypePackageViewSet, DeliveryCompanyViewSet
+
+
+def async_read_view(sync_view, sync_if=None):
+    """Serves GET with the decorated coroutine, other methods and sync_if(request) requests with sync_view.
+
+    The coroutine gets a DRF request and returns (status code, data, headers), the data is rendered
+    with the JSON renderer of the sync views, so both return the same body.
+    """
+    sync_view = sync_to_async(sync_view)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def view(request, *args, **kwargs):
+            request = Request(request)
+            if request.method != 'GET' or (sync_if is not None and sync_if(request)):
+                return await sync_view(request._request, *args, **kwargs)
+            try:
+                status_code, data, headers = await func(request, *args, **kwargs)
+            except (APIException, Http404) as exc:
+                response = exception_handler(exc, {})
+                status_code, data, headers = response.status_code, response.data, {}
+            return HttpResponse(
+                JSONRenderer().render(data), status=status_code, headers=headers, content_type='application/json'
+            )
+        view.csrf_exempt = True
+        return view
+    return decorator
+
+
+async def _owner_packages(request):
+    """Packages of the owner of the request session, the session engine may load the session synchronously"""
+    owner = await sync_to_async(get_owner)(request)
+    packages = Package.objects.filter(owner=owner) if owner is not None else Package.objects.none()
+    return owner, packages.only(*PackageViewSet.read_fields)
+
+
+async def _load_type_packages(packages):
+    """Makes sure type_package_name of the packages is served from the reference data without queries"""
+    await reference_data.aload()
+    if any(reference_data.get_type_package(package.type_package_id, reload=False) is None for package in packages):
+        await reference_data.aload(force=True)
+
+
+@async_read_view(
+    PackageViewSet.as_view({'get': 'list', 'post': 'create'}),
+    sync_if=lambda request: request.query_params.get('pagination') == 'cursor',
+)
+async def package_list(request):
+    """PackageViewSet.list with the async ORM"""
+    owner, queryset = await _owner_packages(request)
+
+    async def list_packages():
+        filterset = PackageFilter(request.query_params, queryset=queryset.order_by('pk'))
+        if not await sync_to_async(filterset.is_valid)():
+            raise translate_validation(filterset.errors)
+        paginator = AsyncPageNumberPagination()
+        packages = await paginator.apaginate_queryset(filterset.qs, request)
+        await _load_type_packages(packages)
+        return status.HTTP_200_OK, paginator.get_paginated_response(
+            ListPackageSerializer(packages, many=True).data
+        ).data
+
+    return await acached_response(request, owner, list_packages)
+
+
+@async_read_view(PackageViewSet.as_view({'get': 'retrieve', 'delete': 'destroy'}))
+async def package_detail(request, pk):
+    """PackageViewSet.retrieve with the async ORM"""
+    owner, queryset = await _owner_packages(request)
+
+    async def retrieve_package():
+        try:
+            package = await queryset.aget(pk=pk)
+        except Package.DoesNotExist:
+            raise Http404(f'No {Package._meta.object_name} matches the given query.')
+        await _load_type_packages([package])
+        return status.HTTP_200_OK, RetrievePackageSerializer(package).data
+
+    return await acached_response(request, owner, retrieve_package)
+
+
+def _list_reference(request, objects, serializer_class):
+    paginator = PageNumberPagination()
+    page = paginator.paginate_queryset(objects, request)
+    if page is not None:
+        return status.HTTP_200_OK, paginator.get_paginated_response(serializer_class(page, many=True).data).data, {}
+    return status.HTTP_200_OK, serializer_class(objects, many=True).data, {}
+
+
+def _retrieve_reference(instance, serializer_class):
+    if instance is None:
+        raise Http404
+    return status.HTTP_200_OK, serializer_class(instance).data, {}
+
+
+@async_read_view(TypePackageViewSet.as_view({'get': 'list'}))
+async def type_package_list(request):
+    await reference_data.aload()
+    return _list_reference(request, reference_data.type_packages(), TypePackageSerializer)
+
+
+@async_read_view(TypePackageViewSet.as_view({'get': 'retrieve'}))
+async def type_package_detail(request, pk):
+    return _retrieve_reference(await reference_data.aget_type_package(pk), TypePackageSerializer)
+
+
+@async_read_view(DeliveryCompanyViewSet.as_view({'get': 'list', 'post': 'create'}))
+async def delivery_company_list(request):
+    await reference_data.aload()
+    return _list_reference(request, reference_data.delivery_companies(), DeliveryCompanySerializer)
+
+
+@async_read_view(DeliveryCompanyViewSet.as_view(
+    {'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}
+))
+async def delivery_company_detail(request, pk):
+    return _retrieve_reference(await reference_data.aget_delivery_company(pk), DeliveryCompanySerializer)
@@ -0,0 +1,160 @@
+import json
+import subprocess
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+
+from package import rollups
+from package.loadtest import latency_stats
+from package.owners import session_for_owner
+from package.models import Package
+from package.response_cache import invalidate_sessions
+from package.seeding import SEED_NAME_PREFIX
+from package.service import PRICING_MODES
+from package.tasks import calculate_delivery_cost_for_all_packages_task
+
+
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@contextmanager
+def benchmark_databases(verbosity=1):
+    """Runs the block on freshly migrated test databases and a cache of this process.
+
+    Benchmarks seed, reprice and drop indexes, none of it may touch the live database or the
+    shared cache. The test databases are destroyed on exit.
+    """
+    with override_settings(CACHES=BENCHMARK_CACHES):
+        old_config = setup_databases(verbosity, interactive=False)
+        try:
+            yield
+        finally:
+            teardown_databases(old_config, verbosity)
+
+
+def measure(request, repeat, before=None):
+    """Latency percentiles and query counts of repeat calls of request(i), before(i) runs outside the timing"""
+    latencies, queries, statuses = [], [], set()
+    for i in range(repeat):
+        if before is not None:
+            before(i)
+        with CaptureQueriesContext(connection) as captured:
+            started_at = time.perf_counter()
+            response = request(i)
+            latencies.append(time.perf_counter() - started_at)
+        queries.append(len(captured))
+        statuses.add(response.status_code)
+    return {
+        'repeat': repeat,
+        **latency_stats(latencies),
+        'queries_min': min(queries),
+        'queries_max': max(queries),
+        'statuses': sorted(statuses),
+    }
+
+
+def _package_data(type_package_id, i):
+    return {'name': f'{SEED_NAME_PREFIX}api_{i}', 'weight': '1.500', 'cost_in_usd': '10.00',
+            'type_package': type_package_id}
+
+
+def run_api_benchmarks(owner, company_ids, repeat=50, bulk_size=100):
+    """Measures the package endpoints with the test client in a session of the owner"""
+    client = Client()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session_for_owner(owner).session_key
+    session_packages = Package.objects.filter(owner=owner).order_by('pk')
+    package_pk = session_packages.values_list('pk', flat=True).first()
+    type_package_id = session_packages.values_list('type_package_id', flat=True).first()
+    unassigned_pks = list(
+        session_packages.filter(delivery_company__isnull=True).values_list('pk', flat=True)[:repeat]
+    )
+    list_url = reverse('package-list')
+    detail_url = reverse('package-detail', kwargs={'pk': str(package_pk)})
+
+    def invalidate(i):
+        invalidate_sessions([owner])
+
+    results = {
+        'package list': measure(lambda i: client.get(list_url), repeat, before=invalidate),
+        'package list cached': measure(lambda i: client.get(list_url), repeat),
+        'package list cursor': measure(lambda i: client.get(f'{list_url}?pagination=cursor'), repeat),
+        'package list deep page': measure(
+            lambda i: client.get(f'{list_url}?page=last'), repeat, before=invalidate
+        ),
+        'package detail': measure(lambda i: client.get(detail_url), repeat, before=invalidate),
+        'package create': measure(
+            lambda i: client.post(list_url, _package_data(type_package_id, i), content_type='application/json'),
+            repeat,
+        ),
+        f'package bulk_create {bulk_size}': measure(
+            lambda i: client.post(
+                reverse('package-bulk-create'),
+                [_package_data(type_package_id, i * bulk_size + j) for j in range(bulk_size)],
+                content_type='application/json',
+            ),
+            max(repeat // 10, 1),
+        ),
+    }
+    if unassigned_pks and company_ids:
+        results['package add_company'] = measure(
+            lambda i: client.post(
+                reverse('package-add-company', kwargs={'pk': str(unassigned_pks[i])}),
+                {'company_id': company_ids[i % len(company_ids)]},
+                content_type='application/json',
+            ),
+            len(unassigned_pks),
+        )
+    return results
+
+
+def run_task_benchmarks(owners, batch_size=None):
+    """Throughput of calculate_delivery_cost_for_all_packages_task in every pricing mode"""
+    seeded = Package.objects.filter(owner__in=owners, name__startswith=SEED_NAME_PREFIX)
+    results = {}
+    for mode in PRICING_MODES:
+        delta = rollups.queryset_totals(seeded, sign=-1)
+        seeded.update(delivery_cost=None, usd_rate_version=None)
+        delta.merge(rollups.queryset_totals(seeded))
+        rollups.record(delta)
+        stats = calculate_delivery_cost_for_all_packages_task(batch_size=batch_size, mode=mode)
+        results[f'calculate_delivery_cost {mode}'] = stats
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous, current, threshold=0.2):
+    """Regressions of current against previous: p50 latency, query counts or rows/sec worse by threshold"""
+    regressions = []
+    for name, result in current['endpoints'].items():
+        before = previous.get('endpoints', {}).get(name)
+        if before is None:
+            continue
+        if before['p50_ms'] and result['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            regressions.append(f'{name}: p50 {before["p50_ms"]} -> {result["p50_ms"]} ms')
+        if result['queries_max'] > before['queries_max']:
+            regressions.append(f'{name}: queries {before["queries_max"]} -> {result["queries_max"]}')
+    for name, result in current['tasks'].items():
+        before = previous.get('tasks', {}).get(name)
+        if before is None:
+            continue
+        if result['rows_per_sec'] < before['rows_per_sec'] * (1 - threshold):
+            regressions.append(f'{name}: {before["rows_per_sec"]} -> {result["rows_per_sec"]} rows/sec')
+    return regressions
+
+
+def load_results(path):
+    with open(path) as results:
+        return json.load(results)
@@ -0,0 +1,105 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+@contextmanager
+def _reads(from_replica):
+    token = _replica_reads.set(from_replica)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_reads():
+    """Sends the reads of the block to a replica, reads inside a transaction still go to the primary"""
+    return _reads(True)
+
+
+def primary_reads():
+    """Sends the reads of the block to the primary, e.g. to reload data cached under a new version"""
+    return _reads(False)
+
+
+class PrimaryReplicaRouter:
+    """Writes go to the primary, reads go to a random replica of DATABASE_REPLICAS only inside replica_reads().
+
+    Celery tasks and management commands read from the primary unless they opt in, so rows they
+    read and then update are never stale.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not _replica_reads.get():
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def _pinned_to_primary(request):
+    try:
+        return float(request.COOKIES.get(settings.DATABASE_STICKY_COOKIE_NAME, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _pin_to_primary(response):
+    response.set_cookie(
+        settings.DATABASE_STICKY_COOKIE_NAME,
+        str(time.time() + settings.DATABASE_STICKY_SECONDS),
+        max_age=settings.DATABASE_STICKY_SECONDS,
+        httponly=True,
+        samesite='Lax',
+    )
+
+
+class ReplicaReadsMiddleware:
+    """Safe requests read from replicas, unless the client wrote within the last DATABASE_STICKY_SECONDS.
+
+    Every unsafe request sets a cookie pinning the reads of the client to the primary for that
+    window, so a client reads its own writes while replicas catch up.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with _reads(request.method in SAFE_METHODS and not _pinned_to_primary(request)):
+            response = self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            _pin_to_primary(response)
+        return response
+
+    async def __acall__(self, request):
+        with _reads(request.method in SAFE_METHODS and not _pinned_to_primary(request)):
+            response = await self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            _pin_to_primary(response)
+        return response
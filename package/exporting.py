@@ -0,0 +1,78 @@
+import csv
+import io
+import json
+
+from package.filters import PackageExportFilter
+from package.models import ArchivedPackage, Package
+from package.service import iterate_keyset_values
+
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+
+# import_packages reads the same column names but ignores id and usd_rate_version, so an imported export
+# creates copies of the packages with new ids, priced ones are repriced as stale
+EXPORT_COLUMNS = (
+    ('id', 'pk'),
+    ('name', 'name'),
+    ('type_package', 'type_package_id'),
+    ('weight', 'weight'),
+    ('cost_in_usd', 'cost_in_usd'),
+    ('delivery_cost', 'delivery_cost'),
+    ('usd_rate_version', 'usd_rate_version'),
+    ('delivery_company', 'delivery_company_id'),
+)
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return str(value)
+
+
+def _take(buffer):
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
+
+
+def render_csv(pages):
+    """Yields the header at once and then one chunk of CSV lines per page"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column for column, _ in EXPORT_COLUMNS)
+    yield _take(buffer)
+    for page in pages:
+        writer.writerows(page)
+        yield _take(buffer)
+
+
+def render_ndjson(pages):
+    """Yields one chunk of JSON lines per page, decimals and uuids are written as strings"""
+    columns = [column for column, _ in EXPORT_COLUMNS]
+    for page in pages:
+        yield ''.join(
+            json.dumps(dict(zip(columns, map(_json_value, row))), ensure_ascii=False) + '\n' for row in page
+        )
+
+
+def export_filtersets(params):
+    """Filtersets of the live and the archived packages, an export has the rows of both"""
+    return [PackageExportFilter(params, queryset=model.objects.all()) for model in (Package, ArchivedPackage)]
+
+
+def export_pages(querysets, chunk_size):
+    """Pages of export rows as values_list tuples in the order of EXPORT_COLUMNS, queryset after queryset"""
+    fields = [field for _, field in EXPORT_COLUMNS]
+    for queryset in querysets:
+        yield from iterate_keyset_values(queryset, fields, chunk_size)
+
+
+def render(pages, fmt):
+    return render_csv(pages) if fmt == 'csv' else render_ndjson(pages)
+
+
+def export_chunks(querysets, fmt, chunk_size):
+    """Chunks of the export of the querysets, the first one is sent before all rows are read"""
+    return render(export_pages(querysets, chunk_size), fmt)
@@ -0,0 +1,27 @@
+from django_filters import rest_framework as filters
+
+from package.models import ArchivedPackage, Package
+
+
+class PackageFilter(filters.FilterSet):
+    class Meta:
+        model = Package
+        fields = ['type_package', 'delivery_cost']
+
+
+class PackageExportFilter(filters.FilterSet):
+    """Filters of the export, ids are compared as numbers so the filter needs no queries"""
+    type_package = filters.NumberFilter(field_name='type_package_id')
+    delivery_company = filters.NumberFilter(field_name='delivery_company_id')
+    priced = filters.BooleanFilter(field_name='delivery_cost', lookup_expr='isnull', exclude=True)
+    created_after = filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lt')
+    archived = filters.BooleanFilter(method='filter_archived')
+
+    class Meta:
+        model = Package
+        fields = ['type_package', 'delivery_company', 'priced', 'created_after', 'created_before', 'archived']
+
+    def filter_archived(self, queryset, name, value):
+        """The same filters are applied to Package and ArchivedPackage, archived keeps one of them"""
+        return queryset if (queryset.model is ArchivedPackage) == value else queryset.none()
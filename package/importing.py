@@ -0,0 +1,187 @@
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from package import rollups
+from package.models import Package, PackageOwner
+from package.reference import reference_data
+from package.response_cache import invalidate_sessions
+from package.service import delivery_cost_calculation_batch, usd_rate_version
+
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+
+def read_rows(stream, fmt):
+    """Yields (line number, row dict) from a CSV file with a header or from NDJSON, one line at a time"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else {'__all__': line}
+
+
+class PackageRowValidator:
+    """Validates rows by the rules of CreatePackageSerializer without serializer objects.
+
+    Plain fields are cleaned with the model field validators, type and company are looked up in the
+    reference data and owner tokens are checked once per batch with validate_owners.
+    """
+    fields = ('name', 'weight', 'cost_in_usd', 'delivery_cost')
+
+    def __init__(self):
+        self.model_fields = {name: Package._meta.get_field(name) for name in self.fields}
+
+    def validate(self, row):
+        """Returns (attrs, errors) of a row, errors is empty for a valid row"""
+        if '__all__' in row:
+            return None, {'__all__': ['Некорректная строка.']}
+        attrs, errors = {}, {}
+        for name, field in self.model_fields.items():
+            value = row.get(name)
+            if isinstance(value, (int, float)):
+                # JSON numbers are cleaned from their text like the serializer does
+                value = str(value)
+            try:
+                attrs[name] = field.clean(None if value == '' else value, None)
+            except ValidationError as error:
+                errors[name] = error.messages
+        type_package = reference_data.get_type_package(row.get('type_package'))
+        if type_package is None:
+            errors['type_package'] = [f'Недопустимый первичный ключ "{row.get("type_package")}".']
+        else:
+            attrs['type_package_id'] = type_package.pk
+        delivery_company = row.get('delivery_company')
+        if delivery_company not in (None, ''):
+            company = reference_data.get_delivery_company(delivery_company)
+            if company is None:
+                errors['delivery_company'] = [f'Недопустимый первичный ключ "{delivery_company}".']
+            else:
+                attrs['delivery_company_id'] = company.pk
+        owner = row.get('owner')
+        attrs['owner'] = owner if owner not in (None, '') else None
+        return attrs, errors
+
+    @staticmethod
+    def validate_owners(batch):
+        """Removes rows with unknown owner tokens from the batch of (line number, attrs), returns their errors"""
+        keys = {attrs['owner'] for _, attrs in batch if attrs['owner'] is not None}
+        known = set(PackageOwner.objects.filter(pk__in=keys).values_list('pk', flat=True)) if keys else set()
+        errors = [
+            (line_number, {'owner': [f'Недопустимый первичный ключ "{attrs["owner"]}".']})
+            for line_number, attrs in batch
+            if attrs['owner'] is not None and attrs['owner'] not in known
+        ]
+        batch[:] = [(line_number, attrs) for line_number, attrs in batch
+                    if attrs['owner'] is None or attrs['owner'] in known]
+        return errors
+
+
+def price_packages(packages, usd_rate_in_rub):
+    """Prices the packages that came without delivery_cost"""
+    unpriced = [package for package in packages if package.delivery_cost is None]
+    if not unpriced:
+        return
+    delivery_costs = delivery_cost_calculation_batch(
+        [package.weight for package in unpriced], [package.cost_in_usd for package in unpriced], usd_rate_in_rub,
+    )
+    rate_version = usd_rate_version(usd_rate_in_rub)
+    for package, delivery_cost in zip(unpriced, delivery_costs):
+        package.delivery_cost = delivery_cost
+        package.usd_rate_version = rate_version
+
+
+def _load_data_value(value):
+    if value is None:
+        return 'NULL'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def load_data_infile(packages):
+    """Inserts packages with MySQL LOAD DATA LOCAL INFILE, the client needs the local_infile option"""
+    fields = list(Package._meta.concrete_fields)
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, encoding='utf-8') as infile:
+        for package in packages:
+            # pre_save sets created_at and updated_at like bulk_create does
+            values = [field.get_db_prep_save(field.pre_save(package, True), connection) for field in fields]
+            infile.write(','.join(_load_data_value(value) for value in values) + '\n')
+    try:
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE {connection.ops.quote_name(Package._meta.db_table)} "
+                f"CHARACTER SET utf8mb4 FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' "
+                f"LINES TERMINATED BY '\\n' ({columns})",
+                [infile.name],
+            )
+    finally:
+        os.unlink(infile.name)
+
+
+def import_packages(rows, batch_size=5000, usd_rate_in_rub=None, load_data=False, on_batch=None):
+    """Validates and inserts (line number, row) pairs batch by batch, only one batch is kept in memory.
+
+    Every batch is inserted in its own transaction with bulk_create, or with LOAD DATA if load_data is set.
+    Every row creates a new package, an id column is ignored.
+    Packages without delivery_cost are priced on ingest if usd_rate_in_rub is given. on_batch(stats, errors)
+    gets the running stats and the errors of every batch as (line number, errors) pairs.
+    """
+    validator = PackageRowValidator()
+    stats = {'rows': 0, 'created': 0, 'invalid': 0, 'batches': 0}
+    started_at = time.perf_counter()
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, batch_size))
+        if not chunk:
+            break
+        batch, errors = [], []
+        for line_number, row in chunk:
+            attrs, row_errors = validator.validate(row)
+            if row_errors:
+                errors.append((line_number, row_errors))
+            else:
+                batch.append((line_number, attrs))
+        errors.extend(validator.validate_owners(batch))
+        packages = [Package(**attrs) for _, attrs in batch]
+        if usd_rate_in_rub is not None:
+            price_packages(packages, usd_rate_in_rub)
+        if packages:
+            with transaction.atomic():
+                if load_data:
+                    load_data_infile(packages)
+                else:
+                    Package.objects.bulk_create(packages, batch_size=batch_size)
+                rollups.record(rollups.packages_delta(packages))
+            invalidate_sessions(package.owner for package in packages)
+        stats['rows'] += len(chunk)
+        stats['created'] += len(packages)
+        stats['invalid'] += len(errors)
+        stats['batches'] += 1
+        if on_batch is not None:
+            on_batch(stats, sorted(errors, key=lambda error: error[0]))
+    stats['seconds'] = round(time.perf_counter() - started_at, 3)
+    stats['rows_per_sec'] = round(stats['rows'] / stats['seconds'], 1) if stats['seconds'] else None
+    return stats
+
+
+def open_import_stream(path):
+    """Text stream of the file or of stdin for '-'"""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
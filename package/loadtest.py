@@ -0,0 +1,78 @@
+import asyncio
+import math
+import time
+
+import httpx
+
+
+def latency_stats(latencies):
+    """p50/p95/p99/max of latencies in seconds, in milliseconds"""
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    latencies = sorted(latencies)
+
+    def percentile(share):
+        return round(latencies[max(math.ceil(share * len(latencies)) - 1, 0)] * 1000, 2)
+
+    return {
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(latencies[-1] * 1000, 2),
+    }
+
+
+async def _prepare_session(client, packages):
+    """Creates the packages of the session, the first write sets the session cookie"""
+    response = await client.get('/type_package/')
+    response.raise_for_status()
+    type_package = response.json()['results'][0]['id']
+    if packages:
+        items = [
+            {'name': f'loadtest_{i}', 'weight': '1.500', 'cost_in_usd': '10.00', 'type_package': type_package}
+            for i in range(packages)
+        ]
+        response = await client.post('/package/bulk_create/', json=items)
+        response.raise_for_status()
+
+
+async def _poll(client, paths, deadline, etag, latencies, errors):
+    etags = {}
+    while time.monotonic() < deadline:
+        for path in paths:
+            headers = {'If-None-Match': etags[path]} if etag and path in etags else {}
+            started_at = time.perf_counter()
+            try:
+                response = await client.get(path, headers=headers)
+            except httpx.HTTPError:
+                errors.append(time.perf_counter() - started_at)
+                continue
+            latencies.append(time.perf_counter() - started_at)
+            if response.status_code >= 400:
+                errors.append(latencies[-1])
+            elif 'ETag' in response.headers:
+                etags[path] = response.headers['ETag']
+
+
+async def run_load(base_url, paths, clients=100, duration=10, packages=0, etag=False, timeout=30):
+    """Polls paths of base_url from concurrent clients with their own sessions for duration seconds"""
+    limits = httpx.Limits(max_connections=1)
+    sessions = [httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) for _ in range(clients)]
+    latencies, errors = [], []
+    try:
+        await asyncio.gather(*(_prepare_session(client, packages) for client in sessions))
+        started_at = time.monotonic()
+        deadline = started_at + duration
+        await asyncio.gather(*(_poll(client, paths, deadline, etag, latencies, errors) for client in sessions))
+        seconds = time.monotonic() - started_at
+    finally:
+        await asyncio.gather(*(client.aclose() for client in sessions))
+    return {
+        'base_url': base_url,
+        'clients': clients,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': round(seconds, 2),
+        'req_per_sec': round(len(latencies) / seconds, 1),
+        **latency_stats(latencies),
+    }
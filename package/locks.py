@@ -0,0 +1,179 @@
+import functools
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+
+from celery import current_task
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+
+from package.progress import JobProgress
+
+logger = logging.getLogger('main')
+
+# the key is deleted or extended only while it still holds the job id, the check and the change are one step
+COMPARE_AND_DELETE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+COMPARE_AND_EXPIRE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def redis_client(key):
+    """(raw client, full key) for commands the cache API has no call for, None for other cache backends"""
+    backend = caches['default']
+    if not isinstance(backend, RedisCache):
+        return None
+    return backend._cache.get_client(key, write=True), backend.make_and_validate_key(key)
+
+
+def _compare_and(script, key, value, *args):
+    """Runs the compare-and-change script on the Redis cache, returns None for other cache backends"""
+    redis = redis_client(key)
+    if redis is None:
+        return None
+    client, full_key = redis
+    return client.eval(script, 1, full_key, caches['default']._cache._serializer.dumps(value), *args)
+
+
+def compare_and_delete(key, value):
+    """Deletes the key if it holds the value, returns whether it was deleted"""
+    deleted = _compare_and(COMPARE_AND_DELETE, key, value)
+    if deleted is not None:
+        return bool(deleted)
+    # LocMemCache of development and tests, not atomic
+    if cache.get(key) != value:
+        return False
+    return cache.delete(key)
+
+
+def compare_and_expire(key, value, timeout):
+    """Sets the timeout of the key if it holds the value, returns whether it was set"""
+    expired = _compare_and(COMPARE_AND_EXPIRE, key, value, int(timeout * 1000))
+    if expired is not None:
+        return bool(expired)
+    # LocMemCache of development and tests, not atomic
+    if cache.get(key) != value:
+        return False
+    return cache.touch(key, timeout)
+
+
+class SingleFlight:
+    """Lets only one run of a job work at a time across all workers.
+
+    The lock holds the id of the running job and expires after SINGLE_FLIGHT_TTL seconds unless
+    the holder's heartbeat extends it, so a crashed worker releases it by itself. A queued
+    marker deduplicates jobs enqueued while one is already waiting or running.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock_key = f'single_flight:{name}'
+        self.queued_key = f'single_flight:{name}:queued'
+
+    def running_id(self):
+        return cache.get(self.lock_key)
+
+    def queued_id(self):
+        return cache.get(self.queued_key)
+
+    @contextmanager
+    def hold(self, job_id, release=True):
+        """Yields True if the lock was acquired for job_id, False if another job holds it.
+
+        release=False keeps the lock after a successful block for another task to release it,
+        e.g. a chord callback. The heartbeat of this process keeps extending it until it is
+        released, so the lock outlives a queue too busy to start the next task within the TTL.
+        """
+        ttl = settings.SINGLE_FLIGHT_TTL
+        acquired = self.acquire(job_id)
+        if not acquired:
+            yield False
+            return
+        stopped, handed_over = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(job_id, ttl, stopped, handed_over), daemon=True,
+        )
+        heartbeat.start()
+        try:
+            yield True
+        except BaseException:
+            release = True
+            raise
+        finally:
+            if release:
+                stopped.set()
+                heartbeat.join()
+                self.release(job_id)
+            else:
+                handed_over.set()
+
+    def acquire(self, job_id):
+        """Takes the lock for job_id without a heartbeat, a job shorter than SINGLE_FLIGHT_TTL releases it itself"""
+        acquired = cache.add(self.lock_key, job_id, timeout=settings.SINGLE_FLIGHT_TTL)
+        # a queued job is dequeued either way, a skipped one must not keep later jobs from being enqueued
+        compare_and_delete(self.queued_key, job_id)
+        return acquired
+
+    def extend(self, job_id):
+        """Extends the lock of job_id, returns False if job_id does not hold it"""
+        return compare_and_expire(self.lock_key, job_id, settings.SINGLE_FLIGHT_TTL)
+
+    def release(self, job_id):
+        """Releases the lock of job_id, a lock that expired and was taken by another job is kept"""
+        compare_and_delete(self.lock_key, job_id)
+
+    def _heartbeat(self, job_id, ttl, stopped, handed_over):
+        """Extends the lock every third of the TTL, a handed over lock until another task releases it"""
+        while not stopped.wait(ttl / 3):
+            if not self.extend(job_id):
+                if not handed_over.is_set():
+                    logger.warning(f'{self.name} lock was lost by {job_id}')
+                return
+
+    def enqueue(self, task, *args, job_name=None, **kwargs):
+        """Returns (job id, True) for a new job or (id of the running or queued job, False).
+
+        The queued progress of a new job is written under job_name, the flight name by default,
+        before the dispatch, so it never replaces the progress of a job that has already started.
+        """
+        running_id = self.running_id()
+        if running_id is not None:
+            return running_id, False
+        job_id = str(uuid.uuid4())
+        if not cache.add(self.queued_key, job_id, timeout=settings.SINGLE_FLIGHT_QUEUED_TTL):
+            return self.queued_id() or self.running_id(), False
+        JobProgress(job_id, job_name or self.name).queue()
+        task.apply_async(args=args, kwargs=kwargs, task_id=job_id)
+        return job_id, True
+
+
+def single_flight(name, skipped=None):
+    """Task decorator: a run that finds the job already running returns skipped() or None.
+
+    The progress of a skipped queued job is marked superseded by the running one.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            request_id = getattr(current_task.request, 'id', None) if current_task else None
+            job_id = request_id or str(uuid.uuid4())
+            flight = SingleFlight(name)
+            with flight.hold(job_id) as acquired:
+                if not acquired:
+                    running_id = flight.running_id()
+                    logger.info(f'{name} is already running as {running_id}, {job_id} skipped')
+                    JobProgress(job_id).supersede(running_id)
+                    return skipped() if skipped is not None else None
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
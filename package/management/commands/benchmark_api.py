@@ -0,0 +1,65 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from package.benchmarks import (
+    benchmark_databases, run_api_benchmarks, run_task_benchmarks, git_commit, compare_results, load_results,
+)
+from package.rates import usd_rate_provider
+from package.seeding import seed_packages, seed_delivery_companies
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds packages into a test database, measures latency percentiles and query counts of the package endpoints and '
+        'throughput of the pricing task, and writes the results as JSON. With --compare the run fails '
+        'if it is slower than a previous result file by more than --threshold. The database user needs '
+        'the right to create databases.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100_000)
+        parser.add_argument('--sessions', type=int, default=100)
+        parser.add_argument('--companies', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--rate', type=float, default=89.13)
+        parser.add_argument('--skip-tasks', action='store_true')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='JSON file of a previous run')
+        parser.add_argument('--threshold', type=float, default=0.2)
+
+    def handle(self, *args, **options):
+        with benchmark_databases(options['verbosity']):
+            self.stdout.write(f'seeding {options["count"]} packages...')
+            started_at = time.perf_counter()
+            owners = seed_packages(options['count'], sessions=options['sessions'])
+            company_ids = seed_delivery_companies(options['companies'])
+            self.stdout.write(f'seeded in {time.perf_counter() - started_at:.1f} s')
+            # the rate is stored in the cache of this process, it stubs the rate endpoint for
+            # pricing on create and for the pricing task
+            usd_rate_provider.store(options['rate'])
+            results = {
+                'commit': git_commit(),
+                'count': options['count'],
+                'sessions': options['sessions'],
+                'endpoints': run_api_benchmarks(owners[0], company_ids, repeat=options['repeat']),
+                'tasks': {} if options['skip_tasks'] else run_task_benchmarks(owners),
+            }
+
+        for name, result in results['endpoints'].items():
+            self.stdout.write(
+                f'{name:<32} p50 {result["p50_ms"]:>8} ms  p99 {result["p99_ms"]:>8} ms  '
+                f'queries {result["queries_min"]}-{result["queries_max"]}'
+            )
+        for name, stats in results['tasks'].items():
+            self.stdout.write(f'{name:<32} {stats["rows_per_sec"]:>10} rows/sec')
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+        if options['compare']:
+            regressions = compare_results(load_results(options['compare']), results, options['threshold'])
+            if regressions:
+                raise CommandError('regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('no regressions'))
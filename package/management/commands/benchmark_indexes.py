@@ -0,0 +1,60 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from package.benchmarks import benchmark_databases
+from package.models import Package
+from package.seeding import seed_packages
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds packages into a test database and shows EXPLAIN and timings of the hot queries '
+        'without and with Package indexes. The database user needs the right to create databases.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100_000)
+        parser.add_argument('--sessions', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with benchmark_databases(options['verbosity']):
+            self.run(options)
+
+    def run(self, options):
+        self.stdout.write(f'seeding {options["count"]} packages...')
+        owners = seed_packages(options['count'], sessions=options['sessions'])
+        owner = owners[0]
+        type_package_id = Package.objects.filter(owner=owner).values_list('type_package_id', flat=True)[0]
+        queries = {
+            'pricing backlog page': Package.objects.filter(
+                delivery_cost__isnull=True
+            ).order_by('pk')[:settings.DELIVERY_COST_BATCH_SIZE],
+            'owner packages': Package.objects.filter(owner=owner),
+            'owner packages by type': Package.objects.filter(owner=owner, type_package_id=type_package_id),
+        }
+        with connection.schema_editor() as schema_editor:
+            for index in Package._meta.indexes:
+                schema_editor.remove_index(Package, index)
+        try:
+            self.measure('before', queries, options['repeat'])
+        finally:
+            with connection.schema_editor() as schema_editor:
+                for index in Package._meta.indexes:
+                    schema_editor.add_index(Package, index)
+        self.measure('after', queries, options['repeat'])
+
+    def measure(self, title, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{title} indexes'))
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started_at = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - started_at) * 1000)
+            self.stdout.write(self.style.MIGRATE_LABEL(f'{name}: median {statistics.median(timings):.2f} ms'))
+            self.stdout.write(queryset.explain())
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from config.celery import app
+from package.benchmarks import benchmark_databases
+from package.models import Package
+from package.seeding import seed_packages
+from package.tasks import calculate_delivery_cost_in_parallel_task
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds unpriced packages into a test database and prices them with calculate_delivery_cost_in_parallel_task. '
+        'With --eager the ranges run one after another in this process, which is the single worker baseline; '
+        'without it the chord is sent to the broker, start N workers on the test database with '
+        '"DB_NAME=test_<DB_NAME> celery -A config worker -P solo" and compare rows/sec for different N. '
+        'The database user needs the right to create databases.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100_000)
+        parser.add_argument('--range-size', type=int, default=10_000)
+        parser.add_argument('--rate', type=float, default=89.13)
+        parser.add_argument('--eager', action='store_true')
+        parser.add_argument('--timeout', type=int, default=600)
+
+    def handle(self, *args, **options):
+        with benchmark_databases(options['verbosity']):
+            self.run(options)
+
+    def run(self, options):
+        self.stdout.write(f'seeding {options["count"]} packages into {connection.settings_dict["NAME"]}...')
+        seed_packages(options['count'], priced_share=0)
+        # the test database holds only the seeded packages, and the rate is passed to the ranges
+        # instead of being stored in the cache the workers share
+        backlog = Package.objects.filter(delivery_cost__isnull=True)
+        started_at = time.perf_counter()
+        if options['eager']:
+            app.conf.task_always_eager = True
+        calculate_delivery_cost_in_parallel_task(range_size=options['range_size'], usd_rate_in_rub=options['rate'])
+        while backlog.exists():
+            if time.perf_counter() - started_at > options['timeout']:
+                self.stderr.write(f'{backlog.count()} packages are still unpriced, giving up')
+                return
+            time.sleep(0.2)
+        seconds = time.perf_counter() - started_at
+        self.stdout.write(
+            f'{options["count"]} packages priced in {seconds:.2f} s, {options["count"] / seconds:.0f} rows/sec'
+        )
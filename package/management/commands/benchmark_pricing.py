@@ -0,0 +1,37 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from package.service import delivery_cost_calculation, delivery_cost_calculation_batch, round_delivery_cost
+
+
+class Command(BaseCommand):
+    help = 'Compares per-row delivery_cost_calculation with delivery_cost_calculation_batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--rate', type=float, default=89.13)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        randomizer = random.Random(options['seed'])
+        usd_rate_in_rub = options['rate']
+        self.stdout.write(f'{"rows":>10} {"per-row, s":>12} {"batch, s":>12} {"speedup":>8}')
+        for size in options['sizes']:
+            weights = [Decimal(randomizer.randint(1, 100_000)).scaleb(-3) for _ in range(size)]
+            costs_in_usd = [Decimal(randomizer.randint(1, 1_000_000)).scaleb(-2) for _ in range(size)]
+
+            started_at = time.perf_counter()
+            for weight, cost_in_usd in zip(weights, costs_in_usd):
+                round_delivery_cost(delivery_cost_calculation(weight, cost_in_usd, usd_rate_in_rub))
+            per_row_seconds = time.perf_counter() - started_at
+
+            started_at = time.perf_counter()
+            delivery_cost_calculation_batch(weights, costs_in_usd, usd_rate_in_rub)
+            batch_seconds = time.perf_counter() - started_at
+
+            self.stdout.write(
+                f'{size:>10} {per_row_seconds:>12.3f} {batch_seconds:>12.3f} {per_row_seconds / batch_seconds:>7.1f}x'
+            )
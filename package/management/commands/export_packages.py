@@ -0,0 +1,56 @@
+import functools
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from package.exporting import EXPORT_FORMATS, export_filtersets, export_pages, render
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the live and then the archived packages as CSV or NDJSON to a file or stdout, '
+        'rows are read in keyset pages'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--output', default='-', help='File path, "-" for stdout')
+        parser.add_argument('--type-package', type=int)
+        parser.add_argument('--delivery-company', type=int)
+        parser.add_argument('--priced', choices=('true', 'false'))
+        parser.add_argument('--created-after', help='ISO datetime, packages created at or after it')
+        parser.add_argument('--created-before', help='ISO datetime, packages created before it')
+        parser.add_argument('--archived', choices=('true', 'false'),
+                            help='Only the archived or only the live packages, both by default')
+        parser.add_argument('--chunk-size', type=int, default=settings.PACKAGE_EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        params = {
+            name: options[name]
+            for name in ('type_package', 'delivery_company', 'priced', 'created_after', 'created_before', 'archived')
+            if options[name] is not None
+        }
+        filtersets = export_filtersets(params)
+        if not filtersets[0].is_valid():
+            raise CommandError(filtersets[0].errors.as_text())
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] != '-' else None
+        write = output.write if output is not None else functools.partial(self.stdout.write, ending='')
+        started_at = time.perf_counter()
+        rows = 0
+
+        def counted(pages):
+            nonlocal rows
+            for page in pages:
+                rows += len(page)
+                yield page
+
+        querysets = [filterset.qs for filterset in filtersets]
+        try:
+            for chunk in render(counted(export_pages(querysets, options['chunk_size'])), options['format']):
+                write(chunk)
+        finally:
+            if output is not None:
+                output.close()
+        seconds = time.perf_counter() - started_at
+        self.stderr.write(f'{rows} packages exported in {seconds:.2f} s, {rows / seconds:.0f} rows/sec')
@@ -0,0 +1,61 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from package.importing import IMPORT_FORMATS, import_packages, open_import_stream, read_rows
+from package.rates import usd_rate_provider
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports packages from a CSV file with a header or from NDJSON, "-" reads stdin. Rows are validated '
+        'by the rules of the package API and inserted in batches, invalid rows are reported and skipped. '
+        'Every row creates a new package: id and usd_rate_version columns of an export are ignored, so '
+        're-importing an export creates copies.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or NDJSON file, "-" for stdin')
+        parser.add_argument('--format', choices=IMPORT_FORMATS, help='By default taken from the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--price', action='store_true', help='Price packages without delivery_cost on ingest')
+        parser.add_argument('--load-data', action='store_true',
+                            help='Insert with MySQL LOAD DATA LOCAL INFILE, needs local_infile on both sides')
+        parser.add_argument('--max-errors', type=int, default=1000, help='Stop after this many invalid rows')
+        parser.add_argument('--show-errors', type=int, default=20, help='Print at most this many invalid rows')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or ('ndjson' if os.path.splitext(options['path'])[1] in ('.ndjson', '.jsonl')
+                                    else 'csv')
+        if options['load_data'] and connection.vendor != 'mysql':
+            raise CommandError('--load-data needs a MySQL database')
+        usd_rate_in_rub = None
+        if options['price']:
+            usd_rate_in_rub = usd_rate_provider.cached()[0]
+            if usd_rate_in_rub is None:
+                raise CommandError('usd rate is not cached, run update_usd_rate first or import without --price')
+        shown_errors = 0
+
+        def on_batch(stats, errors):
+            nonlocal shown_errors
+            for line_number, row_errors in errors[:max(options['show_errors'] - shown_errors, 0)]:
+                self.stderr.write(f'line {line_number}: {row_errors}')
+            shown_errors += len(errors)
+            self.stdout.write(f'{stats["rows"]} rows, {stats["created"]} created, {stats["invalid"]} invalid')
+            if stats['invalid'] > options['max_errors']:
+                raise CommandError(f'more than {options["max_errors"]} invalid rows, '
+                                   f'{stats["created"]} packages were imported')
+
+        with open_import_stream(options['path']) as stream:
+            stats = import_packages(
+                read_rows(stream, fmt),
+                batch_size=options['batch_size'],
+                usd_rate_in_rub=usd_rate_in_rub,
+                load_data=options['load_data'],
+                on_batch=on_batch,
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f'{stats["created"]} packages imported, {stats["invalid"]} invalid rows skipped '
+            f'in {stats["seconds"]} s, {stats["rows_per_sec"]} rows/sec'
+        ))
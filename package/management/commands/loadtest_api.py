@@ -0,0 +1,41 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from package.loadtest import run_load
+
+
+class Command(BaseCommand):
+    help = (
+        'Polls the package endpoints of running deployments from concurrent clients and compares req/s and '
+        'latency percentiles, e.g. WSGI "gunicorn config.wsgi -w 4" against ASGI "uvicorn config.asgi:application '
+        '--workers 4". Every client gets its own session with --packages packages.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_urls', nargs='+', help='e.g. http://127.0.0.1:8000 http://127.0.0.1:8001')
+        parser.add_argument('--path', action='append', dest='paths', help='Polled path, can be repeated')
+        parser.add_argument('--clients', type=int, default=100)
+        parser.add_argument('--duration', type=float, default=10)
+        parser.add_argument('--packages', type=int, default=20)
+        parser.add_argument('--etag', action='store_true', help='Send If-None-Match like a polling client')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/package/', '/type_package/']
+        results = []
+        for base_url in options['base_urls']:
+            self.stdout.write(f'{base_url}: {options["clients"]} clients for {options["duration"]} s...')
+            result = asyncio.run(run_load(
+                base_url, paths, clients=options['clients'], duration=options['duration'],
+                packages=options['packages'], etag=options['etag'],
+            ))
+            results.append({'paths': paths, **result})
+            self.stdout.write(self.style.MIGRATE_LABEL(
+                f'{result["req_per_sec"]} req/s, p50 {result["p50_ms"]} ms, p99 {result["p99_ms"]} ms, '
+                f'{result["errors"]} errors of {result["requests"]} requests'
+            ))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from package import rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the delivery cost rollups from a full scan of the packages, --check only compares them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Report the differences without rebuilding')
+
+    def handle(self, *args, **options):
+        differences = rollups.check()
+        for (type_package_id, company_id), field, stored, scanned in differences:
+            self.stderr.write(f'type {type_package_id}, company {company_id}: {field} {stored} != {scanned}')
+        if options['check']:
+            if differences:
+                raise CommandError(f'{len(differences)} rollup values differ from the packages')
+            self.stdout.write(self.style.SUCCESS('rollups match the packages'))
+            return
+        rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'rollups rebuilt, {len(differences)} values fixed'))
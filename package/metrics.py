@@ -0,0 +1,329 @@
+import os
+import socket
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+PROCESSES_KEY = 'metrics:processes'
+
+
+class Metric:
+    """Values of one metric per label values tuple, updated in process memory under a lock"""
+    type = None
+
+    def __init__(self, name, help, labelnames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def snapshot(self):
+        with self.lock:
+            values = {labels: list(value) if isinstance(value, list) else value
+                      for labels, value in self.values.items()}
+        return {'type': self.type, 'help': self.help, 'labelnames': self.labelnames, 'buckets': self.buckets,
+                'values': values}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Last set value, merged over processes by the time it was set"""
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = (value, time.time())
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames, tuple(buckets))
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one counter per bucket, then sum and count
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+class Registry:
+    """Metrics of this process. Every process flushes a snapshot to the shared cache at most once per
+    METRICS_FLUSH_INTERVAL, the /metrics view merges the snapshots of all live web and worker processes.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.flushed_at = 0
+        os.register_at_fork(after_in_child=self.reset)
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+        self.flushed_at = 0
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    @staticmethod
+    def process_key():
+        return f'metrics:process:{socket.gethostname()}:{os.getpid()}'
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        key = self.process_key()
+        cache.set(key, self.snapshot(), timeout=settings.METRICS_PROCESS_TTL)
+        processes = cache.get(PROCESSES_KEY) or set()
+        if key not in processes:
+            cache.set(PROCESSES_KEY, processes | {key}, timeout=None)
+
+    def flush_due(self):
+        return time.monotonic() - self.flushed_at > settings.METRICS_FLUSH_INTERVAL
+
+    def maybe_flush(self):
+        if self.flush_due():
+            self.flush()
+
+    def collect(self):
+        """Merged snapshots of all processes, snapshots of exited processes expire and are dropped"""
+        self.flush()
+        processes = cache.get(PROCESSES_KEY) or set()
+        snapshots = cache.get_many(processes)
+        if len(snapshots) < len(processes):
+            cache.set(PROCESSES_KEY, set(snapshots), timeout=None)
+        return merge(snapshots.values())
+
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, 'values': {}})
+            for labels, value in metric['values'].items():
+                current = target['values'].get(labels)
+                if current is None:
+                    target['values'][labels] = value
+                elif metric['type'] == 'gauge':
+                    target['values'][labels] = max(current, value, key=lambda item: item[1])
+                elif metric['type'] == 'histogram':
+                    target['values'][labels] = [a + b for a, b in zip(current, value)]
+                else:
+                    target['values'][labels] = current + value
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labelnames, labels, extra=()):
+    pairs = [*zip(labelnames, labels), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics):
+    """Prometheus text exposition format 0.0.4"""
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        labelnames = metric['labelnames']
+        for labels, value in sorted(metric['values'].items()):
+            if metric['type'] == 'histogram':
+                for bound, count in zip(metric['buckets'], value):
+                    bucket_labels = _labels(labelnames, labels, [('le', _number(float(bound)))])
+                    lines.append(f'{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{name}_bucket{_labels(labelnames, labels, [("le", "+Inf")])} {value[-1]}')
+                lines.append(f'{name}_sum{_labels(labelnames, labels)} {_number(value[-2])}')
+                lines.append(f'{name}_count{_labels(labelnames, labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_labels(labelnames, labels)} '
+                             f'{_number(value[0] if metric["type"] == "gauge" else value)}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Latency of requests by view', ('view', 'method', 'status'),
+))
+http_request_queries = registry.register(Histogram(
+    'http_request_db_queries', 'SQL queries per request', ('view',), buckets=QUERY_COUNT_BUCKETS,
+))
+http_request_query_duration = registry.register(Histogram(
+    'http_request_db_query_duration_seconds', 'Time spent in SQL queries per request', ('view',),
+))
+usd_rate_lookups = registry.register(Counter(
+    'usd_rate_cache_lookups_total', 'Lookups of usd_rate_in_rub: process memory, shared cache hit or miss',
+    ('result',),
+))
+cbr_fetch_duration = registry.register(Histogram(
+    'cbr_fetch_duration_seconds', 'Latency of the CBR rate request', ('result',),
+))
+cbr_fetch_failures = registry.register(Counter(
+    'cbr_fetch_failures_total', 'Failed CBR rate requests',
+))
+task_duration = registry.register(Histogram(
+    'celery_task_duration_seconds', 'Run time of celery tasks', ('task', 'state'),
+    buckets=DEFAULT_BUCKETS + (30, 60, 300, 900),
+))
+pricing_duration = registry.register(Histogram(
+    'pricing_job_duration_seconds', 'Duration of pricing jobs', ('job',), buckets=DEFAULT_BUCKETS + (30, 60, 300, 900),
+))
+pricing_rows = registry.register(Counter(
+    'pricing_job_rows_total', 'Packages priced by pricing jobs', ('job',),
+))
+pricing_rows_per_sec = registry.register(Gauge(
+    'pricing_job_rows_per_second', 'Throughput of the last run of a pricing job', ('job',),
+))
+
+
+def observe_pricing(job, stats):
+    """Records the stats returned by calculate_delivery_cost_in_batches"""
+    pricing_duration.observe(stats['seconds'], job)
+    pricing_rows.inc(job, amount=stats['updated'])
+    pricing_rows_per_sec.set(stats['rows_per_sec'], job)
+
+
+_task_started_at = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started_at[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def observe_task(task_id=None, task=None, state=None, **kwargs):
+    started_at = _task_started_at.pop(task_id, None)
+    if started_at is not None:
+        task_duration.observe(time.perf_counter() - started_at, task.name, state or 'UNKNOWN')
+    registry.maybe_flush()
+
+
+@worker_process_shutdown.connect
+def flush_on_shutdown(**kwargs):
+    registry.flush()
+
+
+class QueryRecorder:
+    """Count and time of the SQL queries run in the context of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+_query_recorder = ContextVar('query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, the recorder is a context variable, so queries of async
+    views run by sync_to_async in another thread are counted for their request too
+    """
+    recorder = _query_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.seconds += time.perf_counter() - started_at
+        recorder.count += 1
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _observe_request(request, response, seconds, recorder):
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match is not None else 'unresolved'
+    http_request_duration.observe(seconds, view, request.method, response.status_code)
+    http_request_queries.observe(recorder.count, view)
+    http_request_query_duration.observe(recorder.seconds, view)
+
+
+class MetricsMiddleware:
+    """Latency and SQL queries of every request, for sync and async views"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        token = _query_recorder.set(recorder)
+        started_at = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_recorder.reset(token)
+        _observe_request(request, response, time.perf_counter() - started_at, recorder)
+        if registry.flush_due():
+            registry.flush()
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        token = _query_recorder.set(recorder)
+        started_at = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_recorder.reset(token)
+        _observe_request(request, response, time.perf_counter() - started_at, recorder)
+        if registry.flush_due():
+            await sync_to_async(registry.flush)()
+        return response
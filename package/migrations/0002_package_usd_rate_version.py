@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='usd_rate_version',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='Курс доллара при расчете, в копейках'),
+        ),
+    ]
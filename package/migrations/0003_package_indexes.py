@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:58
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0002_package_usd_rate_version'),
+        ('sessions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='package',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['session', 'type_package'], name='package_session_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['delivery_cost', 'id'], name='package_backlog_idx'),
+        ),
+    ]
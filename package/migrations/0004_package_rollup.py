@@ -0,0 +1,59 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_rollups(apps, schema_editor):
+    Package = apps.get_model('package', 'Package')
+    PackageRollup = apps.get_model('package', 'PackageRollup')
+    db_alias = schema_editor.connection.alias
+    rows = Package.objects.using(db_alias).order_by().values('type_package_id', 'delivery_company_id').annotate(
+        count=Count('pk'),
+        total_weight=Sum('weight'),
+        total_cost_in_usd=Sum('cost_in_usd'),
+        priced_count=Count('delivery_cost'),
+        total_delivery_cost=Sum('delivery_cost'),
+    )
+    totals = {}
+    for row in rows:
+        key = (row['type_package_id'], row['delivery_company_id'] or 0)
+        values = totals.setdefault(key, [0, 0, 0, 0, 0])
+        for i, field in enumerate(('count', 'total_weight', 'total_cost_in_usd', 'priced_count', 'total_delivery_cost')):
+            values[i] += row[field] or 0
+    PackageRollup.objects.using(db_alias).bulk_create([
+        PackageRollup(
+            type_package_id=type_package_id, company_id=company_id, count=values[0], total_weight=values[1],
+            total_cost_in_usd=values[2], priced_count=values[3], total_delivery_cost=values[4],
+        )
+        for (type_package_id, company_id), values in totals.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0003_package_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('company_id', models.PositiveIntegerField(default=0, verbose_name='Id компании доставки, 0 если компания не выбрана')),
+                ('count', models.BigIntegerField(default=0, verbose_name='Количество посылок')),
+                ('total_weight', models.DecimalField(decimal_places=3, default=0, max_digits=24, verbose_name='Общий вес в кг')),
+                ('total_cost_in_usd', models.DecimalField(decimal_places=2, default=0, max_digits=30, verbose_name='Общая стоимость в $')),
+                ('priced_count', models.BigIntegerField(default=0, verbose_name='Количество посылок с рассчитанной доставкой')),
+                ('total_delivery_cost', models.DecimalField(decimal_places=2, default=0, max_digits=30, verbose_name='Общая стоимость доставки в ₽')),
+                ('type_package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='package.typepackage', verbose_name='Тип посылки')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='packagerollup',
+            constraint=models.UniqueConstraint(fields=('type_package', 'company_id'), name='package_rollup_group_unique'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:32
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def copy_sessions_to_owners(apps, schema_editor):
+    """Session keys of the packages become owner tokens, old owners expire like their sessions.
+
+    The packages are updated by pages of BATCH_SIZE in pk order, every UPDATE commits on its own.
+    """
+    Package = apps.get_model('package', 'Package')
+    PackageOwner = apps.get_model('package', 'PackageOwner')
+    Session = apps.get_model('sessions', 'Session')
+    db_alias = schema_editor.connection.alias
+    owned = Package.objects.using(db_alias).filter(session__isnull=False).order_by('pk')
+    last_pk = None
+    while True:
+        page = owned.filter(pk__gt=last_pk) if last_pk is not None else owned
+        pks = list(page.values_list('pk', flat=True)[:BATCH_SIZE])
+        if not pks:
+            break
+        Package.objects.using(db_alias).filter(pk__in=pks).update(owner=models.F('session_id'))
+        last_pk = pks[-1]
+    sessions = Session.objects.using(db_alias).filter(
+        session_key__in=Package.objects.using(db_alias).filter(session__isnull=False).values('session_id')
+    ).values_list('session_key', 'expire_date')
+    PackageOwner.objects.using(db_alias).bulk_create(
+        (
+            PackageOwner(token=session_key, last_seen_at=expire_date - timedelta(seconds=settings.SESSION_COOKIE_AGE))
+            for session_key, expire_date in sessions.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    # the pages of copy_sessions_to_owners are not held in one long transaction
+    atomic = False
+
+    dependencies = [
+        ('package', '0004_package_rollup'),
+        ('sessions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackageOwner',
+            fields=[
+                ('token', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('last_seen_at', models.DateTimeField(db_index=True, verbose_name='Последнее обращение')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='owner',
+            field=models.CharField(blank=True, default=None, max_length=40, null=True, verbose_name='Токен владельца из сессии пользователя'),
+        ),
+        migrations.RunPython(copy_sessions_to_owners, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='package',
+            name='package_session_type_idx',
+        ),
+        migrations.RemoveField(
+            model_name='package',
+            name='session',
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['owner', 'type_package'], name='package_owner_type_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0005_package_owner'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrencyRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('char_code', models.CharField(max_length=3, verbose_name='Код валюты')),
+                ('effective_at', models.DateTimeField(verbose_name='Дата курса')),
+                ('value', models.DecimalField(decimal_places=8, max_digits=18, verbose_name='Курс в ₽ за единицу валюты')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='currencyrate',
+            constraint=models.UniqueConstraint(fields=('char_code', 'effective_at'), name='currency_rate_code_time_unique'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0006_currency_rate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPackage',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('owner', models.CharField(blank=True, default=None, max_length=40, null=True, verbose_name='Токен владельца из сессии пользователя')),
+                ('name', models.CharField(max_length=100, verbose_name='Название')),
+                ('weight', models.DecimalField(decimal_places=3, max_digits=10, verbose_name='Вес в кг')),
+                ('cost_in_usd', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Стоимость в $')),
+                ('delivery_cost', models.DecimalField(blank=True, decimal_places=2, default=None, max_digits=20, null=True, verbose_name='Стоимость доставки в ₽')),
+                ('usd_rate_version', models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='Курс доллара при расчете, в копейках')),
+                ('created_at', models.DateTimeField(verbose_name='Создана')),
+                ('updated_at', models.DateTimeField(verbose_name='Изменена')),
+                ('archived_at', models.DateTimeField(verbose_name='Перенесена в архив')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='Создана'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='package',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='Изменена'),
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['updated_at'], name='package_updated_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedpackage',
+            name='delivery_company',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_packages', to='package.deliverycompany'),
+        ),
+        migrations.AddField(
+            model_name='archivedpackage',
+            name='type_package',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_packages', to='package.typepackage', verbose_name='Тип посылки'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedpackage',
+            index=models.Index(fields=['owner', 'type_package'], name='archived_package_owner_idx'),
+        ),
+    ]
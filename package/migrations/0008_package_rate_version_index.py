@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0007_package_archive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['usd_rate_version'], name='package_rate_version_idx'),
+        ),
+    ]
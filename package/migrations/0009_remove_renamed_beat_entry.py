@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:20
+
+from django.db import migrations
+
+
+# the 5 minute entry renamed to sweep-packages-where-delivery-cost-is-null in config/celery.py,
+# DatabaseScheduler adds the new entry but keeps running the old row
+RENAMED_BEAT_ENTRIES = ('update-delivery-cost-for-all-packages-where-delivery-cost-is-null-every-5-min',)
+
+
+def delete_renamed_beat_entries(apps, schema_editor):
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTask.objects.using(schema_editor.connection.alias).filter(name__in=RENAMED_BEAT_ENTRIES).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('package', '0008_package_rate_version_index'),
+        ('django_celery_beat', '0018_improve_crontab_helptext'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_renamed_beat_entries, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,6 @@
 import uuid
 
 from django.db import models
-from django.contrib.sessions.models import Session
 
 
 class Package(models.Model):
@@ -9,15 +8,13 @@ class Package(models.Model):
         primary_key=True,
         default=uuid.uuid4,
         editable=False,
-        db_index=True,
     )
-    session = models.ForeignKey(
-        Session,
-        verbose_name='Id сессии пользователя',
-        on_delete=models.SET_NULL,
-        db_index=True,
+    owner = models.CharField(
+        verbose_name='Токен владельца из сессии пользователя',
+        max_length=40,
         blank=True,
         null=True,
+        default=None,
     )
     name = models.CharField(
         verbose_name='Название',
@@ -47,6 +44,12 @@ class Package(models.Model):
         null=True,
         default=None,
     )
+    usd_rate_version = models.PositiveIntegerField(
+        verbose_name='Курс доллара при расчете, в копейках',
+        blank=True,
+        null=True,
+        default=None,
+    )
     delivery_company = models.ForeignKey(
         'DeliveryCompany',
         on_delete=models.SET_NULL,
@@ -54,10 +57,108 @@ class Package(models.Model):
         null=True,
         default=None,
     )
+    created_at = models.DateTimeField(
+        verbose_name='Создана',
+        auto_now_add=True,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменена',
+        auto_now=True,
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'type_package'], name='package_owner_type_idx'),
+            models.Index(fields=['delivery_cost', 'id'], name='package_backlog_idx'),
+            models.Index(fields=['updated_at'], name='package_updated_idx'),
+            # stale priced packages are looked up by the rate task every run
+            models.Index(fields=['usd_rate_version'], name='package_rate_version_idx'),
+        ]
 
     @property
     def type_package_name(self):
-        return str(self.type_package)
+        from package.reference import reference_data
+
+        type_package = reference_data.get_type_package(self.type_package_id) or self.type_package
+        return str(type_package)
+
+
+class ArchivedPackage(models.Model):
+    """Settled package moved out of Package by package.archiving, archived rows are not changed"""
+    id = models.UUIDField(
+        primary_key=True,
+        editable=False,
+    )
+    owner = models.CharField(
+        verbose_name='Токен владельца из сессии пользователя',
+        max_length=40,
+        blank=True,
+        null=True,
+        default=None,
+    )
+    name = models.CharField(
+        verbose_name='Название',
+        max_length=100,
+    )
+    weight = models.DecimalField(
+        verbose_name='Вес в кг',
+        max_digits=10,
+        decimal_places=3,
+    )
+    type_package = models.ForeignKey(
+        'TypePackage',
+        related_name='archived_packages',
+        verbose_name='Тип посылки',
+        on_delete=models.CASCADE,
+    )
+    cost_in_usd = models.DecimalField(
+        verbose_name='Стоимость в $',
+        max_digits=20,
+        decimal_places=2,
+    )
+    delivery_cost = models.DecimalField(
+        verbose_name='Стоимость доставки в ₽',
+        max_digits=20,
+        decimal_places=2,
+        blank=True,
+        null=True,
+        default=None,
+    )
+    usd_rate_version = models.PositiveIntegerField(
+        verbose_name='Курс доллара при расчете, в копейках',
+        blank=True,
+        null=True,
+        default=None,
+    )
+    delivery_company = models.ForeignKey(
+        'DeliveryCompany',
+        related_name='archived_packages',
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        default=None,
+    )
+    created_at = models.DateTimeField(
+        verbose_name='Создана',
+    )
+    updated_at = models.DateTimeField(
+        verbose_name='Изменена',
+    )
+    archived_at = models.DateTimeField(
+        verbose_name='Перенесена в архив',
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'type_package'], name='archived_package_owner_idx'),
+        ]
+
+    @property
+    def type_package_name(self):
+        from package.reference import reference_data
+
+        type_package = reference_data.get_type_package(self.type_package_id) or self.type_package
+        return str(type_package)
 
 
 class TypePackage(models.Model):
@@ -95,3 +196,81 @@ class DeliveryCompany(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class PackageOwner(models.Model):
+    """Owner token kept in the session of a user, packages are released when it is not seen for a session age"""
+    token = models.CharField(
+        primary_key=True,
+        max_length=40,
+    )
+    last_seen_at = models.DateTimeField(
+        verbose_name='Последнее обращение',
+        db_index=True,
+    )
+
+
+class PackageRollup(models.Model):
+    """Package totals per type and delivery company, kept up to date by package.rollups"""
+    type_package = models.ForeignKey(
+        'TypePackage',
+        related_name='rollups',
+        verbose_name='Тип посылки',
+        on_delete=models.CASCADE,
+    )
+    company_id = models.PositiveIntegerField(
+        verbose_name='Id компании доставки, 0 если компания не выбрана',
+        default=0,
+    )
+    count = models.BigIntegerField(
+        verbose_name='Количество посылок',
+        default=0,
+    )
+    total_weight = models.DecimalField(
+        verbose_name='Общий вес в кг',
+        max_digits=24,
+        decimal_places=3,
+        default=0,
+    )
+    total_cost_in_usd = models.DecimalField(
+        verbose_name='Общая стоимость в $',
+        max_digits=30,
+        decimal_places=2,
+        default=0,
+    )
+    priced_count = models.BigIntegerField(
+        verbose_name='Количество посылок с рассчитанной доставкой',
+        default=0,
+    )
+    total_delivery_cost = models.DecimalField(
+        verbose_name='Общая стоимость доставки в ₽',
+        max_digits=30,
+        decimal_places=2,
+        default=0,
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['type_package', 'company_id'], name='package_rollup_group_unique'),
+        ]
+
+
+class CurrencyRate(models.Model):
+    """Rate of one currency from one CBR daily snapshot, written by package.rate_history"""
+    char_code = models.CharField(
+        verbose_name='Код валюты',
+        max_length=3,
+    )
+    effective_at = models.DateTimeField(
+        verbose_name='Дата курса',
+    )
+    value = models.DecimalField(
+        verbose_name='Курс в ₽ за единицу валюты',
+        max_digits=18,
+        decimal_places=8,
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['char_code', 'effective_at'], name='currency_rate_code_time_unique'),
+        ]
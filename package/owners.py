@@ -0,0 +1,107 @@
+import time
+import uuid
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.utils import timezone
+
+from package.models import ArchivedPackage, Package, PackageOwner
+from package.response_cache import invalidate_sessions
+from package.service import iterate_keyset_ranges
+
+
+OWNER_SESSION_KEY = 'package_owner'
+OWNER_SEEN_SESSION_KEY = 'package_owner_seen_at'
+# keys of the database sessions that owned packages before migration 0005
+LEGACY_SESSION_KEY_LENGTH = 32
+
+
+def owner_lifetime():
+    """Ownership ends this long after the last touch, when the session saved with it expires too"""
+    return settings.SESSION_COOKIE_AGE
+
+
+def _adopt_legacy_owner(request):
+    """Owner of a client still sending the key of a database session from before signed cookie sessions.
+
+    Migration 0005 made the session keys owner tokens. The key of an unexpired session row that
+    is still an owner is moved into the session once, so these clients keep their packages.
+    """
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')
+    if len(session_key) != LEGACY_SESSION_KEY_LENGTH or not session_key.isalnum():
+        return
+    now = timezone.now()
+    last_seen_at = PackageOwner.objects.filter(
+        token=session_key,
+        last_seen_at__gt=now - timedelta(seconds=owner_lifetime()),
+        token__in=Session.objects.filter(session_key=session_key, expire_date__gt=now).values('session_key'),
+    ).values_list('last_seen_at', flat=True).first()
+    if last_seen_at is not None:
+        request.session[OWNER_SESSION_KEY] = session_key
+        request.session[OWNER_SEEN_SESSION_KEY] = last_seen_at.timestamp()
+
+
+def get_owner(request):
+    """Owner token of the request session or None, writes neither the session nor the database
+    except to adopt a legacy session key"""
+    if OWNER_SESSION_KEY not in request.session:
+        _adopt_legacy_owner(request)
+    owner = request.session.get(OWNER_SESSION_KEY)
+    seen_at = request.session.get(OWNER_SEEN_SESSION_KEY, 0)
+    if owner is None or time.time() - seen_at > owner_lifetime():
+        return None
+    return owner
+
+
+def ensure_owner(request):
+    """Owner token of the request session, a new one is issued on the first write.
+
+    The owner row and the session are touched at most once per PACKAGE_OWNER_TOUCH_INTERVAL.
+    """
+    owner = get_owner(request)
+    now = time.time()
+    if owner is not None and now - request.session[OWNER_SEEN_SESSION_KEY] < settings.PACKAGE_OWNER_TOUCH_INTERVAL:
+        return owner
+    owner = owner or uuid.uuid4().hex
+    PackageOwner.objects.update_or_create(token=owner, defaults={'last_seen_at': timezone.now()})
+    request.session[OWNER_SESSION_KEY] = owner
+    request.session[OWNER_SEEN_SESSION_KEY] = now
+    return owner
+
+
+def session_for_owner(owner):
+    """Saved session of the configured engine holding the owner, its key is the session cookie value"""
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[OWNER_SESSION_KEY] = owner
+    session[OWNER_SEEN_SESSION_KEY] = time.time()
+    session.save()
+    return session
+
+
+def release_expired_owners(owner_batch_size=None, batch_size=None):
+    """Detaches packages of owners not seen for the owner lifetime, then deletes the owners.
+
+    Live and archived packages keep their data with owner NULL like after the old session cascade,
+    but every page of at most batch_size packages is updated in its own short transaction.
+    """
+    owner_batch_size = owner_batch_size or settings.PACKAGE_OWNER_CLEANUP_OWNER_BATCH_SIZE
+    batch_size = batch_size or settings.PACKAGE_OWNER_CLEANUP_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(seconds=owner_lifetime())
+    stats = {'owners': 0, 'packages': 0}
+    while True:
+        owners = list(
+            PackageOwner.objects.filter(last_seen_at__lt=cutoff)
+            .order_by('last_seen_at').values_list('token', flat=True)[:owner_batch_size]
+        )
+        if not owners:
+            return stats
+        for model in (Package, ArchivedPackage):
+            for page_queryset, _ in iterate_keyset_ranges(model.objects.filter(owner__in=owners), batch_size):
+                with transaction.atomic():
+                    stats['packages'] += page_queryset.update(owner=None)
+        # get_owner drops expired tokens from sessions, so these owners can not be touched again
+        stats['owners'] += PackageOwner.objects.filter(token__in=owners).delete()[0]
+        invalidate_sessions(owners)
@@ -0,0 +1,26 @@
+from django.core.paginator import InvalidPage
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+class PackageCursorPagination(CursorPagination):
+    """Keyset pagination by pk: no COUNT(*) and no OFFSET scans however deep the page is"""
+    ordering = 'pk'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class AsyncPageNumberPagination(PageNumberPagination):
+    """PageNumberPagination for async views, COUNT(*) and the page rows are fetched with the async ORM"""
+
+    async def apaginate_queryset(self, queryset, request):
+        self.request = request
+        paginator = self.django_paginator_class(queryset, self.get_page_size(request))
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [obj async for obj in self.page.object_list]
+        return list(self.page)
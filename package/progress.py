@@ -0,0 +1,131 @@
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from celery import current_task
+from django.conf import settings
+from django.core.cache import cache
+
+
+class JobProgress:
+    """Progress of a long-running job in the shared cache.
+
+    Counters are changed with atomic increments once per batch, so several workers may
+    report to the same job and nothing is written to the database.
+    """
+
+    def __init__(self, job_id, name=None):
+        self.job_id = job_id
+        self.name = name
+        self.key = f'job_progress:{job_id}'
+        self.done_key = f'{self.key}:done'
+        self.errors_key = f'{self.key}:errors'
+        self.updated_at_key = f'{self.key}:updated_at'
+
+    @classmethod
+    def for_current_task(cls, name):
+        """Progress of the running task, a job called outside of a worker gets its own id"""
+        request_id = getattr(current_task.request, 'id', None) if current_task else None
+        return cls(request_id or str(uuid.uuid4()), name)
+
+    def _new_meta(self):
+        return {'name': self.name, 'status': 'queued', 'total': None, 'started_at': None, 'finished_at': None,
+                'last_error': None}
+
+    def _update(self, **fields):
+        meta = cache.get(self.key) or self._new_meta()
+        meta.update(fields)
+        cache.set(self.key, meta, timeout=settings.JOB_PROGRESS_TTL)
+
+    def queue(self):
+        """Marks the job queued before it is dispatched, the progress of a job that already started is kept"""
+        cache.add(self.key, self._new_meta(), timeout=settings.JOB_PROGRESS_TTL)
+
+    def start(self, total=None):
+        now = time.time()
+        cache.set_many(
+            {self.done_key: 0, self.errors_key: 0, self.updated_at_key: now}, timeout=settings.JOB_PROGRESS_TTL
+        )
+        self._update(name=self.name, status='running', total=total, started_at=now, finished_at=None, last_error=None)
+
+    def set_total(self, total):
+        self._update(total=total)
+
+    def advance(self, rows):
+        try:
+            cache.incr(self.done_key, rows)
+        except ValueError:
+            cache.set(self.done_key, rows, timeout=settings.JOB_PROGRESS_TTL)
+        cache.set(self.updated_at_key, time.time(), timeout=settings.JOB_PROGRESS_TTL)
+
+    def error(self, error):
+        try:
+            cache.incr(self.errors_key)
+        except ValueError:
+            cache.set(self.errors_key, 1, timeout=settings.JOB_PROGRESS_TTL)
+        self._update(last_error=str(error))
+
+    def finish(self, status='succeeded'):
+        self._update(status=status, finished_at=time.time())
+
+    def supersede(self, running_id):
+        """Marks a queued job that was skipped for running_id, a job nobody queued is left untracked"""
+        if cache.get(self.key) is not None:
+            self._update(status='superseded', finished_at=time.time(), superseded_by=running_id)
+
+    def fail(self, error):
+        self.error(error)
+        self.finish(status='failed')
+
+    def report(self):
+        """Returns the progress with throughput and ETA or None for an unknown job"""
+        meta = cache.get(self.key)
+        if meta is None:
+            return None
+        counters = cache.get_many([self.done_key, self.errors_key, self.updated_at_key])
+        done = counters.get(self.done_key, 0)
+        started_at = meta['started_at']
+        until = meta['finished_at'] or time.time()
+        rows_per_sec = round(done / (until - started_at), 1) if started_at and until > started_at else None
+        total = meta['total']
+        eta_seconds = None
+        if meta['status'] == 'running' and rows_per_sec and total is not None:
+            eta_seconds = round(max(total - done, 0) / rows_per_sec, 1)
+        return {
+            'job_id': self.job_id,
+            'name': meta['name'],
+            'status': meta['status'],
+            'total': total,
+            'done': done,
+            'percent': round(done * 100 / total, 1) if total else None,
+            'rows_per_sec': rows_per_sec,
+            'eta_seconds': eta_seconds,
+            'errors': counters.get(self.errors_key, 0),
+            'last_error': meta['last_error'],
+            'superseded_by': meta.get('superseded_by'),
+            'started_at': _isoformat(started_at),
+            'updated_at': _isoformat(counters.get(self.updated_at_key)),
+            'finished_at': _isoformat(meta['finished_at']),
+        }
+
+
+@contextmanager
+def tracked_job(name, finish=True):
+    """Starts the progress of the current task, marks it failed on an exception.
+
+    finish=False leaves a successful job running for a chord callback to finish it.
+    """
+    progress = JobProgress.for_current_task(name)
+    progress.start()
+    try:
+        yield progress
+    except Exception as error:
+        progress.fail(error)
+        raise
+    if finish:
+        progress.finish()
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat() if timestamp else None
@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+from package.db_routing import primary_reads
+from package.models import CurrencyRate
+
+
+SNAPSHOT_KEY = 'currency_rates_snapshot'
+
+
+class RateHistory:
+    """In-process copy of the rate history, looked up by bisect over the sorted effective times.
+
+    Like ReferenceData, the series are kept with the version token they were loaded with and
+    reloaded when a saved snapshot replaces the token, so lookups do not query the database.
+    """
+    version_key = 'currency_rates_history_version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0
+        self._series = {}
+
+    def _current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < settings.REFERENCE_DATA_CHECK_INTERVAL:
+            return
+        version = self._current_version()
+        with self._lock:
+            if version != self._version:
+                self._series = {}
+                self._version = version
+            self._checked_at = now
+
+    def _get_series(self, char_code):
+        """(effective times, rates) of one currency in time order, loaded by one query"""
+        series = self._series.get(char_code)
+        if series is None:
+            with primary_reads():
+                rows = list(CurrencyRate.objects.filter(char_code=char_code).order_by('effective_at').values_list(
+                    'effective_at', 'value',
+                ))
+            series = self._series[char_code] = (
+                [effective_at for effective_at, _ in rows], [value for _, value in rows],
+            )
+        return series
+
+    def entries_at(self, moments, char_code='USD'):
+        """(effective_at, rate) in force at each of the moments, None for a moment before the first known rate"""
+        self._ensure_fresh()
+        times, values = self._get_series(char_code)
+        entries = []
+        for moment in moments:
+            i = bisect_right(times, moment)
+            entries.append((times[i - 1], values[i - 1]) if i else None)
+        return entries
+
+    def rates_at(self, moments, char_code='USD'):
+        return [entry[1] if entry is not None else None for entry in self.entries_at(moments, char_code)]
+
+    def rate_at(self, moment, char_code='USD'):
+        return self.rates_at([moment], char_code)[0]
+
+    def invalidate(self):
+        """Makes every process reload the history"""
+        with self._lock:
+            self._series = {}
+            self._version = None
+        cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+
+
+rate_history = RateHistory()
+
+
+def save_snapshot(snapshot):
+    """Writes all rates of a fetched snapshot by one bulk INSERT, a snapshot fetched again adds no rows"""
+    CurrencyRate.objects.bulk_create(
+        [
+            CurrencyRate(char_code=char_code, effective_at=snapshot.effective_at, value=value)
+            for char_code, value in snapshot.rates.items()
+        ],
+        batch_size=settings.PACKAGE_BULK_CREATE_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    latest = cache.get(SNAPSHOT_KEY)
+    if latest is None or latest.effective_at <= snapshot.effective_at:
+        cache.set(SNAPSHOT_KEY, snapshot, timeout=None)
+    rate_history.invalidate()
+
+
+def latest_snapshot():
+    """RatesSnapshot of the latest fetch with the rates of all currencies, None before the first fetch"""
+    return cache.get(SNAPSHOT_KEY)
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from package import metrics, rate_history
+from package.locks import SingleFlight
+
+
+logger = logging.getLogger('main')
+
+RATE_PRECISION = Decimal('0.00000001')
+
+
+class RatesSnapshot(namedtuple('RatesSnapshot', ('effective_at', 'rates'))):
+    """All rates of one daily_json.js payload: rubles per one unit of currency by char code"""
+
+    @classmethod
+    def parse(cls, text):
+        """Raises ValueError on a payload that is not JSON or has no rates"""
+        payload = json.loads(text)
+        try:
+            effective_at = datetime.fromisoformat(payload['Date']) if 'Date' in payload else timezone.now()
+            rates = {
+                char_code: (Decimal(str(rate['Value'])) / rate.get('Nominal', 1)).quantize(RATE_PRECISION)
+                for char_code, rate in payload['Valute'].items()
+            }
+        except (KeyError, TypeError, ArithmeticError) as error:
+            raise ValueError(f'unexpected rates payload: {error!r}')
+        return cls(effective_at, rates)
+
+    @property
+    def usd_rate_in_rub(self):
+        usd_rate_in_rub = self.rates.get('USD')
+        return round(float(usd_rate_in_rub), 2) if usd_rate_in_rub is not None else None
+
+
+class UsdRateProvider:
+    """USD rate from the CBR endpoint behind an in-process and a shared cache.
+
+    The last known rate never expires: when it is older than USD_RATE_FRESH_FOR it is still
+    served while one background refresh runs. The refresh is update_usd_rate_in_rub_task,
+    a single flight job, so only one worker fetches the rate at a time.
+    """
+    rate_key = 'usd_rate_in_rub'
+    fetched_at_key = 'usd_rate_in_rub_fetched_at'
+
+    def __init__(self):
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._local = None
+        self._refreshing = threading.Event()
+        self._async_clients = {}
+        self._refresh_enqueued_at = 0
+
+    @property
+    def session(self):
+        """HTTP session with a connection pool shared by all threads of the process"""
+        with self._session_lock:
+            if self._session is None:
+                retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504),
+                              allowed_methods=('GET',))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.USD_RATE_POOL_SIZE, max_retries=retry)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def async_client(self):
+        """httpx client with a connection pool shared by the coroutines of the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            self._async_clients = {loop: client for loop, client in self._async_clients.items() if not loop.is_closed()}
+            connect_timeout, read_timeout = settings.USD_RATE_FETCH_TIMEOUT
+            client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(retries=2),
+                limits=httpx.Limits(max_connections=settings.USD_RATE_POOL_SIZE),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            self._async_clients[loop] = client
+        return client
+
+    def fetch_snapshot(self):
+        """Downloads the rates of all currencies, returns None if the endpoint is unavailable"""
+        started_at = time.perf_counter()
+        try:
+            response = self.session.get(settings.CBR_DAILY_URL, timeout=settings.USD_RATE_FETCH_TIMEOUT)
+            response.raise_for_status()
+            snapshot = RatesSnapshot.parse(response.text)
+        except (requests.RequestException, ValueError) as error:
+            self._observe_fetch(started_at, failed=True)
+            logger.warning(f'usd rate request failed: {error}')
+            return None
+        self._observe_fetch(started_at, failed=False)
+        return snapshot
+
+    async def afetch_snapshot(self):
+        """fetch_snapshot without blocking the event loop"""
+        started_at = time.perf_counter()
+        try:
+            response = await self.async_client().get(settings.CBR_DAILY_URL)
+            response.raise_for_status()
+            snapshot = RatesSnapshot.parse(response.text)
+        except (httpx.HTTPError, ValueError) as error:
+            self._observe_fetch(started_at, failed=True)
+            logger.warning(f'usd rate request failed: {error}')
+            return None
+        self._observe_fetch(started_at, failed=False)
+        return snapshot
+
+    def fetch(self):
+        """Downloads the rate, returns None if the endpoint is unavailable or has no USD rate"""
+        snapshot = self.fetch_snapshot()
+        return snapshot.usd_rate_in_rub if snapshot is not None else None
+
+    async def afetch(self):
+        """fetch without blocking the event loop"""
+        snapshot = await self.afetch_snapshot()
+        return snapshot.usd_rate_in_rub if snapshot is not None else None
+
+    @staticmethod
+    def _observe_fetch(started_at, failed):
+        metrics.cbr_fetch_duration.observe(time.perf_counter() - started_at, 'failure' if failed else 'success')
+        if failed:
+            metrics.cbr_fetch_failures.inc()
+
+    def store(self, usd_rate_in_rub):
+        fetched_at = time.time()
+        cache.set_many({self.rate_key: usd_rate_in_rub, self.fetched_at_key: fetched_at}, timeout=None)
+        self._local = (usd_rate_in_rub, fetched_at, time.monotonic())
+
+    def cached(self):
+        """Returns (rate, fetched_at) from the process memory or from the shared cache"""
+        if self._local is not None and time.monotonic() - self._local[2] < settings.USD_RATE_LOCAL_TTL:
+            metrics.usd_rate_lookups.inc('local')
+            return self._local[:2]
+        values = cache.get_many([self.rate_key, self.fetched_at_key])
+        usd_rate_in_rub, fetched_at = values.get(self.rate_key), values.get(self.fetched_at_key, 0)
+        metrics.usd_rate_lookups.inc('hit' if usd_rate_in_rub is not None else 'miss')
+        self._local = (usd_rate_in_rub, fetched_at, time.monotonic()) if usd_rate_in_rub is not None else None
+        return usd_rate_in_rub, fetched_at
+
+    async def acached(self):
+        if self._local is not None and time.monotonic() - self._local[2] < settings.USD_RATE_LOCAL_TTL:
+            metrics.usd_rate_lookups.inc('local')
+            return self._local[:2]
+        return await sync_to_async(self.cached)()
+
+    def get_rate(self, refresh):
+        """Serves the known rate at once, refresh is called synchronously only if no rate is known yet"""
+        usd_rate_in_rub, fetched_at = self.cached()
+        if usd_rate_in_rub is None:
+            return refresh()
+        if time.time() - fetched_at > settings.USD_RATE_FRESH_FOR and not self._refreshing.is_set():
+            self._refreshing.set()
+            threading.Thread(target=self._refresh_in_background, args=(refresh,), daemon=True).start()
+        return usd_rate_in_rub
+
+    async def aget_rate(self, refresh):
+        """get_rate for async code, the event loop never waits for the rate endpoint once a rate is known.
+
+        A missing rate is awaited with afetch under the lock of the refresh task, like refresh() in
+        get_rate a caller that finds the lock held gets None. A stale rate is refreshed by the
+        refresh task on a worker.
+        """
+        usd_rate_in_rub, fetched_at = await self.acached()
+        if usd_rate_in_rub is None:
+            return await self._afetch_missing()
+        stale = time.time() - fetched_at > settings.USD_RATE_FRESH_FOR
+        if stale and time.monotonic() - self._refresh_enqueued_at > settings.USD_RATE_LOCAL_TTL:
+            self._refresh_enqueued_at = time.monotonic()
+            await sync_to_async(SingleFlight('update_usd_rate_in_rub').enqueue)(refresh)
+        return usd_rate_in_rub
+
+    async def _afetch_missing(self):
+        flight = SingleFlight('update_usd_rate_in_rub')
+        job_id = str(uuid.uuid4())
+        if not await sync_to_async(flight.acquire)(job_id):
+            logger.info(f'usd rate is already being fetched by {await sync_to_async(flight.running_id)()}')
+            return None
+        try:
+            snapshot = await self.afetch_snapshot()
+            if snapshot is None:
+                return None
+            await sync_to_async(rate_history.save_snapshot)(snapshot)
+            usd_rate_in_rub = snapshot.usd_rate_in_rub
+            if usd_rate_in_rub is not None:
+                await sync_to_async(self.store)(usd_rate_in_rub)
+            return usd_rate_in_rub
+        finally:
+            await sync_to_async(flight.release)(job_id)
+
+    def _refresh_in_background(self, refresh):
+        try:
+            refresh()
+        finally:
+            self._refreshing.clear()
+
+
+usd_rate_provider = UsdRateProvider()
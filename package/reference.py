@@ -0,0 +1,116 @@
+import threading
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from package.db_routing import primary_reads
+from package.models import TypePackage, DeliveryCompany
+
+
+class ReferenceData:
+    """In-process copy of TypePackage and DeliveryCompany.
+
+    Every process keeps the rows in memory together with the version token they were loaded
+    with. The token lives in the shared cache and is replaced on any change, then every
+    process reloads the rows on its next access, so lookups do not query the database.
+    """
+    version_key = 'reference_data_version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0
+        self._type_packages = {}
+        self._delivery_companies = {}
+
+    def _current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def _is_fresh(self):
+        return self._version is not None and time.monotonic() - self._checked_at < settings.REFERENCE_DATA_CHECK_INTERVAL
+
+    def _ensure_loaded(self, force=False):
+        now = time.monotonic()
+        if not force and self._is_fresh():
+            return
+        version = self._current_version()
+        with self._lock:
+            if version != self._version:
+                # a lagging replica would keep old rows under the new version
+                with primary_reads():
+                    self._type_packages = {obj.pk: obj for obj in TypePackage.objects.order_by('pk')}
+                    self._delivery_companies = {obj.pk: obj for obj in DeliveryCompany.objects.order_by('pk')}
+                self._version = version
+            self._checked_at = now
+
+    async def aload(self, force=False):
+        """Loads the rows for async code, the event loop waits for a thread only when a check is due.
+
+        force=True checks the version at once, e.g. when a row is missing from the loaded data.
+        """
+        if force or not self._is_fresh():
+            await sync_to_async(self._ensure_loaded)(force)
+
+    def invalidate(self):
+        """Makes every process reload the reference data"""
+        with self._lock:
+            self._version = None
+        cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+
+    def _get(self, rows, pk, reload):
+        """Row by pk, a miss checks the version at once so a row just created by another process is found.
+
+        reload=False is for async code, which does the forced check with aload(force=True) itself.
+        """
+        self._ensure_loaded()
+        pk = _to_pk(pk)
+        obj = getattr(self, rows).get(pk)
+        if obj is None and pk is not None and reload:
+            self._ensure_loaded(force=True)
+            obj = getattr(self, rows).get(pk)
+        return obj
+
+    async def _aget(self, rows, pk):
+        await self.aload()
+        obj = self._get(rows, pk, reload=False)
+        if obj is None and _to_pk(pk) is not None:
+            await self.aload(force=True)
+            obj = self._get(rows, pk, reload=False)
+        return obj
+
+    def type_packages(self):
+        self._ensure_loaded()
+        return list(self._type_packages.values())
+
+    def get_type_package(self, pk, reload=True):
+        return self._get('_type_packages', pk, reload)
+
+    async def aget_type_package(self, pk):
+        return await self._aget('_type_packages', pk)
+
+    def delivery_companies(self):
+        self._ensure_loaded()
+        return list(self._delivery_companies.values())
+
+    def get_delivery_company(self, pk, reload=True):
+        return self._get('_delivery_companies', pk, reload)
+
+    async def aget_delivery_company(self, pk):
+        return await self._aget('_delivery_companies', pk)
+
+
+def _to_pk(pk):
+    try:
+        return int(pk)
+    except (TypeError, ValueError):
+        return None
+
+
+reference_data = ReferenceData()
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from package.db_routing import primary_reads
+
+
+def _version_key(session_id):
+    return f'package_response_version:{session_id}'
+
+
+def get_session_version(session_id):
+    """Token of the current package data of the session, it is replaced on every change"""
+    key = _version_key(session_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, timeout=settings.PACKAGE_RESPONSE_CACHE_TTL * 2):
+            version = cache.get(key, version)
+    return version
+
+
+async def aget_session_version(session_id):
+    """get_session_version for async views"""
+    key = _version_key(session_id)
+    version = await cache.aget(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not await cache.aadd(key, version, timeout=settings.PACKAGE_RESPONSE_CACHE_TTL * 2):
+            version = await cache.aget(key, version)
+    return version
+
+
+def invalidate_sessions(session_ids):
+    """Makes cached package responses of the sessions unreachable"""
+    versions = {_version_key(session_id): uuid.uuid4().hex for session_id in set(session_ids) if session_id}
+    if versions:
+        cache.set_many(versions, timeout=settings.PACKAGE_RESPONSE_CACHE_TTL * 2)
+
+
+def _etag(data):
+    content = json.dumps(data, sort_keys=True, default=str).encode()
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match', '')
+    return etag in {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')} or if_none_match == '*'
+
+
+def _response_key(request, session_id, version):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'package_response:{session_id}:{version}:{path}'
+
+
+def cached_response(request, session_id, view):
+    """Serves the view from the per-session cache with ETag/If-None-Match support.
+
+    A miss is built from the primary: a lagging replica would cache a stale response under the
+    new version for the whole PACKAGE_RESPONSE_CACHE_TTL.
+    """
+    key = _response_key(request, session_id, get_session_version(session_id))
+    cached = cache.get(key)
+    if cached is None:
+        with primary_reads():
+            response = view()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        cached = (_etag(response.data), response.data)
+        cache.set(key, cached, timeout=settings.PACKAGE_RESPONSE_CACHE_TTL)
+    etag, data = cached
+    if _etag_matches(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(data, headers={'ETag': etag})
+
+
+async def acached_response(request, session_id, view):
+    """cached_response for async views.
+
+    view is a coroutine function returning (status code, data), the result is (status code, data, headers).
+    The cache entries are shared with cached_response, so WSGI and ASGI processes serve the same responses.
+    """
+    key = _response_key(request, session_id, await aget_session_version(session_id))
+    cached = await cache.aget(key)
+    if cached is None:
+        with primary_reads():
+            status_code, data = await view()
+        if status_code != status.HTTP_200_OK:
+            return status_code, data, {}
+        cached = (_etag(data), data)
+        await cache.aset(key, cached, timeout=settings.PACKAGE_RESPONSE_CACHE_TTL)
+    etag, data = cached
+    if _etag_matches(request, etag):
+        return status.HTTP_304_NOT_MODIFIED, None, {'ETag': etag}
+    return status.HTTP_200_OK, data, {'ETag': etag}
@@ -0,0 +1,242 @@
+import functools
+import threading
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from package.models import ArchivedPackage, Package, PackageRollup
+from package.reference import reference_data
+
+
+TOTALS = ('count', 'total_weight', 'total_cost_in_usd', 'priced_count', 'total_delivery_cost')
+ROLLUP_FIELDS = ('type_package_id', 'delivery_company_id', 'weight', 'cost_in_usd', 'delivery_cost')
+
+
+def _decimal(value):
+    if value is None:
+        return Decimal(0)
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+class RollupDelta:
+    """Changes of the rollup totals per (type_package_id, company_id), company_id is 0 for no company"""
+
+    def __init__(self):
+        self.groups = defaultdict(lambda: [0, Decimal(0), Decimal(0), 0, Decimal(0)])
+
+    def __bool__(self):
+        return any(any(values) for values in self.groups.values())
+
+    def add(self, type_package_id, delivery_company_id, weight, cost_in_usd, delivery_cost, sign=1):
+        values = self.groups[(type_package_id, delivery_company_id or 0)]
+        values[0] += sign
+        values[1] += sign * _decimal(weight)
+        values[2] += sign * _decimal(cost_in_usd)
+        if delivery_cost is not None:
+            values[3] += sign
+            values[4] += sign * _decimal(delivery_cost)
+
+    def add_package(self, package, sign=1):
+        self.add(*(getattr(package, field) for field in ROLLUP_FIELDS), sign=sign)
+
+    def add_totals(self, key, totals):
+        values = self.groups[key]
+        for i, value in enumerate(totals):
+            values[i] += value
+
+    def merge(self, other):
+        for key, totals in other.groups.items():
+            self.add_totals(key, totals)
+
+
+def packages_delta(packages, sign=1):
+    delta = RollupDelta()
+    for package in packages:
+        delta.add_package(package, sign)
+    return delta
+
+
+def queryset_totals(queryset, sign=1):
+    """RollupDelta with the totals of the queryset rows, computed by one GROUP BY query"""
+    delta = RollupDelta()
+    rows = queryset.order_by().values('type_package_id', 'delivery_company_id').annotate(
+        count=Count('pk'),
+        total_weight=Sum('weight'),
+        total_cost_in_usd=Sum('cost_in_usd'),
+        priced_count=Count('delivery_cost'),
+        total_delivery_cost=Sum('delivery_cost'),
+    )
+    for row in rows:
+        delta.add_totals(
+            (row['type_package_id'], row['delivery_company_id'] or 0),
+            [sign * row['count'], sign * _decimal(row['total_weight']), sign * _decimal(row['total_cost_in_usd']),
+             sign * row['priced_count'], sign * _decimal(row['total_delivery_cost'])],
+        )
+    return delta
+
+
+def pricing_delta(queryset, delivery_cost_expression):
+    """Delta of setting delivery_cost of the queryset rows to the expression, rows stay in the database"""
+    delta = RollupDelta()
+    rows = queryset.order_by().values('type_package_id', 'delivery_company_id').annotate(
+        count=Count('pk'),
+        priced_count=Count('delivery_cost'),
+        old_delivery_cost=Sum('delivery_cost'),
+        new_delivery_cost=Sum(delivery_cost_expression),
+    )
+    for row in rows:
+        delta.add_totals(
+            (row['type_package_id'], row['delivery_company_id'] or 0),
+            [0, 0, 0, row['count'] - row['priced_count'],
+             _decimal(row['new_delivery_cost']) - _decimal(row['old_delivery_cost'])],
+        )
+    return delta
+
+
+def apply_delta(delta):
+    for (type_package_id, company_id), values in delta.groups.items():
+        if not any(values):
+            continue
+        rollup = PackageRollup.objects.filter(type_package_id=type_package_id, company_id=company_id)
+        increments = {field: F(field) + value for field, value in zip(TOTALS, values)}
+        if rollup.update(**increments) or values[0] <= 0:
+            # a missing row is not created for removed packages, it was deleted with its type
+            continue
+        try:
+            with transaction.atomic():
+                PackageRollup.objects.create(
+                    type_package_id=type_package_id, company_id=company_id, **dict(zip(TOTALS, values))
+                )
+        except IntegrityError:
+            # created by a concurrent transaction
+            rollup.update(**increments)
+
+
+class _PendingDeltas(threading.local):
+    """Deltas of committed transactions of this thread waiting for the last on_commit callback of record()"""
+
+    def __init__(self):
+        self.delta = RollupDelta()
+        self.registered = 0
+
+    def commit(self, delta, number):
+        self.delta.merge(delta)
+        if number == self.registered:
+            delta, self.delta = self.delta, RollupDelta()
+            apply_delta(delta)
+
+
+_pending = _PendingDeltas()
+
+
+def record(delta):
+    """Applies the delta after the current transaction commits, or at once outside a transaction.
+
+    Every call adds an on_commit callback, so a rolled back savepoint drops its deltas. The
+    callbacks only merge their deltas and the last one of the transaction applies them, so
+    deleting many packages updates every rollup row once. If the last callback was dropped,
+    the merged deltas are applied with the next ones of the thread.
+    """
+    if not delta:
+        return
+    if not transaction.get_connection().in_atomic_block:
+        _pending.commit(delta, _pending.registered)
+        return
+    _pending.registered += 1
+    transaction.on_commit(functools.partial(_pending.commit, delta, _pending.registered), robust=True)
+
+
+def move_company_to_unassigned(company_id):
+    """Merges the rollups of a deleted company into the rollups of packages without company.
+
+    Deleting a company sets delivery_company of its packages to NULL without package signals.
+    """
+    with transaction.atomic():
+        rollups = list(PackageRollup.objects.select_for_update().filter(company_id=company_id))
+        delta = RollupDelta()
+        for rollup in rollups:
+            delta.add_totals((rollup.type_package_id, 0), [getattr(rollup, field) for field in TOTALS])
+        PackageRollup.objects.filter(pk__in=[rollup.pk for rollup in rollups]).delete()
+        apply_delta(delta)
+
+
+def scanned_totals():
+    """Totals of a full scan of the live and the archived packages"""
+    totals = queryset_totals(Package.objects.all())
+    totals.merge(queryset_totals(ArchivedPackage.objects.all()))
+    return totals
+
+
+def rebuild():
+    """Replaces the rollups with the totals of a full scan of the packages"""
+    with transaction.atomic():
+        totals = scanned_totals()
+        PackageRollup.objects.all().delete()
+        PackageRollup.objects.bulk_create([
+            PackageRollup(type_package_id=type_package_id, company_id=company_id, **dict(zip(TOTALS, values)))
+            for (type_package_id, company_id), values in totals.groups.items()
+        ])
+
+
+def check():
+    """Differences between the rollups and a full scan as (group, field, rollup value, scanned value)"""
+    scanned = scanned_totals().groups
+    stored = {
+        (rollup.type_package_id, rollup.company_id): [getattr(rollup, field) for field in TOTALS]
+        for rollup in PackageRollup.objects.all()
+    }
+    differences = []
+    for key in sorted(set(scanned) | set(stored)):
+        expected = scanned.get(key, [0] * len(TOTALS))
+        actual = stored.get(key, [0] * len(TOTALS))
+        differences.extend(
+            (key, field, actual_value, expected_value)
+            for field, actual_value, expected_value in zip(TOTALS, actual, expected)
+            if actual_value != expected_value
+        )
+    return differences
+
+
+GROUP_BY = {
+    None: lambda rollup: (rollup.type_package_id, rollup.company_id),
+    'type_package': lambda rollup: (rollup.type_package_id, None),
+    'delivery_company': lambda rollup: (None, rollup.company_id),
+}
+
+
+def delivery_cost_analytics(group_by=None):
+    """Totals per type and company from the rollups, or per type or company only with group_by"""
+    keys = GROUP_BY[group_by]
+    groups = RollupDelta()
+    total = [0, Decimal(0), Decimal(0), 0, Decimal(0)]
+    for rollup in PackageRollup.objects.all():
+        values = [getattr(rollup, field) for field in TOTALS]
+        groups.add_totals(keys(rollup), values)
+        total = [a + b for a, b in zip(total, values)]
+    rows = [_analytics_row(key, values) for key, values in sorted(groups.groups.items(), key=_group_order)
+            if values[0]]
+    return {'groups': rows, 'total': _analytics_row((None, None), total)}
+
+
+def _group_order(item):
+    (type_package_id, company_id), _ = item
+    return (type_package_id or 0, company_id or 0)
+
+
+def _analytics_row(key, values):
+    type_package_id, company_id = key
+    row = dict(zip(TOTALS, values))
+    type_package = reference_data.get_type_package(type_package_id) if type_package_id else None
+    company = reference_data.get_delivery_company(company_id) if company_id else None
+    row.update(
+        type_package=type_package_id,
+        type_package_name=str(type_package) if type_package else None,
+        delivery_company=company_id or None,
+        delivery_company_name=company.name if company else None,
+        average_delivery_cost=(
+            (row['total_delivery_cost'] / row['priced_count']).quantize(Decimal('0.01')) if row['priced_count'] else None
+        ),
+    )
+    return row
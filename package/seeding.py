@@ -0,0 +1,53 @@
+import random
+import uuid
+from decimal import Decimal
+
+from django.utils import timezone
+
+from package import rollups
+from package.models import Package, PackageOwner, TypePackage, DeliveryCompany
+from package.reference import reference_data
+
+
+SEED_NAME_PREFIX = 'seed_'
+
+
+def seed_packages(count, sessions=100, priced_share=0.5, batch_size=5000, seed=0):
+    """Creates count packages spread over owners and types with bulk_create, returns the owner tokens"""
+    randomizer = random.Random(seed)
+    type_package_ids = [
+        TypePackage.objects.get_or_create(name=name)[0].pk for name, _ in TypePackage.CHOICES
+    ]
+    now = timezone.now()
+    owners = [uuid.uuid4().hex for _ in range(sessions)]
+    PackageOwner.objects.bulk_create([PackageOwner(token=owner, last_seen_at=now) for owner in owners])
+
+    for offset in range(0, count, batch_size):
+        packages = []
+        for i in range(offset, min(offset + batch_size, count)):
+            priced = randomizer.random() < priced_share
+            packages.append(Package(
+                name=f'{SEED_NAME_PREFIX}{i}',
+                owner=randomizer.choice(owners),
+                type_package_id=randomizer.choice(type_package_ids),
+                weight=Decimal(randomizer.randint(1, 100_000)).scaleb(-3),
+                cost_in_usd=Decimal(randomizer.randint(1, 1_000_000)).scaleb(-2),
+                delivery_cost=Decimal(randomizer.randint(1, 10_000_000)).scaleb(-2) if priced else None,
+            ))
+        Package.objects.bulk_create(packages)
+        rollups.record(rollups.packages_delta(packages))
+    return owners
+
+
+def seed_delivery_companies(count):
+    """Creates count delivery companies, returns their pks"""
+    prefix = f'{SEED_NAME_PREFIX}{uuid.uuid4().hex[:8]}_'
+    DeliveryCompany.objects.bulk_create([DeliveryCompany(name=f'{prefix}{i}') for i in range(count)])
+    # bulk_create sends no post_save, so the reference data is invalidated here
+    reference_data.invalidate()
+    return list(DeliveryCompany.objects.filter(name__startswith=prefix).values_list('pk', flat=True))
+
+
+def delete_seeded_packages(owners):
+    Package.objects.filter(owner__in=owners, name__startswith=SEED_NAME_PREFIX).delete()
+    PackageOwner.objects.filter(token__in=owners).delete()
@@ -1,12 +1,22 @@
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
 
-from package.models import Package, TypePackage, DeliveryCompany
+from package import rollups
+from package.models import ArchivedPackage, Package, TypePackage, DeliveryCompany
+from package.service import delivery_cost_calculation_batch, usd_rate_version
 
 
 class AddCompanySerializer(serializers.Serializer):
     company_id = serializers.IntegerField()
 
 
+class AssignCompanySerializer(AddCompanySerializer):
+    package_ids = serializers.ListField(
+        child=serializers.UUIDField(), required=False, allow_empty=False, max_length=settings.PACKAGE_ASSIGN_MAX_IDS,
+    )
+
+
 class ListPackageSerializer(serializers.ModelSerializer):
     type_package_name = serializers.CharField()
     delivery_cost = serializers.SerializerMethodField('delivery_cost_info')
@@ -19,10 +29,45 @@ class ListPackageSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'type_package_name', 'weight', 'cost_in_usd', 'delivery_cost', 'delivery_company')
 
 
+class BulkCreatePackageListSerializer(serializers.ListSerializer):
+    def validate_items(self):
+        """Validates items one by one, returns validated data of valid items and errors of every item"""
+        validated_data, errors = [], []
+        for item in self.initial_data:
+            try:
+                validated_data.append(self.child.run_validation(item))
+                errors.append({})
+            except serializers.ValidationError as exc:
+                errors.append(exc.detail)
+        return validated_data, errors
+
+    def create(self, validated_data):
+        """Inserts packages with batched INSERTs in one transaction, prices them if the rate is in the context"""
+        packages = [Package(**attrs) for attrs in validated_data]
+        usd_rate_in_rub = self.context.get('usd_rate_in_rub')
+        if usd_rate_in_rub is not None and packages:
+            delivery_costs = delivery_cost_calculation_batch(
+                [package.weight for package in packages],
+                [package.cost_in_usd for package in packages],
+                usd_rate_in_rub,
+            )
+            rate_version = usd_rate_version(usd_rate_in_rub)
+            for package, delivery_cost in zip(packages, delivery_costs):
+                package.delivery_cost = delivery_cost
+                package.usd_rate_version = rate_version
+        with transaction.atomic():
+            packages = Package.objects.bulk_create(packages, batch_size=settings.PACKAGE_BULK_CREATE_BATCH_SIZE)
+            rollups.record(rollups.packages_delta(packages))
+        return packages
+
+
 class CreatePackageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Package
         fields = '__all__'
+        # set only by pricing, reprice_stale_packages_task trusts it
+        read_only_fields = ('usd_rate_version',)
+        list_serializer_class = BulkCreatePackageListSerializer
 
 
 class RetrievePackageSerializer(serializers.ModelSerializer):
@@ -37,6 +82,17 @@ class RetrievePackageSerializer(serializers.ModelSerializer):
         fields = ('name', 'type_package_name', 'weight', 'cost_in_usd', 'delivery_cost')
 
 
+class ArchivedPackageSerializer(serializers.ModelSerializer):
+    type_package_name = serializers.CharField()
+
+    class Meta:
+        model = ArchivedPackage
+        fields = (
+            'id', 'name', 'type_package_name', 'weight', 'cost_in_usd', 'delivery_cost', 'delivery_company',
+            'created_at', 'archived_at',
+        )
+
+
 class TypePackageSerializer(serializers.ModelSerializer):
     class Meta:
         model = TypePackage
@@ -47,3 +103,27 @@ class DeliveryCompanySerializer(serializers.ModelSerializer):
     class Meta:
         model = DeliveryCompany
         fields = '__all__'
+
+
+class DeliveryCostRollupSerializer(serializers.Serializer):
+    type_package = serializers.IntegerField(allow_null=True)
+    type_package_name = serializers.CharField(allow_null=True)
+    delivery_company = serializers.IntegerField(allow_null=True)
+    delivery_company_name = serializers.CharField(allow_null=True)
+    count = serializers.IntegerField()
+    total_weight = serializers.DecimalField(max_digits=24, decimal_places=3)
+    total_cost_in_usd = serializers.DecimalField(max_digits=30, decimal_places=2)
+    priced_count = serializers.IntegerField()
+    total_delivery_cost = serializers.DecimalField(max_digits=30, decimal_places=2)
+    average_delivery_cost = serializers.DecimalField(max_digits=30, decimal_places=2, allow_null=True)
+
+
+class DeliveryCostAnalyticsSerializer(serializers.Serializer):
+    groups = DeliveryCostRollupSerializer(many=True)
+    total = DeliveryCostRollupSerializer()
+
+
+class CurrencyRateSerializer(serializers.Serializer):
+    char_code = serializers.CharField()
+    effective_at = serializers.DateTimeField()
+    value = serializers.DecimalField(max_digits=18, decimal_places=8)
@@ -1,3 +1,219 @@
+import time
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When, ExpressionWrapper
+from django.db.models.functions import Round
+from django.utils import timezone
+
+from package import rollups
+from package.models import Package
+from package.response_cache import invalidate_sessions
+
+
+PRICING_MODE_PYTHON = 'python'
+PRICING_MODE_SQL = 'sql'
+PRICING_MODES = (PRICING_MODE_PYTHON, PRICING_MODE_SQL)
+
+DELIVERY_COST_QUANT = Decimal('0.01')
+
+# floats scaled to minor units below this bound round to the exact integer
+FLOAT_EXACT_LIMIT = 2 ** 49
+INT64_MAX = np.iinfo(np.int64).max
+
 
 def delivery_cost_calculation(weight, cost_in_usd, usd_rate_in_rub):
     return (float(weight) * 0.5 + float(cost_in_usd) * 0.01) * usd_rate_in_rub
+
+
+def round_delivery_cost(delivery_cost):
+    """Rounds the calculated cost to kopecks half up, the same way as ROUND in the database"""
+    return Decimal(str(delivery_cost)).quantize(DELIVERY_COST_QUANT, rounding=ROUND_HALF_UP)
+
+
+def _to_minor_units(values, exponent):
+    """Column of numbers as integers in 10**-exponent units, exact for any magnitude"""
+    scaled = np.rint(np.fromiter(map(float, values), dtype=np.float64) * 10 ** exponent)
+    if not scaled.size or np.abs(scaled).max() < FLOAT_EXACT_LIMIT:
+        return scaled.astype(np.int64)
+    return np.array(
+        [int(Decimal(str(value)).scaleb(exponent).to_integral_value(rounding=ROUND_HALF_UP)) for value in values],
+        dtype=object,
+    )
+
+
+def delivery_cost_calculation_batch(weights, costs_in_usd, usd_rate_in_rub):
+    """Vectorized delivery_cost_calculation for columns of weights and costs, exact to the kopeck.
+
+    Weights are taken in grams, costs in cents and the rate in kopecks, so the cost in kopecks is
+    (5 * grams + cents) * rate_in_kopecks / 10000 rounded half up, like round_delivery_cost.
+    """
+    base = 5 * _to_minor_units(weights, 3) + _to_minor_units(costs_in_usd, 2)
+    if not base.size:
+        return []
+    rate_in_kopecks = int(_to_minor_units([usd_rate_in_rub], 2)[0])
+
+    if base.dtype != object and np.abs(base).max() > (INT64_MAX - 5000) // max(abs(rate_in_kopecks), 1):
+        base = base.astype(object)
+    numerator = base * rate_in_kopecks
+    kopecks = np.sign(numerator) * ((np.abs(numerator) + 5000) // 10000)
+    return [Decimal(value) * DELIVERY_COST_QUANT for value in kopecks.tolist()]
+
+
+def delivery_cost_expression(usd_rate_in_rub):
+    """SQL expression of delivery_cost_calculation for UPDATE ... SET delivery_cost = ..."""
+    output_field = Package._meta.get_field('delivery_cost')
+    rate = Value(Decimal(str(usd_rate_in_rub)), output_field=models.DecimalField())
+    expression = (F('weight') * Value(Decimal('0.5')) + F('cost_in_usd') * Value(Decimal('0.01'))) * rate
+    return Round(ExpressionWrapper(expression, output_field=output_field), output_field.decimal_places)
+
+
+def iterate_keyset_pages(queryset, batch_size):
+    """Yields pages of the queryset ordered by pk, every page starts after the last pk of the previous one"""
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        page_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        page = list(page_queryset[:batch_size])
+        if not page:
+            return
+        yield page
+        last_pk = page[-1].pk
+
+
+def iterate_keyset_values(queryset, fields, batch_size):
+    """Yields pages of values_list(*fields) rows ordered by pk, fields must start with 'pk'.
+
+    Unlike iterator() this keeps memory flat on MySQL too, where the driver buffers the whole result.
+    """
+    queryset = queryset.order_by('pk').values_list(*fields)
+    last_pk = None
+    while True:
+        page_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        page = list(page_queryset[:batch_size])
+        if not page:
+            return
+        yield page
+        last_pk = page[-1][0]
+
+
+def iterate_keyset_ranges(queryset, batch_size):
+    """Yields (queryset, upper pk) for consecutive pk ranges of at most batch_size rows, rows are not loaded.
+
+    The last range is open and comes with upper pk None.
+    """
+    last_pk = None
+    while True:
+        rest = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        upper_pk = list(rest.order_by('pk').values_list('pk', flat=True)[batch_size - 1:batch_size])
+        if not upper_pk:
+            if rest.exists():
+                yield rest, None
+            return
+        yield rest.filter(pk__lte=upper_pk[0]), upper_pk[0]
+        last_pk = upper_pk[0]
+
+
+def usd_rate_version(usd_rate_in_rub):
+    """Version of the rate stored on priced packages: the rate in kopecks"""
+    return int(_to_minor_units([usd_rate_in_rub], 2)[0])
+
+
+def first_pricing_updated_at(now):
+    """updated_at of a priced row: a first pricing changes the package, a reprice for a new rate does not.
+
+    Every rate change reprices all packages, so a reprice bumping updated_at would keep them from ever
+    getting settled for package.archiving.
+    """
+    return Case(When(delivery_cost__isnull=True, then=Value(now)), default=F('updated_at'))
+
+
+def _price_pages_in_python(queryset, usd_rate_in_rub, batch_size):
+    rate_version = usd_rate_version(usd_rate_in_rub)
+    fields = ('pk', 'owner', 'type_package', 'delivery_company', 'weight', 'cost_in_usd', 'delivery_cost',
+              'updated_at')
+    for page in iterate_keyset_values(queryset, ('pk',), batch_size):
+        with transaction.atomic():
+            # the page is read again under row locks: rows priced by a concurrent run since the keyset
+            # read no longer match the queryset, so their old values are never taken out twice
+            packages = list(
+                queryset.filter(pk__in=[pk for pk, in page]).select_for_update().order_by('pk').only(*fields)
+            )
+            delivery_costs = delivery_cost_calculation_batch(
+                [package.weight for package in packages], [package.cost_in_usd for package in packages],
+                usd_rate_in_rub,
+            )
+            delta = rollups.packages_delta(packages, sign=-1)
+            updated_at = timezone.now()
+            for package, delivery_cost in zip(packages, delivery_costs):
+                if package.delivery_cost is None:
+                    package.updated_at = updated_at
+                package.delivery_cost = delivery_cost
+                package.usd_rate_version = rate_version
+            delta.merge(rollups.packages_delta(packages))
+            updated = Package.objects.bulk_update(packages, ['delivery_cost', 'usd_rate_version', 'updated_at'])
+            rollups.record(delta)
+        invalidate_sessions(package.owner for package in packages)
+        yield updated, page[-1][0]
+
+
+def _price_pages_in_database(queryset, usd_rate_in_rub, batch_size):
+    expression = delivery_cost_expression(usd_rate_in_rub)
+    rate_version = usd_rate_version(usd_rate_in_rub)
+    for page_queryset, upper_pk in iterate_keyset_ranges(queryset, batch_size):
+        with transaction.atomic():
+            # the rows are locked before the delta is read, a concurrent run waits and then skips them
+            locked = list(page_queryset.select_for_update().order_by('pk').values_list('pk', 'owner'))
+            packages = Package.objects.filter(pk__in=[pk for pk, _ in locked])
+            delta = rollups.pricing_delta(packages, expression)
+            # updated_at goes first, MySQL evaluates the assignments left to right
+            updated = packages.update(
+                updated_at=first_pricing_updated_at(timezone.now()),
+                delivery_cost=expression,
+                usd_rate_version=rate_version,
+            )
+            rollups.record(delta)
+        invalidate_sessions(owner for _, owner in locked)
+        yield updated, upper_pk
+
+
+def calculate_delivery_cost_in_batches(queryset, usd_rate_in_rub, batch_size, mode=PRICING_MODE_PYTHON,
+                                       pause=0, on_batch=None, progress=None):
+    """Prices packages page by page, every page is saved in its own short transaction.
+
+    In the python mode rows are loaded and saved with bulk_update, in the sql mode only the pks
+    of a page are read and it is priced by a single UPDATE. Either way the rows of a page are
+    locked before their old values are taken out of the rollups, so overlapping runs do not
+    count a package twice.
+    on_batch is called with the last pk of every committed page (None for the last open range
+    of the sql mode), pause throttles the loop by sleeping between pages, progress is a JobProgress
+    advanced once per page.
+    """
+    if mode not in PRICING_MODES:
+        raise ValueError(f'Unknown pricing mode {mode}')
+    pages = _price_pages_in_database if mode == PRICING_MODE_SQL else _price_pages_in_python
+
+    started_at = time.monotonic()
+    updated = batches = 0
+    for page_updated, last_pk in pages(queryset, usd_rate_in_rub, batch_size):
+        updated += page_updated
+        batches += 1
+        if progress is not None:
+            progress.advance(page_updated)
+        if on_batch is not None:
+            on_batch(last_pk)
+        if pause:
+            time.sleep(pause)
+    seconds = time.monotonic() - started_at
+    return {
+        'updated': updated,
+        'batches': batches,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(updated / seconds, 1) if seconds else 0.0,
+    }
+
+
+def stale_packages(usd_rate_in_rub):
+    """Packages not priced yet or priced with another rate"""
+    return Package.objects.exclude(usd_rate_version=usd_rate_version(usd_rate_in_rub))
@@ -0,0 +1,63 @@
+import functools
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.dispatch import receiver
+
+from package import rollups
+from package.models import Package, TypePackage, DeliveryCompany
+from package.reference import reference_data
+from package.response_cache import invalidate_sessions
+
+
+@receiver(post_save, sender=TypePackage)
+@receiver(post_delete, sender=TypePackage)
+@receiver(post_save, sender=DeliveryCompany)
+@receiver(post_delete, sender=DeliveryCompany)
+def invalidate_reference_data(sender, **kwargs):
+    """Invalidates at once for the current transaction and once more after commit for other processes"""
+    reference_data.invalidate()
+    transaction.on_commit(reference_data.invalidate)
+
+
+@receiver(pre_save, sender=Package)
+def remember_rollup_values(sender, instance, raw=False, **kwargs):
+    """Keeps the stored values of an updated package to take them out of its old rollup"""
+    if raw or instance._state.adding:
+        return
+    instance._rollup_values = (
+        Package.objects.filter(pk=instance.pk).values_list(*rollups.ROLLUP_FIELDS).first()
+    )
+
+
+@receiver(post_save, sender=Package)
+def record_saved_package(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    delta = rollups.RollupDelta()
+    old_values = getattr(instance, '_rollup_values', None)
+    if old_values is not None:
+        delta.add(*old_values, sign=-1)
+        del instance._rollup_values
+    delta.add_package(instance)
+    rollups.record(delta)
+
+
+@receiver(post_delete, sender=Package)
+def record_deleted_package(sender, instance, **kwargs):
+    rollups.record(rollups.packages_delta([instance], sign=-1))
+
+
+@receiver(post_delete, sender=DeliveryCompany)
+def move_company_rollups(sender, instance, **kwargs):
+    # after the pending deltas of the transaction, which may still count packages of the company
+    transaction.on_commit(functools.partial(rollups.move_company_to_unassigned, instance.pk))
+
+
+@receiver(pre_delete, sender=DeliveryCompany)
+def invalidate_company_owners(sender, instance, **kwargs):
+    """The deletion sets the company of the packages to NULL by one UPDATE, their cached responses go after commit"""
+    owners = list(
+        Package.objects.filter(delivery_company=instance).order_by().values_list('owner', flat=True).distinct()
+    )
+    transaction.on_commit(lambda: invalidate_sessions(owners))
@@ -1,40 +1,316 @@
-import json
 import logging
-import jmespath
-import requests
+import time
 
+from celery import chord
+from django.conf import settings
 from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
 
 from config.celery import app
+from package import metrics
+from package.archiving import archive_settled_packages
+from package.db_routing import replica_reads
+from package.locks import SingleFlight, redis_client, single_flight
 from package.models import Package
-from package.service import delivery_cost_calculation
+from package.owners import release_expired_owners
+from package.progress import JobProgress, tracked_job
+from package.rate_history import rate_history, save_snapshot
+from package.rates import usd_rate_provider
+from package.service import (
+    calculate_delivery_cost_in_batches, iterate_keyset_ranges, stale_packages, usd_rate_version,
+)
 
 
 logger = logging.getLogger('main')
 
+PRICE_NEW_PACKAGES_KEY = 'price_new_packages_scheduled_at'
+NEW_PACKAGES_KEY = 'price_new_packages_pks'
+# the sequential and the parallel pricing share one lock, so they never price the same packages at once
+PRICING_FLIGHT = 'calculate_delivery_cost_for_all_packages'
+
 
 @app.task
-def calculate_delivery_cost_for_all_packages_task():
+@single_flight(PRICING_FLIGHT)
+def calculate_delivery_cost_for_all_packages_task(batch_size=None, mode=None):
     usd_rate_in_rub = cache.get('usd_rate_in_rub')
     if usd_rate_in_rub is None:
         usd_rate_in_rub = update_usd_rate_in_rub_task()
     if usd_rate_in_rub is not None:
-        packages = Package.objects.filter(delivery_cost__isnull=True)
-        for package in packages:
-            package.delivery_cost = delivery_cost_calculation(package.weight, package.cost_in_usd, usd_rate_in_rub)
-        return Package.objects.bulk_update(packages, ['delivery_cost'])
+        with tracked_job('calculate_delivery_cost_for_all_packages') as progress:
+            packages = Package.objects.filter(delivery_cost__isnull=True)
+            progress.set_total(packages.count())
+            stats = calculate_delivery_cost_in_batches(
+                packages,
+                usd_rate_in_rub,
+                batch_size or settings.DELIVERY_COST_BATCH_SIZE,
+                mode or settings.DELIVERY_COST_PRICING_MODE,
+                progress=progress,
+            )
+        metrics.observe_pricing('calculate_delivery_cost_for_all_packages', stats)
+        logger.info(f'delivery cost calculated: {stats["updated"]} packages in {stats["batches"]} batches, '
+                    f'{stats["rows_per_sec"]} rows/sec')
+        return stats
     logger.warning('usd rate is None, delivery cost not calculated!')
 
 
 @app.task
-def update_usd_rate_in_rub_task():
-    rates_url = 'https://www.cbr-xml-daily.ru/daily_json.js'
-    response = requests.get(rates_url)
+def calculate_delivery_cost_in_parallel_task(range_size=None, batch_size=None, mode=None, usd_rate_in_rub=None):
+    """Splits unpriced packages into disjoint pk ranges and prices them on all workers as a chord.
+
+    The pricing lock is held until the chord callback or errback releases it, the heartbeat of this
+    worker and every page of the range tasks extend it meanwhile.
+    """
+    if usd_rate_in_rub is None:
+        usd_rate_in_rub = usd_rate_provider.get_rate(refresh=update_usd_rate_in_rub_task)
+    if usd_rate_in_rub is None:
+        logger.warning('usd rate is None, delivery cost not calculated!')
+        return
+    flight = SingleFlight(PRICING_FLIGHT)
+    with tracked_job('calculate_delivery_cost_in_parallel', finish=False) as progress, \
+            flight.hold(progress.job_id, release=False) as acquired:
+        if not acquired:
+            logger.info(f'{PRICING_FLIGHT} is already running, {progress.job_id} skipped')
+            progress.supersede(flight.running_id())
+            return
+        packages = Package.objects.filter(delivery_cost__isnull=True)
+        with replica_reads():
+            # only the range bounds are read here, the last range is open and takes packages the replica misses
+            progress.set_total(packages.count())
+            upper_pks = [
+                str(upper_pk) if upper_pk is not None else None
+                for _, upper_pk in iterate_keyset_ranges(packages, range_size or settings.DELIVERY_COST_RANGE_SIZE)
+            ]
+        lower_pks = [None] + upper_pks[:-1]
+        if not upper_pks:
+            flight.release(progress.job_id)
+            progress.finish()
+            return {'ranges': 0}
+        header = [
+            price_package_range_task.s(lower_pk, upper_pk, usd_rate_in_rub, batch_size, mode, progress.job_id)
+            for lower_pk, upper_pk in zip(lower_pks, upper_pks)
+        ]
+        callback = aggregate_pricing_stats_task.s(time.time(), progress.job_id)
+        chord(header)(callback.on_error(fail_parallel_pricing_task.s(progress.job_id)))
+    logger.info(f'delivery cost calculation split into {len(header)} ranges')
+    return {'ranges': len(header)}
+
+
+@app.task(autoretry_for=(DatabaseError,), retry_backoff=True, max_retries=3)
+def price_package_range_task(lower_pk, upper_pk, usd_rate_in_rub, batch_size=None, mode=None, job_id=None):
+    """Prices unpriced packages with lower_pk < pk <= upper_pk, a retry only repeats this range"""
+    packages = Package.objects.filter(delivery_cost__isnull=True)
+    if lower_pk is not None:
+        packages = packages.filter(pk__gt=lower_pk)
+    if upper_pk is not None:
+        packages = packages.filter(pk__lte=upper_pk)
+    progress = JobProgress(job_id) if job_id is not None else None
+    # every committed page keeps the pricing lock of the job alive
+    on_batch = (lambda last_pk: SingleFlight(PRICING_FLIGHT).extend(job_id)) if job_id is not None else None
+    try:
+        return calculate_delivery_cost_in_batches(
+            packages,
+            usd_rate_in_rub,
+            batch_size or settings.DELIVERY_COST_BATCH_SIZE,
+            mode or settings.DELIVERY_COST_PRICING_MODE,
+            on_batch=on_batch,
+            progress=progress,
+        )
+    except DatabaseError as error:
+        if progress is not None:
+            progress.error(error)
+        raise
+
+
+@app.task
+def aggregate_pricing_stats_task(results, started_at, job_id=None):
+    """Chord callback: totals of all ranges and throughput over the wall time of the whole run"""
+    seconds = time.time() - started_at
+    updated = sum(result['updated'] for result in results)
+    stats = {
+        'ranges': len(results),
+        'updated': updated,
+        'batches': sum(result['batches'] for result in results),
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(updated / seconds, 1) if seconds else 0.0,
+    }
+    metrics.observe_pricing('calculate_delivery_cost_in_parallel', stats)
+    logger.info(f'delivery cost calculated in parallel: {updated} packages in {stats["ranges"]} ranges, '
+                f'{stats["rows_per_sec"]} rows/sec')
+    if job_id is not None:
+        JobProgress(job_id).finish()
+        SingleFlight(PRICING_FLIGHT).release(job_id)
+    return stats
 
-    rates_data = json.loads(response.text)
-    usd_rate_in_rub = jmespath.search('Valute.USD.Value', rates_data)
+
+@app.task
+def fail_parallel_pricing_task(request, exc, traceback, job_id):
+    """Chord errback: a range that failed for good fails the job and releases the pricing lock"""
+    logger.error(f'delivery cost calculation in parallel failed: {exc!r}')
+    JobProgress(job_id).fail(exc)
+    SingleFlight(PRICING_FLIGHT).release(job_id)
+
+
+def _push_new_packages(package_pks):
+    """Adds the pks for the next fast-path run, an RPUSH on Redis"""
+    package_pks = [str(pk) for pk in package_pks]
+    redis = redis_client(NEW_PACKAGES_KEY)
+    if redis is None:
+        # LocMemCache of development and tests, not atomic
+        pending = cache.get(NEW_PACKAGES_KEY, [])
+        cache.set(NEW_PACKAGES_KEY, pending + package_pks, timeout=settings.DELIVERY_COST_COALESCE_TTL)
+        return
+    client, key = redis
+    client.pipeline().rpush(key, *package_pks).expire(key, settings.DELIVERY_COST_COALESCE_TTL).execute()
+
+
+def _take_new_packages():
+    """Pks pushed since the last take, read and removed in one MULTI on Redis"""
+    redis = redis_client(NEW_PACKAGES_KEY)
+    if redis is None:
+        package_pks = cache.get(NEW_PACKAGES_KEY, [])
+        cache.delete(NEW_PACKAGES_KEY)
+        return package_pks
+    client, key = redis
+    package_pks, _ = client.pipeline().lrange(key, 0, -1).delete(key).execute()
+    return [pk.decode() for pk in package_pks]
+
+
+def price_created_packages(package_pks):
+    """Prices new packages right after commit.
+
+    With a cached rate they are priced synchronously, otherwise the pks are pushed for the fast-path
+    task. A burst of creates schedules a single task run, the flag is dropped when the run starts.
+    """
+    usd_rate_in_rub = usd_rate_provider.cached()[0]
+    if settings.DELIVERY_COST_PRICE_ON_CREATE == 'sync' and usd_rate_in_rub is not None:
+        calculate_delivery_cost_in_batches(
+            Package.objects.filter(pk__in=package_pks, delivery_cost__isnull=True),
+            usd_rate_in_rub,
+            settings.DELIVERY_COST_BATCH_SIZE,
+        )
+        return
+    # pushed before the flag is set, so a run that drops the flag takes these pks or a new run is scheduled
+    _push_new_packages(package_pks)
+    if cache.add(PRICE_NEW_PACKAGES_KEY, time.time(), timeout=settings.DELIVERY_COST_COALESCE_TTL):
+        price_new_packages_task.apply_async(countdown=settings.DELIVERY_COST_COALESCE_DELAY)
+
+
+@app.task
+def price_new_packages_task():
+    """Fast path for the packages created since the last run, the beat job sweeps the rest of the backlog"""
+    scheduled_at = cache.get(PRICE_NEW_PACKAGES_KEY)
+    cache.delete(PRICE_NEW_PACKAGES_KEY)
+    package_pks = _take_new_packages()
+    if not package_pks:
+        return
+    usd_rate_in_rub = usd_rate_provider.get_rate(refresh=update_usd_rate_in_rub_task)
+    if usd_rate_in_rub is None:
+        logger.warning('usd rate is None, new packages not priced!')
+        return
+    stats = calculate_delivery_cost_in_batches(
+        Package.objects.filter(pk__in=package_pks, delivery_cost__isnull=True),
+        usd_rate_in_rub,
+        settings.DELIVERY_COST_BATCH_SIZE,
+        settings.DELIVERY_COST_PRICING_MODE,
+    )
+    metrics.observe_pricing('price_new_packages', stats)
+    if scheduled_at is not None:
+        stats['latency_seconds'] = round(time.time() - scheduled_at, 3)
+    logger.info(f'new packages priced: {stats["updated"]} packages, '
+                f'{stats.get("latency_seconds")} seconds after the first create')
+    return stats
+
+
+def _reprice_rate():
+    usd_rate_in_rub = cache.get('usd_rate_in_rub')
+    if usd_rate_in_rub is None:
+        # the rate of the last saved snapshot, repricing does not wait for the rates endpoint
+        usd_rate_in_rub = rate_history.rate_at(timezone.now())
+        usd_rate_in_rub = round(float(usd_rate_in_rub), 2) if usd_rate_in_rub is not None else None
+    return usd_rate_in_rub
+
+
+@app.task
+@single_flight('reprice_stale_packages')
+def reprice_stale_packages_task(batch_size=None, mode=None):
+    """Reprices packages priced with another rate, resumes from the last committed page after a crash.
+
+    A reprice enqueued for a rate stored while this run holds the lock is skipped, so the run
+    repeats itself with the newer rate until the rate stops changing.
+    """
+    usd_rate_in_rub = _reprice_rate()
+    if usd_rate_in_rub is None:
+        logger.warning('usd rate is None, packages not repriced!')
+        return
+
+    with tracked_job('reprice_stale_packages') as progress:
+        total = 0
+        while True:
+            checkpoint_key = f'reprice_checkpoint:{usd_rate_version(usd_rate_in_rub)}'
+            packages = stale_packages(usd_rate_in_rub)
+            checkpoint = cache.get(checkpoint_key)
+            if checkpoint is not None:
+                logger.info(f'repricing resumed after package {checkpoint}')
+                packages = packages.filter(pk__gt=checkpoint)
+
+            def save_checkpoint(last_pk):
+                if last_pk is not None:
+                    cache.set(checkpoint_key, last_pk, timeout=settings.DELIVERY_COST_REPRICE_CHECKPOINT_TTL)
+
+            total += packages.count()
+            progress.set_total(total)
+            stats = calculate_delivery_cost_in_batches(
+                packages,
+                usd_rate_in_rub,
+                batch_size or settings.DELIVERY_COST_BATCH_SIZE,
+                mode or settings.DELIVERY_COST_PRICING_MODE,
+                pause=settings.DELIVERY_COST_REPRICE_PAUSE,
+                on_batch=save_checkpoint,
+                progress=progress,
+            )
+            cache.delete(checkpoint_key)
+            metrics.observe_pricing('reprice_stale_packages', stats)
+            logger.info(f'packages repriced: {stats["updated"]} packages in {stats["batches"]} batches, '
+                        f'{stats["rows_per_sec"]} rows/sec')
+            latest = _reprice_rate()
+            if latest is None or latest == usd_rate_in_rub:
+                return stats
+            logger.info(f'usd rate changed to {latest} during repricing, repricing again')
+            usd_rate_in_rub = latest
+
+
+@app.task
+@single_flight('update_usd_rate_in_rub', skipped=lambda: cache.get('usd_rate_in_rub'))
+def update_usd_rate_in_rub_task():
+    with tracked_job('update_usd_rate_in_rub'):
+        snapshot = usd_rate_provider.fetch_snapshot()
+        if snapshot is not None:
+            save_snapshot(snapshot)
+    usd_rate_in_rub = snapshot.usd_rate_in_rub if snapshot is not None else None
     if usd_rate_in_rub is not None:
-        cache.set('usd_rate_in_rub', round(usd_rate_in_rub, 2))
+        usd_rate_provider.store(usd_rate_in_rub)
         logger.info(f'usd_rate_in_rub was updated {usd_rate_in_rub}')
-        return round(usd_rate_in_rub, 2)
+        # checked on every run, not only on a rate change, so an interrupted or skipped reprice is picked up again
+        if stale_packages(usd_rate_in_rub).filter(delivery_cost__isnull=False).exists():
+            SingleFlight('reprice_stale_packages').enqueue(reprice_stale_packages_task)
+        return usd_rate_in_rub
     logger.warning('usd rate not found!')
+
+
+@app.task
+@single_flight('release_expired_package_owners')
+def release_expired_package_owners_task():
+    """Periodic cleanup of owners of expired sessions, replaces the session cascade"""
+    stats = release_expired_owners()
+    logger.info(f'expired package owners released: {stats["owners"]} owners, {stats["packages"]} packages')
+    return stats
+
+
+@app.task
+@single_flight('archive_settled_packages')
+def archive_settled_packages_task():
+    """Periodic move of settled packages to the archive, keeps the hot table small"""
+    archived = archive_settled_packages()
+    logger.info(f'settled packages archived: {archived}')
+    return archived
@@ -1,11 +1,77 @@
+import csv
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, router, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django.contrib.sessions.models import Session
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore as DatabaseSessionStore
 
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from package.service import (
+    delivery_cost_calculation, delivery_cost_calculation_batch, calculate_delivery_cost_in_batches,
+    iterate_keyset_ranges, iterate_keyset_values, round_delivery_cost, PRICING_MODE_PYTHON, PRICING_MODE_SQL,
+    PRICING_MODES,
+)
+from package.models import ArchivedPackage, CurrencyRate, Package, PackageOwner, TypePackage, DeliveryCompany
+from config.celery import app
+from package.tasks import (
+    calculate_delivery_cost_for_all_packages_task, reprice_stale_packages_task, update_usd_rate_in_rub_task,
+    price_new_packages_task, calculate_delivery_cost_in_parallel_task, price_package_range_task,
+    aggregate_pricing_stats_task, fail_parallel_pricing_task,
+)
+from package.archiving import archive_settled_packages
+from package.serializers import CreatePackageSerializer
+from package.seeding import seed_packages, seed_delivery_companies, delete_seeded_packages
+from package.benchmarks import run_api_benchmarks, run_task_benchmarks, compare_results
+from package.rate_history import latest_snapshot, rate_history
+from package.rates import UsdRateProvider, usd_rate_provider
+from package.reference import reference_data
+from package.locks import SingleFlight
+from package.progress import JobProgress, tracked_job
+from package.db_routing import primary_reads, replica_reads
+from package.owners import OWNER_SESSION_KEY, release_expired_owners, session_for_owner
+from package import metrics, rollups
+
+
+def owner_session(client):
+    """Gives the test client a session of a new package owner, returns the owner token"""
+    owner = uuid.uuid4().hex
+    PackageOwner.objects.create(token=owner, last_seen_at=timezone.now())
+    client.cookies[settings.SESSION_COOKIE_NAME] = session_for_owner(owner).session_key
+    return owner
+
+
+class CacheClearingMixin:
+    """Starts and ends every test with an empty cache, the cache is not rolled back with the test database"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
 
-from package.service import delivery_cost_calculation
-from package.models import Package, TypePackage, DeliveryCompany
+    def tearDown(self):
+        cache.clear()
+        super().tearDown()
 
 
 class PackageTests(APITestCase):
@@ -15,17 +81,16 @@ class PackageTests(APITestCase):
           "weight": "5.000",
           "cost_in_usd": "12.00",
           "delivery_cost": None,
-          "session": None,
+          "owner": None,
           "type_package": 1,
           "delivery_company": None,
         }
 
     def create_package(self):
-        self.client.session.save()
+        owner = owner_session(self.client)
         type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
-        session = Session.objects.get(session_key=self.client.session.session_key)
         self.package_data['type_package'] = type_package
-        self.package_data['session'] = session
+        self.package_data['owner'] = owner
         return Package.objects.create(**self.package_data)
 
     def test_delivery_cost_calculation(self):
@@ -46,6 +111,65 @@ class PackageTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(self.package_data['name'], package.name)
 
+    def test_rate_version_is_not_writable(self):
+        type_package = TypePackage.objects.create(name=TypePackage.ELECTRONIC)
+        serializer = CreatePackageSerializer(data={**self.package_data, 'type_package': type_package.pk,
+                                                   'usd_rate_version': 9000})
+
+        self.assertTrue(serializer.is_valid())
+        self.assertNotIn('usd_rate_version', serializer.validated_data)
+
+    def test_bulk_create_packages(self):
+        type_package = TypePackage.objects.create(name=TypePackage.ELECTRONIC)
+        self.package_data['type_package'] = type_package.pk
+        url = reverse('package-bulk-create')
+        response = self.client.post(url, [self.package_data] * 3, format='json')
+        data = response.json()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(data['created']), 3)
+        self.assertEqual(data['errors'], [])
+        self.assertEqual(
+            Package.objects.filter(owner=self.client.session[OWNER_SESSION_KEY], delivery_cost__isnull=True).count(), 3
+        )
+
+    def test_bulk_create_packages_ndjson(self):
+        type_package = TypePackage.objects.create(name=TypePackage.ELECTRONIC)
+        self.package_data['type_package'] = type_package.pk
+        url = reverse('package-bulk-create')
+        body = '\n'.join(json.dumps(self.package_data) for _ in range(2))
+        response = self.client.post(url, body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Package.objects.count(), 2)
+
+    def test_bulk_create_rejects_invalid_item(self):
+        type_package = TypePackage.objects.create(name=TypePackage.ELECTRONIC)
+        self.package_data['type_package'] = type_package.pk
+        url = reverse('package-bulk-create')
+        response = self.client.post(url, [self.package_data, {'name': 'no_weight'}], format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Package.objects.exists())
+
+    def test_bulk_create_partial_and_priced(self):
+        cache.set('usd_rate_in_rub', 89)
+        type_package = TypePackage.objects.create(name=TypePackage.ELECTRONIC)
+        self.package_data['type_package'] = type_package.pk
+        self.package_data['weight'] = '2.000'
+        self.package_data['cost_in_usd'] = '12.30'
+        url = reverse('package-bulk-create') + '?partial=1&price=1'
+        response = self.client.post(url, [{'name': 'no_weight'}, self.package_data], format='json')
+        data = response.json()
+        cache.clear()
+        usd_rate_provider._local = None
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(data['created']), 1)
+        self.assertEqual(data['errors'][0]['index'], 0)
+        self.assertIn('weight', data['errors'][0]['errors'])
+        self.assertEqual(Package.objects.get().delivery_cost, Decimal('99.95'))
+
     def test_get_package(self):
         package = self.create_package()
         url = reverse('package-list')
@@ -59,6 +183,48 @@ class PackageTests(APITestCase):
         self.assertEqual(package.name, data['results'][-1]['name'])
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def create_packages(self, count):
+        owner = owner_session(self.client)
+        type_packages = [TypePackage.objects.create(name=name) for name, _ in TypePackage.CHOICES]
+        reference_data.type_packages()
+        return Package.objects.bulk_create([
+            Package(
+                name=f'package_{i}',
+                weight='1.000',
+                cost_in_usd='1.00',
+                owner=owner,
+                type_package=type_packages[i % len(type_packages)],
+            )
+            for i in range(count)
+        ])
+
+    def test_get_packages_query_count(self):
+        self.create_packages(15)
+        url = reverse('package-list')
+
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        data = response.json()
+
+        self.assertEqual(data['count'], 15)
+        self.assertEqual(
+            {item['type_package_name'] for item in data['results']}, {'Одежда', 'Электроника', 'Разное'}
+        )
+
+    def test_get_packages_cursor_pagination(self):
+        packages = self.create_packages(15)
+        url = reverse('package-list') + '?pagination=cursor&page_size=10'
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        first_page = response.json()
+        second_page = self.client.get(first_page['next']).json()
+
+        ids = [item['id'] for item in first_page['results'] + second_page['results']]
+        self.assertNotIn('count', first_page)
+        self.assertEqual(ids, sorted(str(package.pk) for package in packages))
+        self.assertIsNone(second_page['next'])
+
     def test_get_detail_package(self):
         package = self.create_package()
         url = reverse('package-detail', kwargs={'pk': str(package.id)})
@@ -80,6 +246,413 @@ class PackageTests(APITestCase):
         self.assertEqual(updated_package.delivery_company.pk, company.pk)
         self.assertEqual(data['message'], f'Компания {company.name} выбрана перевозчиком.')
 
+    def test_add_company_is_one_conditional_update(self):
+        package = self.create_package()
+        first, second = DeliveryCompany.objects.create(name='first'), DeliveryCompany.objects.create(name='second')
+        url = reverse('package-add-company', kwargs={'pk': str(package.id)})
+        self.client.post(url, {'company_id': first.pk}, format='json')
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(url, {'company_id': second.pk}, format='json')
+
+        self.assertEqual(response.json()['message'],
+                         'Компания second не может быть выбрана перевозчиком либо уже выбрана.')
+        statements = [query['sql'].split()[0] for query in captured]
+        self.assertEqual([statement for statement in statements if statement not in ('SAVEPOINT', 'RELEASE')],
+                         ['UPDATE'])
+        self.assertEqual(Package.objects.get().delivery_company_id, first.pk)
+
+    def test_assign_company_in_batches(self):
+        owner = owner_session(self.client)
+        company, other = DeliveryCompany.objects.create(name='first'), DeliveryCompany.objects.create(name='other')
+        type_packages = [TypePackage.objects.create(name=name) for name in (TypePackage.CLOTH, TypePackage.VARIA)]
+        packages = Package.objects.bulk_create([
+            Package(name=f'package_{i}', weight='1.000', cost_in_usd='1.00', owner=owner,
+                    type_package=type_packages[i % 2], delivery_company=other if i == 0 else None)
+            for i in range(7)
+        ])
+        rollups.rebuild()
+        url = reverse('package-assign-company')
+        unknown = str(uuid.uuid4())
+
+        with override_settings(PACKAGE_ASSIGN_BATCH_SIZE=2), self.captureOnCommitCallbacks(execute=True):
+            by_ids = self.client.post(url, {'company_id': company.pk, 'package_ids': [
+                str(package.pk) for package in packages[:3]
+            ] + [unknown]}, format='json').json()
+            by_filter = self.client.post(
+                f'{url}?type_package={type_packages[0].pk}', {'company_id': company.pk}, format='json'
+            ).json()
+
+        self.assertEqual(set(by_ids['assigned']), {str(package.pk) for package in packages[1:3]})
+        self.assertEqual((by_ids['taken'], by_ids['not_found']), ([str(packages[0].pk)], [unknown]))
+        self.assertEqual(len(by_filter['assigned']), 2)
+        self.assertEqual(Package.objects.filter(delivery_company=company).count(), 4)
+        self.assertEqual(rollups.check(), [])
+
+
+class PriceOnCreateTests(CacheClearingMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        usd_rate_provider._local = None
+        type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+        self.package_data = {'name': 'new', 'weight': '2.000', 'cost_in_usd': '12.30', 'type_package': type_package.pk}
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def test_priced_right_after_commit_with_cached_rate(self):
+        usd_rate_provider.store(89)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('package-list'), self.package_data, format='json')
+
+        self.assertEqual(Package.objects.get(pk=response.json()['id']).delivery_cost, Decimal('99.95'))
+
+    @mock.patch('package.tasks.price_new_packages_task.apply_async')
+    def test_burst_of_creates_schedules_one_task(self, apply_async):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                self.client.post(reverse('package-list'), self.package_data, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('package-bulk-create'), [self.package_data] * 2, format='json')
+
+        apply_async.assert_called_once()
+        self.assertEqual(Package.objects.filter(delivery_cost__isnull=True).count(), 5)
+
+    @override_settings(DELIVERY_COST_PRICE_ON_CREATE='async')
+    @mock.patch('package.tasks.price_new_packages_task.apply_async')
+    def test_fast_path_task_prices_new_packages(self, apply_async):
+        usd_rate_provider.store(89)
+        backlog = Package.objects.create(
+            name='backlog', weight='1.000', cost_in_usd='1.00', type_package_id=self.package_data['type_package'],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('package-list'), self.package_data, format='json')
+
+        stats = price_new_packages_task()
+
+        apply_async.assert_called_once()
+        self.assertEqual(stats['updated'], 1)
+        self.assertIn('latency_seconds', stats)
+        self.assertIsNone(cache.get('price_new_packages_scheduled_at'))
+        # the backlog is left to the sweep, which holds the pricing lock
+        self.assertIsNone(Package.objects.get(pk=backlog.pk).delivery_cost)
+        self.assertIsNone(price_new_packages_task())
+
+
+class SingleFlightTests(CacheClearingMixin, APITestCase):
+    def test_only_one_holder(self):
+        flight = SingleFlight('test_job')
+        with flight.hold('first') as first:
+            with flight.hold('second') as second:
+                running_id = flight.running_id()
+
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertEqual(running_id, 'first')
+        self.assertIsNone(flight.running_id())
+
+    @override_settings(SINGLE_FLIGHT_TTL=0.3)
+    def test_heartbeat_extends_lock(self):
+        flight = SingleFlight('test_job')
+        with flight.hold('first'):
+            time.sleep(0.5)
+            running_id = flight.running_id()
+
+        self.assertEqual(running_id, 'first')
+
+    def test_expired_holder_keeps_off_the_next_lock(self):
+        flight = SingleFlight('test_job')
+        flight.acquire('expired')
+        cache.delete(flight.lock_key)
+        flight.acquire('next')
+
+        extended = flight.extend('expired')
+        flight.release('expired')
+
+        self.assertFalse(extended)
+        self.assertEqual(flight.running_id(), 'next')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                           'LOCATION': 'redis://127.0.0.1:6379'}})
+    def test_redis_lock_is_checked_and_changed_by_one_script(self):
+        flight = SingleFlight('test_job')
+        with mock.patch('redis.Redis.eval', return_value=0) as redis_eval:
+            extended = flight.extend('expired')
+            flight.release('expired')
+
+        self.assertFalse(extended)
+        (script, _, key, value, timeout), _ = redis_eval.call_args_list[0]
+        self.assertIn("'pexpire'", script)
+        self.assertEqual((key, value), (caches['default'].make_key(flight.lock_key), pickle.dumps('expired', pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(timeout, settings.SINGLE_FLIGHT_TTL * 1000)
+        self.assertIn("'del'", redis_eval.call_args_list[1].args[0])
+
+    @mock.patch('package.tasks.calculate_delivery_cost_for_all_packages_task.apply_async')
+    def test_endpoint_returns_queued_task(self, apply_async):
+        url = '/calculate_delivery_cost/'
+        first = self.client.get(url).json()
+        second = self.client.get(url).json()
+
+        apply_async.assert_called_once()
+        self.assertEqual(first['job_id'], second['job_id'])
+        self.assertEqual(second['message'], 'Задача пересчета стоимости доставки уже выполняется.')
+
+    @mock.patch('package.tasks.update_usd_rate_in_rub_task.apply_async')
+    def test_endpoint_returns_running_task(self, apply_async):
+        with SingleFlight('update_usd_rate_in_rub').hold('running-task'):
+            data = self.client.get('/update_usd_rate/').json()
+
+        apply_async.assert_not_called()
+        self.assertEqual(data['job_id'], 'running-task')
+
+    def test_task_skips_when_running(self):
+        with SingleFlight('calculate_delivery_cost_for_all_packages').hold('running-task'):
+            result = calculate_delivery_cost_for_all_packages_task()
+
+        self.assertIsNone(result)
+
+    @mock.patch('package.tasks.calculate_delivery_cost_for_all_packages_task.apply_async')
+    def test_skipped_queued_job_is_superseded(self, apply_async):
+        flight = SingleFlight('calculate_delivery_cost_for_all_packages')
+        job_id = self.client.get('/calculate_delivery_cost/').json()['job_id']
+        with flight.hold('running-task'):
+            with mock.patch('package.locks.current_task', mock.Mock(request=mock.Mock(id=job_id))):
+                calculate_delivery_cost_for_all_packages_task()
+            queued_id = flight.queued_id()
+
+        data = JobProgress(job_id).report()
+
+        self.assertIsNone(queued_id)
+        self.assertEqual((data['status'], data['superseded_by']), ('superseded', 'running-task'))
+
+
+class JobProgressTests(CacheClearingMixin, APITestCase):
+    def test_progress_report(self):
+        progress = JobProgress('job', 'reprice')
+        progress.start(total=100)
+        progress.advance(25)
+        progress.advance(25)
+
+        data = self.client.get(reverse('job-status', kwargs={'job_id': 'job'})).json()
+
+        self.assertEqual(data['status'], 'running')
+        self.assertEqual((data['done'], data['total'], data['percent']), (50, 100, 50.0))
+        self.assertGreater(data['rows_per_sec'], 0)
+        self.assertGreaterEqual(data['eta_seconds'], 0)
+
+    def test_failed_job(self):
+        with self.assertRaises(ValueError):
+            with tracked_job('reprice') as progress:
+                raise ValueError('broken')
+
+        data = progress.report()
+
+        self.assertEqual((data['status'], data['errors'], data['last_error']), ('failed', 1, 'broken'))
+
+    def test_unknown_job(self):
+        response = self.client.get(reverse('job-status', kwargs={'job_id': 'unknown'}))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('package.tasks.calculate_delivery_cost_for_all_packages_task.apply_async')
+    def test_endpoint_returns_queued_job(self, apply_async):
+        job_id = self.client.get('/calculate_delivery_cost/').json()['job_id']
+
+        data = self.client.get(reverse('job-status', kwargs={'job_id': job_id})).json()
+
+        self.assertEqual(data['status'], 'queued')
+        self.assertEqual(data['name'], 'calculate_delivery_cost_for_all_packages')
+
+    def test_finished_job_is_not_reported_queued(self):
+        usd_rate_provider.store(89)
+        task_always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            job_id = self.client.get('/calculate_delivery_cost/').json()['job_id']
+        finally:
+            app.conf.task_always_eager = task_always_eager
+            usd_rate_provider._local = None
+
+        data = self.client.get(reverse('job-status', kwargs={'job_id': job_id})).json()
+
+        self.assertEqual(data['status'], 'succeeded')
+        self.assertIsNotNone(data['finished_at'])
+
+    def test_task_reports_progress(self):
+        usd_rate_provider.store(89)
+        seed_packages(5, sessions=1, priced_share=0)
+        with mock.patch('package.progress.JobProgress.for_current_task',
+                        side_effect=lambda name: JobProgress('task', name)):
+            calculate_delivery_cost_for_all_packages_task(batch_size=2)
+        usd_rate_provider._local = None
+
+        data = JobProgress('task').report()
+
+        self.assertEqual((data['status'], data['done'], data['total']), ('succeeded', 5, 5))
+
+
+class PackageResponseCacheTests(CacheClearingMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = owner_session(self.client)
+        self.type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+        self.package = Package.objects.create(
+            name='test_name', weight='2.000', cost_in_usd='12.30', owner=self.owner, type_package=self.type_package,
+        )
+
+    def test_list_is_cached(self):
+        url = reverse('package-list')
+        first = self.client.get(url)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_not_modified(self):
+        url = reverse('package-detail', kwargs={'pk': str(self.package.pk)})
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_create_invalidates_list(self):
+        url = reverse('package-list')
+        etag = self.client.get(url)['ETag']
+        data = {'name': 'new', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': self.type_package.pk}
+        self.client.post(url, data, format='json')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_pricing_batch_invalidates_detail(self):
+        url = reverse('package-detail', kwargs={'pk': str(self.package.pk)})
+        self.assertEqual(self.client.get(url).json()['delivery_cost'], 'Не рассчитано')
+
+        for mode in PRICING_MODES:
+            calculate_delivery_cost_in_batches(Package.objects.all(), 89 if mode == PRICING_MODE_SQL else 90, 10, mode)
+            response = self.client.get(url)
+
+            self.assertEqual(Decimal(str(response.json()['delivery_cost'])), Package.objects.get().delivery_cost)
+
+    def test_add_company_invalidates_list(self):
+        url = reverse('package-list')
+        self.client.get(url)
+        company = DeliveryCompany.objects.create(name='test_company')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('package-add-company', kwargs={'pk': str(self.package.pk)}),
+                {'company_id': company.pk},
+                format='json',
+            )
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.json()['results'][0]['delivery_company'], company.pk)
+
+
+    def test_company_delete_invalidates_list(self):
+        url = reverse('package-list')
+        company = DeliveryCompany.objects.create(name='test_company')
+        Package.objects.filter(pk=self.package.pk).update(delivery_company=company)
+        self.assertEqual(self.client.get(url).json()['results'][0]['delivery_company'], company.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            company.delete()
+        response = self.client.get(url)
+
+        self.assertIsNone(response.json()['results'][0]['delivery_company'])
+
+
+@override_settings(ROOT_URLCONF='config.asgi_urls')
+class AsyncViewsTests(CacheClearingMixin, TestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        super().setUp()
+        owner = owner_session(self.client)
+        self.async_client.cookies = self.client.cookies
+        type_packages = list(TypePackage.objects.all())
+        self.packages = Package.objects.bulk_create([
+            Package(name=f'package_{i}', weight='1.000', cost_in_usd='1.00', owner=owner,
+                    type_package=type_packages[i % len(type_packages)])
+            for i in range(15)
+        ])
+
+    def get(self, url, **extra):
+        """Responses of the async view and of the sync view, each with a cold response cache"""
+        async_response = async_to_sync(self.async_client.get)(url, **extra)
+        cache.clear()
+        with override_settings(ROOT_URLCONF='config.urls'):
+            sync_response = self.client.get(url, **extra)
+        return async_response, sync_response
+
+    def assertSameResponse(self, url):
+        async_response, sync_response = self.get(url)
+
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        self.assertEqual(async_response.json(), sync_response.json())
+        return async_response
+
+    def test_package_list(self):
+        response = self.assertSameResponse('/package/?page=2')
+
+        self.assertEqual(len(response.json()['results']), 5)
+
+    def test_package_list_filter(self):
+        self.assertSameResponse('/package/?type_package=1')
+        self.assertSameResponse('/package/?type_package=100')
+
+    def test_package_list_invalid_page(self):
+        response = self.assertSameResponse('/package/?page=3')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_package_detail(self):
+        self.assertSameResponse(f'/package/{self.packages[0].pk}/')
+
+    def test_package_detail_not_found(self):
+        response = self.assertSameResponse('/package/unknown/')
+        self.assertSameResponse(f'/package/{uuid.uuid4()}/')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_reference_data(self):
+        self.assertSameResponse('/type_package/')
+        self.assertSameResponse('/type_package/1/')
+        self.assertSameResponse('/delivery_company/')
+
+    def test_response_cache_is_shared_with_sync_views(self):
+        etag = self.client.get('/package/', HTTP_IF_NONE_MATCH='')['ETag']
+
+        with self.assertNumQueries(0):
+            response = async_to_sync(self.async_client.get)('/package/', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_extra_actions_are_served_by_sync_router(self):
+        url = reverse('package-bulk-create')
+        data = [{'name': 'new', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': 1}]
+
+        response = async_to_sync(self.async_client.post)(url, data, content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_create_is_served_by_sync_view(self):
+        data = {'name': 'new', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': 1}
+
+        response = async_to_sync(self.async_client.post)('/package/', data, content_type='application/json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Package.objects.count(), 16)
+
 
 class TypePackageTest(APITestCase):
     fixtures = ['subjects.json']
@@ -93,6 +666,14 @@ class TypePackageTest(APITestCase):
         self.assertEqual(len(data['results']), count_types)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_type_packages_are_served_without_queries(self):
+        reference_data.type_packages()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('typepackage-list'))
+
+        self.assertEqual(len(response.json()['results']), 3)
+
     def test_get_type_package_detail(self):
         url = reverse('typepackage-detail', kwargs={'pk': 1})
         response = self.client.get(url)
@@ -129,6 +710,43 @@ class DeliveryCompanyTest(APITestCase):
         self.assertEqual(data['name'], company.name)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_delivery_company_update_invalidates_reference_data(self):
+        company = self.create_company()
+        url = reverse('deliverycompany-detail', kwargs={'pk': company.pk})
+        self.assertEqual(self.client.get(url).json()['name'], self.name)
+
+        self.client.put(url, {'name': 'renamed_company'}, format='json')
+        response = self.client.get(url)
+
+        self.assertEqual(response.json()['name'], 'renamed_company')
+
+    def test_delivery_company_delete_invalidates_reference_data(self):
+        company = self.create_company()
+        url = reverse('deliverycompany-detail', kwargs={'pk': company.pk})
+        self.client.get(url)
+
+        company.delete()
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(REFERENCE_DATA_CHECK_INTERVAL=3600)
+    def test_company_created_by_another_process_is_found(self):
+        self.client.get(reverse('deliverycompany-list'))
+
+        def create_in_another_process(name):
+            # the shared version is replaced, the reference data of this process is not told
+            company, = DeliveryCompany.objects.bulk_create([DeliveryCompany(name=name)])
+            cache.set(reference_data.version_key, uuid.uuid4().hex, timeout=None)
+            return company
+
+        company = create_in_another_process(self.name)
+        response = self.client.get(reverse('deliverycompany-detail', kwargs={'pk': company.pk}))
+        other = create_in_another_process('other_company')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(async_to_sync(reference_data.aget_delivery_company)(other.pk), other)
+
     def test_create_delivery_company(self):
         url = reverse('deliverycompany-list')
         response = self.client.post(url, {'name': 'test_company'}, format='json')
@@ -138,3 +756,1075 @@ class DeliveryCompanyTest(APITestCase):
         self.assertEqual(count_company, 1)
         self.assertEqual(data['name'], 'test_company')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+
+class StubRatesServer:
+    """Local stand-in for the CBR daily rates endpoint"""
+    def __init__(self, usd_rate=90.0, delay=0, status_code=200, date=None):
+        self.usd_rate = usd_rate
+        self.date = date
+        self.delay = delay
+        self.status_code = status_code
+        self.requests = 0
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.delay)
+                payload = {'Valute': {
+                    'USD': {'CharCode': 'USD', 'Nominal': 1, 'Value': stub.usd_rate},
+                    'KZT': {'CharCode': 'KZT', 'Nominal': 100, 'Value': 18.2345},
+                }}
+                if stub.date is not None:
+                    payload['Date'] = stub.date
+                body = json.dumps(payload).encode()
+                self.send_response(stub.status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/daily_json.js'
+
+
+class UsdRateProviderTests(CacheClearingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.provider = UsdRateProvider()
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def test_fetch(self):
+        with StubRatesServer(usd_rate=91.2345) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_in_rub = self.provider.fetch()
+
+        self.assertEqual(usd_rate_in_rub, 91.23)
+
+    @override_settings(USD_RATE_FETCH_TIMEOUT=(0.5, 0.05))
+    def test_fetch_times_out(self):
+        with StubRatesServer(delay=0.2) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_in_rub = self.provider.fetch()
+
+        self.assertIsNone(usd_rate_in_rub)
+
+    def test_fetch_failed(self):
+        with StubRatesServer(status_code=404) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_in_rub = self.provider.fetch()
+
+        self.assertIsNone(usd_rate_in_rub)
+
+    @mock.patch('package.tasks.reprice_stale_packages_task.apply_async')
+    def test_cold_cache_fetches_once(self, reprice):
+        with StubRatesServer(usd_rate=90) as server, override_settings(CBR_DAILY_URL=server.url):
+            first = self.provider.get_rate(refresh=update_usd_rate_in_rub_task)
+            second = self.provider.get_rate(refresh=update_usd_rate_in_rub_task)
+
+        self.assertEqual((first, second), (90, 90))
+        self.assertEqual(server.requests, 1)
+
+    @override_settings(USD_RATE_FRESH_FOR=0)
+    def test_serves_stale_rate_while_refreshing(self):
+        self.provider.store(89)
+        refreshed = threading.Event()
+
+        def refresh():
+            self.provider.store(90)
+            refreshed.set()
+
+        usd_rate_in_rub = self.provider.get_rate(refresh=refresh)
+
+        self.assertEqual(usd_rate_in_rub, 89)
+        self.assertTrue(refreshed.wait(1))
+        self.assertEqual(cache.get('usd_rate_in_rub'), 90)
+
+    def test_only_lock_holder_fetches(self):
+        cache.set('usd_rate_in_rub', 89)
+        with StubRatesServer() as server, override_settings(CBR_DAILY_URL=server.url):
+            with SingleFlight('update_usd_rate_in_rub').hold('running-task') as acquired:
+                usd_rate_in_rub = update_usd_rate_in_rub_task()
+
+        self.assertTrue(acquired)
+        self.assertEqual(usd_rate_in_rub, 89)
+        self.assertEqual(server.requests, 0)
+
+
+class AsyncUsdRateProviderTests(CacheClearingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.provider = UsdRateProvider()
+
+    def test_afetch(self):
+        with StubRatesServer(usd_rate=91.2345) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_in_rub = async_to_sync(self.provider.afetch)()
+
+        self.assertEqual(usd_rate_in_rub, 91.23)
+
+    def test_afetch_failed(self):
+        with StubRatesServer(status_code=404) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_in_rub = async_to_sync(self.provider.afetch)()
+
+        self.assertIsNone(usd_rate_in_rub)
+
+    def test_cold_cache_fetches_once(self):
+        async def get_rates():
+            return [await self.provider.aget_rate(refresh=update_usd_rate_in_rub_task) for _ in range(2)]
+
+        with StubRatesServer(usd_rate=90) as server, override_settings(CBR_DAILY_URL=server.url):
+            rates = async_to_sync(get_rates)()
+
+        self.assertEqual(rates, [90, 90])
+        self.assertEqual(server.requests, 1)
+
+    def test_cold_cache_skips_fetch_while_refresh_runs(self):
+        with StubRatesServer(usd_rate=90) as server, override_settings(CBR_DAILY_URL=server.url), \
+                SingleFlight('update_usd_rate_in_rub').hold('running-task'):
+            usd_rate_in_rub = async_to_sync(self.provider.aget_rate)(refresh=update_usd_rate_in_rub_task)
+
+        self.assertIsNone(usd_rate_in_rub)
+        self.assertEqual(server.requests, 0)
+
+    @override_settings(USD_RATE_FRESH_FOR=0)
+    @mock.patch('package.tasks.update_usd_rate_in_rub_task.apply_async')
+    def test_stale_rate_is_refreshed_by_task(self, apply_async):
+        self.provider.store(89)
+
+        usd_rate_in_rub = async_to_sync(self.provider.aget_rate)(refresh=update_usd_rate_in_rub_task)
+        async_to_sync(self.provider.aget_rate)(refresh=update_usd_rate_in_rub_task)
+
+        self.assertEqual(usd_rate_in_rub, 89)
+        apply_async.assert_called_once()
+
+
+class DeliveryCostCalculationBatchTests(TestCase):
+    def test_matches_exact_decimal_calculation(self):
+        weights = ['0.001', '1.250', '2.000', '7.777', '15.005', '999.999', '0.333', '0.010']
+        costs_in_usd = ['0.01', '99.99', '12.30', '1234.56', '0.50', '100000.00', '3.33', '0.05']
+        usd_rate_in_rub = 89.13
+
+        delivery_costs = delivery_cost_calculation_batch(weights, costs_in_usd, usd_rate_in_rub)
+
+        for weight, cost_in_usd, delivery_cost in zip(weights, costs_in_usd, delivery_costs):
+            exact = (Decimal(weight) * Decimal('0.5') + Decimal(cost_in_usd) * Decimal('0.01')) * Decimal('89.13')
+            self.assertEqual(delivery_cost, round_delivery_cost(exact))
+
+    def test_matches_per_row_calculation(self):
+        delivery_costs = delivery_cost_calculation_batch([2], [12.3], 89)
+
+        self.assertEqual(delivery_costs, [round_delivery_cost(delivery_cost_calculation(2, 12.3, 89))])
+
+    def test_rounds_half_up(self):
+        self.assertEqual(delivery_cost_calculation_batch(['0.001'], ['0.00'], 10), [Decimal('0.01')])
+
+    def test_does_not_overflow_int64(self):
+        cost_in_usd = Decimal('999999999999999999.99')
+
+        delivery_costs = delivery_cost_calculation_batch(['1.000'], [cost_in_usd], 100)
+
+        self.assertEqual(delivery_costs, [round_delivery_cost((Decimal('0.5') + cost_in_usd / 100) * 100)])
+
+    def test_empty_batch(self):
+        self.assertEqual(delivery_cost_calculation_batch([], [], 89), [])
+
+
+class DeliveryCostBatchTests(TestCase):
+    def setUp(self):
+        self.type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+        for i in range(5):
+            Package.objects.create(
+                name=f'package_{i}',
+                weight='2.000',
+                cost_in_usd='12.30',
+                type_package=self.type_package,
+            )
+
+    def test_calculate_delivery_cost_in_batches(self):
+        stats = calculate_delivery_cost_in_batches(Package.objects.filter(delivery_cost__isnull=True), 89, 2)
+
+        self.assertEqual(stats['updated'], 5)
+        self.assertEqual(stats['batches'], 3)
+        self.assertFalse(Package.objects.filter(delivery_cost__isnull=True).exists())
+        self.assertEqual(Package.objects.first().delivery_cost, Decimal('99.95'))
+
+    def test_batches_skip_priced_packages(self):
+        Package.objects.filter(name='package_0').update(delivery_cost=1)
+        stats = calculate_delivery_cost_in_batches(Package.objects.filter(delivery_cost__isnull=True), 89, 10)
+
+        self.assertEqual(stats['updated'], 4)
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(Package.objects.get(name='package_0').delivery_cost, Decimal('1.00'))
+
+    def test_calculate_delivery_cost_in_batches_sql(self):
+        stats = calculate_delivery_cost_in_batches(
+            Package.objects.filter(delivery_cost__isnull=True), 89, 2, mode=PRICING_MODE_SQL
+        )
+
+        self.assertEqual(stats['updated'], 5)
+        self.assertEqual(stats['batches'], 3)
+        self.assertFalse(Package.objects.filter(delivery_cost__isnull=True).exists())
+
+    def test_sql_pricing_matches_python_calculation(self):
+        samples = [
+            ('0.001', '0.01'), ('1.250', '99.99'), ('2.000', '12.30'), ('7.777', '1234.56'),
+            ('15.005', '0.50'), ('999.999', '100000.00'), ('0.333', '3.33'),
+        ]
+        for weight, cost_in_usd in samples:
+            Package.objects.create(name=weight, weight=weight, cost_in_usd=cost_in_usd, type_package=self.type_package)
+        usd_rate_in_rub = 89.13
+
+        calculate_delivery_cost_in_batches(
+            Package.objects.filter(delivery_cost__isnull=True), usd_rate_in_rub, 3, mode=PRICING_MODE_SQL
+        )
+
+        for package in Package.objects.all():
+            expected = round_delivery_cost(
+                delivery_cost_calculation(package.weight, package.cost_in_usd, usd_rate_in_rub)
+            )
+            self.assertEqual(package.delivery_cost, expected, package.name)
+
+
+@override_settings(DELIVERY_COST_REPRICE_PAUSE=0)
+class CurrencyRateHistoryTests(CacheClearingMixin, APITestCase):
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def fetch(self, usd_rate, date):
+        with StubRatesServer(usd_rate=usd_rate, date=date) as server, override_settings(CBR_DAILY_URL=server.url), \
+                mock.patch('package.tasks.reprice_stale_packages_task.apply_async'):
+            return update_usd_rate_in_rub_task()
+
+    def test_snapshot_of_all_currencies_is_saved(self):
+        with CaptureQueriesContext(connection) as queries:
+            usd_rate_in_rub = self.fetch(89.5, '2024-05-01T11:30:00+03:00')
+        self.fetch(89.5, '2024-05-01T11:30:00+03:00')
+
+        self.assertEqual(usd_rate_in_rub, 89.5)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(
+            set(CurrencyRate.objects.values_list('char_code', 'value')),
+            {('USD', Decimal('89.5')), ('KZT', Decimal('0.182345'))},
+        )
+        snapshot = latest_snapshot()
+        self.assertEqual(snapshot.effective_at, datetime(2024, 5, 1, 8, 30, tzinfo=dt_timezone.utc))
+        self.assertEqual(snapshot.rates['KZT'], Decimal('0.182345'))
+
+    def test_point_in_time_lookup(self):
+        self.fetch(89, '2024-05-01T11:30:00+03:00')
+        self.fetch(90, '2024-05-03T11:30:00+03:00')
+
+        with self.assertNumQueries(1):
+            rates = rate_history.rates_at([
+                datetime(2024, 4, 30, tzinfo=dt_timezone.utc),
+                datetime(2024, 5, 1, 8, 30, tzinfo=dt_timezone.utc),
+                datetime(2024, 5, 2, tzinfo=dt_timezone.utc),
+                datetime(2024, 6, 1, tzinfo=dt_timezone.utc),
+            ])
+            rate_history.rate_at(datetime(2024, 5, 2, tzinfo=dt_timezone.utc))
+
+        self.assertEqual(rates, [None, Decimal(89), Decimal(89), Decimal(90)])
+
+        response = self.client.get(reverse('currency-rate'), {'char_code': 'kzt', 'at': '2024-05-02T00:00:00Z'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['effective_at'], '2024-05-01T08:30:00Z')
+        self.assertEqual(response.data['value'], '0.18234500')
+        response = self.client.get(reverse('currency-rate'), {'at': '2024-04-30'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('currency-rate'), {'at': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reprice_falls_back_to_saved_rate(self):
+        self.fetch(90, '2024-05-01T11:30:00+03:00')
+        cache.delete('usd_rate_in_rub')
+        type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+        Package.objects.create(name='package', weight='2.000', cost_in_usd='12.30', type_package=type_package)
+
+        stats = reprice_stale_packages_task()
+
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(Package.objects.get().usd_rate_version, 9000)
+
+
+class RepriceStalePackagesTests(CacheClearingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+        for i in range(5):
+            Package.objects.create(
+                name=f'package_{i}',
+                weight='2.000',
+                cost_in_usd='12.30',
+                type_package=type_package,
+            )
+        calculate_delivery_cost_in_batches(Package.objects.all(), 89, 10)
+
+    def test_reprice_stale_packages(self):
+        Package.objects.filter(name='package_0').update(delivery_cost=None, usd_rate_version=None)
+        cache.set('usd_rate_in_rub', 90)
+
+        stats = reprice_stale_packages_task(batch_size=2)
+
+        self.assertEqual(stats['updated'], 5)
+        self.assertEqual(set(Package.objects.values_list('usd_rate_version', flat=True)), {9000})
+        self.assertEqual(set(Package.objects.values_list('delivery_cost', flat=True)), {Decimal('101.07')})
+
+    def test_reprice_skips_packages_priced_with_current_rate(self):
+        cache.set('usd_rate_in_rub', 89)
+
+        stats = reprice_stale_packages_task()
+
+        self.assertEqual(stats['updated'], 0)
+
+    def test_rate_changed_during_repricing(self):
+        cache.set('usd_rate_in_rub', 90)
+        calculate = calculate_delivery_cost_in_batches
+
+        def store_newer_rate(*args, **kwargs):
+            stats = calculate(*args, **kwargs)
+            cache.set('usd_rate_in_rub', 91)
+            return stats
+
+        with mock.patch('package.tasks.calculate_delivery_cost_in_batches', side_effect=store_newer_rate):
+            reprice_stale_packages_task()
+
+        self.assertEqual(set(Package.objects.values_list('usd_rate_version', flat=True)), {9100})
+
+    def test_reprice_resumes_from_checkpoint(self):
+        first_pk = Package.objects.order_by('pk').values_list('pk', flat=True).first()
+        cache.set('usd_rate_in_rub', 90)
+        cache.set('reprice_checkpoint:9000', first_pk)
+
+        stats = reprice_stale_packages_task(batch_size=2)
+
+        self.assertEqual(stats['updated'], 4)
+        self.assertEqual(Package.objects.get(pk=first_pk).usd_rate_version, 8900)
+        self.assertIsNone(cache.get('reprice_checkpoint:9000'))
+
+    def test_rate_change_starts_repricing(self):
+        with StubRatesServer(usd_rate=90.001) as server, override_settings(CBR_DAILY_URL=server.url), \
+                mock.patch('package.tasks.reprice_stale_packages_task.apply_async') as reprice:
+            update_usd_rate_in_rub_task()
+            update_usd_rate_in_rub_task()
+
+        self.assertEqual(cache.get('usd_rate_in_rub'), 90.0)
+        reprice.assert_called_once()
+
+    def test_unfinished_repricing_is_started_again(self):
+        cache.set('usd_rate_in_rub', 89)
+        with StubRatesServer(usd_rate=89) as server, override_settings(CBR_DAILY_URL=server.url), \
+                mock.patch('package.tasks.reprice_stale_packages_task.apply_async') as reprice:
+            update_usd_rate_in_rub_task()
+            Package.objects.filter(name='package_0').update(usd_rate_version=8800)
+            update_usd_rate_in_rub_task()
+
+        reprice.assert_called_once()
+
+
+class ParallelPricingTests(CacheClearingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        usd_rate_provider.store(89)
+        seed_packages(25, sessions=3, priced_share=0)
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def test_ranges_price_all_packages(self):
+        task_always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            stats = calculate_delivery_cost_in_parallel_task(range_size=10, batch_size=4)
+        finally:
+            app.conf.task_always_eager = task_always_eager
+
+        self.assertEqual(stats, {'ranges': 3})
+        self.assertFalse(Package.objects.filter(delivery_cost__isnull=True).exists())
+        self.assertIsNone(SingleFlight('calculate_delivery_cost_for_all_packages').running_id())
+
+    def test_given_rate_is_not_stored(self):
+        cache.clear()
+        usd_rate_provider._local = None
+        task_always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            stats = calculate_delivery_cost_in_parallel_task(range_size=10, usd_rate_in_rub=90)
+        finally:
+            app.conf.task_always_eager = task_always_eager
+
+        self.assertEqual(stats, {'ranges': 3})
+        self.assertFalse(Package.objects.filter(delivery_cost__isnull=True).exists())
+        self.assertIsNone(cache.get('usd_rate_in_rub'))
+
+    @override_settings(SINGLE_FLIGHT_TTL=0.3)
+    def test_lock_is_held_until_callback(self):
+        flight = SingleFlight('calculate_delivery_cost_for_all_packages')
+        with mock.patch('package.tasks.chord') as dispatch, \
+                mock.patch('package.progress.JobProgress.for_current_task',
+                           side_effect=lambda name: JobProgress('parallel', name)):
+            calculate_delivery_cost_in_parallel_task(range_size=10)
+        # no range task has committed a page for longer than the TTL
+        time.sleep(0.5)
+        running_id = flight.running_id()
+        skipped = calculate_delivery_cost_for_all_packages_task()
+
+        aggregate_pricing_stats_task([{'updated': 25, 'batches': 3}], time.time() - 1, 'parallel')
+
+        dispatch.assert_called_once()
+        self.assertEqual(running_id, 'parallel')
+        self.assertIsNone(skipped)
+        self.assertTrue(Package.objects.filter(delivery_cost__isnull=True).exists())
+        self.assertIsNone(flight.running_id())
+        self.assertEqual(JobProgress('parallel').report()['status'], 'succeeded')
+        time.sleep(0.2)
+        self.assertIsNone(flight.running_id())
+
+    def test_failed_range_fails_job(self):
+        flight = SingleFlight('calculate_delivery_cost_for_all_packages')
+        JobProgress('parallel', 'calculate_delivery_cost_in_parallel').start()
+        with flight.hold('parallel', release=False):
+            pass
+
+        fail_parallel_pricing_task(None, ValueError('broken'), None, 'parallel')
+
+        data = JobProgress('parallel').report()
+        self.assertEqual((data['status'], data['last_error']), ('failed', 'broken'))
+        self.assertIsNone(flight.running_id())
+
+    def test_aggregate_pricing_stats(self):
+        results = [{'updated': 10, 'batches': 3}, {'updated': 5, 'batches': 2}]
+
+        stats = aggregate_pricing_stats_task(results, time.time() - 1)
+
+        self.assertEqual((stats['ranges'], stats['updated'], stats['batches']), (2, 15, 5))
+        self.assertLessEqual(stats['rows_per_sec'], 15)
+
+    def test_range_task_prices_only_its_range(self):
+        pks = list(Package.objects.order_by('pk').values_list('pk', flat=True))
+
+        stats = price_package_range_task(str(pks[4]), str(pks[9]), 89)
+
+        self.assertEqual(stats['updated'], 5)
+        self.assertEqual(
+            list(Package.objects.filter(delivery_cost__isnull=False).order_by('pk').values_list('pk', flat=True)),
+            pks[5:10],
+        )
+
+
+class PackageOwnerTests(CacheClearingMixin, APITestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        super().setUp()
+        self.package_data = {'name': 'test_name', 'weight': '1.500', 'cost_in_usd': '10.00', 'type_package': 1}
+
+    def test_anonymous_read_writes_nothing(self):
+        Package.objects.create(name='orphan', weight='1.000', cost_in_usd='1.00', type_package_id=1)
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse('package-list'))
+
+        self.assertEqual(response.json()['results'], [])
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        self.assertFalse([query for query in captured if not query['sql'].startswith('SELECT')])
+
+    def test_first_write_issues_owner(self):
+        url = reverse('package-list')
+        self.client.post(url, self.package_data, format='json')
+        owner = self.client.session[OWNER_SESSION_KEY]
+        seen_at = PackageOwner.objects.get(token=owner).last_seen_at
+
+        self.client.post(url, self.package_data, format='json')
+
+        self.assertEqual(Package.objects.filter(owner=owner).count(), 2)
+        self.assertEqual(PackageOwner.objects.get(token=owner).last_seen_at, seen_at)
+        self.assertEqual(self.client.get(url).json()['count'], 2)
+
+    def test_expired_session_gets_new_owner(self):
+        owner = owner_session(self.client)
+        with mock.patch('package.owners.time.time', return_value=time.time() + settings.SESSION_COOKIE_AGE + 1):
+            self.assertEqual(self.client.get(reverse('package-list')).json()['results'], [])
+            self.client.post(reverse('package-list'), self.package_data, format='json')
+
+        self.assertNotEqual(Package.objects.get().owner, owner)
+
+    def test_legacy_database_session_keeps_its_packages(self):
+        session = DatabaseSessionStore()
+        session.create()
+        PackageOwner.objects.create(token=session.session_key, last_seen_at=timezone.now() - timedelta(hours=1))
+        Package.objects.create(name='legacy', weight='1.000', cost_in_usd='1.00', type_package_id=1,
+                               owner=session.session_key)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        url = reverse('package-list')
+
+        first = self.client.get(url).json()
+        with CaptureQueriesContext(connection) as captured:
+            second = self.client.get(url).json()
+
+        self.assertEqual((first['count'], second['count']), (1, 1))
+        self.assertEqual(self.client.session[OWNER_SESSION_KEY], session.session_key)
+        self.assertFalse([query for query in captured if 'django_session' in query['sql']])
+
+    def test_release_expired_owners(self):
+        live, expired = seed_packages(10, sessions=2, priced_share=0)
+        PackageOwner.objects.filter(token=expired).update(
+            last_seen_at=timezone.now() - timedelta(seconds=settings.SESSION_COOKIE_AGE + 1)
+        )
+        expired_count = Package.objects.filter(owner=expired).count()
+
+        stats = release_expired_owners(owner_batch_size=1, batch_size=2)
+
+        self.assertEqual(stats, {'owners': 1, 'packages': expired_count})
+        self.assertEqual(list(PackageOwner.objects.values_list('token', flat=True)), [live])
+        self.assertEqual(Package.objects.filter(owner__isnull=True).count(), expired_count)
+        self.assertEqual(Package.objects.count(), 10)
+
+
+class SeedPackagesTests(TestCase):
+    def test_seed_and_delete_packages(self):
+        owners = seed_packages(25, sessions=3, batch_size=10)
+
+        self.assertEqual(Package.objects.filter(owner__in=owners).count(), 25)
+        self.assertEqual(PackageOwner.objects.filter(token__in=owners).count(), 3)
+
+        delete_seeded_packages(owners)
+
+        self.assertFalse(Package.objects.exists())
+
+
+class ImportPackagesTests(CacheClearingMixin, TestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        super().setUp()
+        self.owner = owner_session(self.client)
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def import_file(self, content, suffix, *args):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as infile:
+            infile.write(content)
+        self.addCleanup(os.unlink, infile.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_packages', infile.name, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_csv(self):
+        content = 'name,weight,cost_in_usd,type_package,owner\n' + ''.join(
+            f'package_{i},1.5,10.00,{i % 3 + 1},{self.owner}\n' for i in range(7)
+        )
+
+        stdout, _ = self.import_file(content, '.csv', '--batch-size', '3')
+
+        self.assertIn('7 packages imported', stdout)
+        self.assertEqual(Package.objects.filter(owner=self.owner).count(), 7)
+        self.assertFalse(Package.objects.filter(delivery_cost__isnull=False).exists())
+
+    def test_import_ndjson_reports_invalid_rows(self):
+        rows = [
+            {'name': 'valid', 'weight': 2, 'cost_in_usd': 12.3, 'type_package': 1},
+            {'name': 'bad weight', 'weight': '1.23456', 'cost_in_usd': '1.00', 'type_package': 1},
+            {'name': 'bad type', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': 100},
+            {'name': 'bad owner', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': 1, 'owner': 'x'},
+        ]
+        content = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+
+        stdout, stderr = self.import_file(content, '.ndjson')
+
+        self.assertIn('1 packages imported, 4 invalid rows skipped', stdout)
+        self.assertEqual(
+            [line.split(':')[0] for line in stderr.splitlines()], ['line 2', 'line 3', 'line 4', 'line 5']
+        )
+        self.assertEqual(Package.objects.get().cost_in_usd, Decimal('12.30'))
+
+    def test_import_with_pricing(self):
+        usd_rate_provider.store(89)
+        content = 'name,weight,cost_in_usd,type_package,delivery_cost\na,2,12.3,1,\nb,2,12.3,1,5.00\n'
+
+        self.import_file(content, '.csv', '--price')
+
+        self.assertEqual(
+            dict(Package.objects.values_list('name', 'delivery_cost')), {'a': Decimal('99.95'), 'b': Decimal('5.00')}
+        )
+
+    def test_reimported_export_creates_copies(self):
+        Package.objects.create(name='exported', weight='2.000', cost_in_usd='12.30', type_package_id=1,
+                               delivery_cost='99.95', usd_rate_version=8900)
+        export = io.StringIO()
+        call_command('export_packages', stdout=export, stderr=io.StringIO())
+
+        self.import_file(export.getvalue(), '.csv')
+
+        copies = Package.objects.filter(name='exported')
+        self.assertEqual(copies.count(), 2)
+        self.assertEqual(set(copies.values_list('usd_rate_version', flat=True)), {8900, None})
+
+    def test_load_data_needs_mysql(self):
+        with self.assertRaises(CommandError):
+            self.import_file('name\n', '.csv', '--load-data')
+
+
+class ExportPackagesTests(APITestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        self.packages = Package.objects.bulk_create([
+            Package(name=f'package, "{i}"', weight='1.500', cost_in_usd='10.00', type_package_id=i % 2 + 1,
+                    delivery_cost='7.50' if i % 3 else None)
+            for i in range(10)
+        ])
+        staff = User.objects.create_user('finance', password='password', is_staff=True)
+        self.client.force_authenticate(staff)
+
+    @override_settings(PACKAGE_EXPORT_CHUNK_SIZE=3)
+    def test_export_csv(self):
+        response = self.client.get(reverse('export-packages', kwargs={'file_format': 'csv'}))
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual([row['id'] for row in rows], sorted(str(package.pk) for package in self.packages))
+        self.assertEqual({row['name'] for row in rows}, {package.name for package in self.packages})
+        self.assertEqual({row['delivery_cost'] for row in rows}, {'', '7.50'})
+
+    def test_export_ndjson_filtered(self):
+        url = reverse('export-packages', kwargs={'file_format': 'ndjson'})
+        response = self.client.get(url, {'type_package': 1, 'priced': 'true'})
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+        expected = Package.objects.filter(type_package_id=1, delivery_cost__isnull=False)
+        self.assertEqual(len(rows), expected.count())
+        self.assertTrue(all(row['delivery_cost'] == '7.50' and row['type_package'] == 1 for row in rows))
+
+    def test_export_needs_staff(self):
+        self.client.force_authenticate(None)
+
+        response = self.client.get(reverse('export-packages', kwargs={'file_format': 'csv'}))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_export_command_round_trips_through_import(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as outfile:
+            self.addCleanup(os.unlink, outfile.name)
+        call_command('export_packages', '--output', outfile.name, '--priced', 'false', stderr=io.StringIO())
+        Package.objects.all().delete()
+
+        call_command('import_packages', outfile.name, stdout=io.StringIO())
+
+        self.assertEqual(Package.objects.count(), 4)
+        self.assertEqual(set(Package.objects.values_list('name', flat=True)),
+                         {f'package, "{i}"' for i in range(0, 10, 3)})
+
+
+class DeliveryCostRollupTests(APITestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        self.company = DeliveryCompany.objects.create(name='rollup_company')
+        staff = User.objects.create_user('analyst', password='password', is_staff=True)
+        self.client.force_authenticate(staff)
+
+    def create_packages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Package.objects.bulk_create([
+                Package(name=f'package_{i}', weight='1.500', cost_in_usd='10.00', type_package_id=i % 2 + 1)
+                for i in range(6)
+            ])
+            rollups.rebuild()
+            package = Package.objects.create(name='single', weight='2.000', cost_in_usd='5.00', type_package_id=3)
+        return package
+
+    def test_rollups_follow_package_changes(self):
+        package = self.create_packages()
+        for mode in PRICING_MODES:
+            with self.captureOnCommitCallbacks(execute=True):
+                calculate_delivery_cost_in_batches(Package.objects.all(), 89 + len(mode), 4, mode=mode)
+            self.assertEqual(rollups.check(), [], mode)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('package-add-company', kwargs={'pk': str(package.pk)}),
+                             {'company_id': self.company.pk}, format='json')
+            package.refresh_from_db()
+            package.weight = Decimal('3.000')
+            package.save()
+            Package.objects.filter(type_package_id=1).delete()
+
+        self.assertEqual(rollups.check(), [])
+        self.assertEqual(rollups.packages_delta([]).groups, {})
+
+    def test_rolled_back_savepoint_drops_its_deltas(self):
+        self.create_packages()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                Package.objects.create(name='rolled_back', weight='1.000', cost_in_usd='1.00', type_package_id=1)
+                raise ValueError
+            Package.objects.create(name='kept', weight='1.000', cost_in_usd='1.00', type_package_id=1)
+
+        self.assertEqual(rollups.check(), [])
+
+    def test_deltas_of_transaction_are_applied_once(self):
+        self.create_packages()
+        with self.captureOnCommitCallbacks() as callbacks:
+            Package.objects.filter(type_package_id__in=[1, 2]).delete()
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+
+        self.assertEqual(len(callbacks), 6)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(rollups.check(), [])
+
+    def test_overlapping_pricing_runs_count_packages_once(self):
+        self.create_packages()
+        pages = {PRICING_MODE_PYTHON: iterate_keyset_values, PRICING_MODE_SQL: iterate_keyset_ranges}
+        for mode, iterate in pages.items():
+            with self.captureOnCommitCallbacks(execute=True):
+                Package.objects.update(delivery_cost=None, usd_rate_version=None)
+                rollups.rebuild()
+
+            def interleaved(*args):
+                for page in iterate(*args):
+                    # a reprice prices the page between the keyset read and the transaction of the sweep
+                    with mock.patch(f'package.service.{iterate.__name__}', iterate):
+                        calculate_delivery_cost_in_batches(Package.objects.all(), 90, 10, mode=mode)
+                    yield page
+
+            with mock.patch(f'package.service.{iterate.__name__}', interleaved), \
+                    self.captureOnCommitCallbacks(execute=True):
+                stats = calculate_delivery_cost_in_batches(
+                    Package.objects.filter(delivery_cost__isnull=True), 89, 10, mode=mode,
+                )
+
+            self.assertEqual(stats['updated'], 0, mode)
+            self.assertEqual(rollups.check(), [], mode)
+
+    def test_deleted_company_rollups_move_to_unassigned(self):
+        package = self.create_packages()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('package-add-company', kwargs={'pk': str(package.pk)}),
+                             {'company_id': self.company.pk}, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.company.delete()
+
+        self.assertEqual(rollups.check(), [])
+
+    def test_analytics_endpoint(self):
+        self.create_packages()
+        with self.captureOnCommitCallbacks(execute=True):
+            calculate_delivery_cost_in_batches(Package.objects.filter(type_package_id=1), 89, 10)
+        url = reverse('delivery-cost-analytics')
+
+        data = self.client.get(url, {'group_by': 'type_package'}).json()
+
+        clothes = data['groups'][0]
+        self.assertEqual([group['type_package'] for group in data['groups']], [1, 2, 3])
+        self.assertEqual((clothes['count'], clothes['priced_count'], clothes['total_weight']), (3, 3, '4.500'))
+        self.assertEqual(Decimal(clothes['average_delivery_cost']) * 3, Decimal(clothes['total_delivery_cost']))
+        self.assertIsNone(data['groups'][1]['average_delivery_cost'])
+        self.assertEqual(data['total']['count'], 7)
+        self.assertEqual(self.client.get(url, {'group_by': 'session'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_rebuild_rollups_command(self):
+        self.create_packages()
+        Package.objects.filter(type_package_id=2).update(weight='9.000')
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', '--check', stderr=io.StringIO())
+        call_command('rebuild_rollups', stdout=io.StringIO(), stderr=io.StringIO())
+
+        self.assertEqual(rollups.check(), [])
+
+
+class ArchivePackagesTests(CacheClearingMixin, APITestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        super().setUp()
+        self.owner = owner_session(self.client)
+        company = DeliveryCompany.objects.create(name='archive_company')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.packages = Package.objects.bulk_create([
+                Package(name=f'package_{i}', weight='1.500', cost_in_usd='10.00', type_package_id=1, owner=self.owner,
+                        delivery_cost='7.50' if i < 4 else None, delivery_company=company if i < 3 else None)
+                for i in range(5)
+            ])
+            rollups.rebuild()
+        # packages 0 and 1 are settled long ago, 2 is settled recently, 3 and 4 are not settled
+        old = timezone.now() - timedelta(seconds=settings.PACKAGE_ARCHIVE_AFTER + 60)
+        Package.objects.exclude(name='package_2').update(updated_at=old)
+        self.settled = {str(package.pk) for package in self.packages[:2]}
+
+    def test_archive_settled_packages(self):
+        analytics = rollups.delivery_cost_analytics()
+        self.client.get(reverse('package-list'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            archived = archive_settled_packages(batch_size=1)
+
+        self.assertEqual(archived, 2)
+        self.assertEqual({str(pk) for pk in ArchivedPackage.objects.values_list('pk', flat=True)}, self.settled)
+        self.assertEqual(Package.objects.count(), 3)
+        self.assertEqual(rollups.check(), [])
+        self.assertEqual(rollups.delivery_cost_analytics(), analytics)
+        listed = {package['id'] for package in self.client.get(reverse('package-list')).data['results']}
+        self.assertFalse(listed & self.settled)
+        self.assertEqual(archive_settled_packages(), 0)
+
+    def test_reprice_does_not_postpone_archiving(self):
+        for mode in PRICING_MODES:
+            with self.subTest(mode=mode), self.captureOnCommitCallbacks(execute=True):
+                calculate_delivery_cost_in_batches(Package.objects.all(), 89 + len(mode), 2, mode=mode)
+
+        self.assertEqual(archive_settled_packages(), 2)
+        self.assertEqual({str(pk) for pk in ArchivedPackage.objects.values_list('pk', flat=True)}, self.settled)
+        # the first pricing of package 4 is a change
+        self.assertGreater(Package.objects.get(name='package_4').updated_at, timezone.now() - timedelta(minutes=1))
+
+    def test_archive_endpoint(self):
+        archive_settled_packages()
+        other = Package.objects.create(name='other', weight='1.000', cost_in_usd='1.00', type_package_id=1,
+                                       owner='other', delivery_cost='1.00', delivery_company_id=1)
+        Package.objects.filter(pk=other.pk).update(updated_at=timezone.now() - timedelta(days=365))
+        archive_settled_packages()
+
+        response = self.client.get(reverse('archivedpackage-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({package['id'] for package in response.data['results']}, self.settled)
+        self.assertEqual(response.data['results'][0]['type_package_name'], 'Одежда')
+        response = self.client.get(reverse('archivedpackage-detail', kwargs={'pk': str(other.pk)}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_includes_archived_packages(self):
+        archive_settled_packages()
+        staff = User.objects.create_user('archivist', password='password', is_staff=True)
+        self.client.force_authenticate(staff)
+        url = reverse('export-packages', kwargs={'file_format': 'ndjson'})
+
+        def exported(params):
+            response = self.client.get(url, params)
+            return {json.loads(line)['id'] for line in b''.join(response.streaming_content).decode().splitlines()}
+
+        self.assertEqual(exported({}), {str(package.pk) for package in self.packages})
+        self.assertEqual(exported({'archived': 'true'}), self.settled)
+        self.assertEqual(exported({'archived': 'false'}) & self.settled, set())
+        output = io.StringIO()
+        call_command('export_packages', '--format', 'ndjson', '--archived', 'true', stdout=output, stderr=io.StringIO())
+        self.assertEqual({json.loads(line)['id'] for line in output.getvalue().splitlines()}, self.settled)
+
+    def test_export_created_filter(self):
+        Package.objects.filter(name='package_4').update(created_at=timezone.now() - timedelta(days=30))
+        staff = User.objects.create_user('archivist', password='password', is_staff=True)
+        self.client.force_authenticate(staff)
+        url = reverse('export-packages', kwargs={'file_format': 'ndjson'})
+
+        response = self.client.get(url, {'created_before': (timezone.now() - timedelta(days=1)).isoformat()})
+
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['name'] for row in rows], ['package_4'])
+
+
+class BenchmarkTests(CacheClearingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        usd_rate_provider.store(89)
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def test_run_benchmarks(self):
+        owners = seed_packages(30, sessions=2)
+        company_ids = seed_delivery_companies(2)
+
+        endpoints = run_api_benchmarks(owners[0], company_ids, repeat=3, bulk_size=5)
+        tasks = run_task_benchmarks(owners)
+
+        self.assertIn('package add_company', endpoints)
+        for name, result in endpoints.items():
+            self.assertTrue(all(200 <= code < 300 for code in result['statuses']), name)
+        self.assertEqual(endpoints['package list cached']['queries_max'], 0)
+        self.assertEqual([stats['updated'] for stats in tasks.values()], [Package.objects.count()] * 2)
+
+    def test_compare_results(self):
+        previous = {
+            'endpoints': {'package list': {'p50_ms': 10, 'queries_max': 3}},
+            'tasks': {'calculate_delivery_cost sql': {'rows_per_sec': 1000}},
+        }
+        current = {
+            'endpoints': {'package list': {'p50_ms': 11, 'queries_max': 4}},
+            'tasks': {'calculate_delivery_cost sql': {'rows_per_sec': 500}},
+        }
+
+        regressions = compare_results(previous, current, threshold=0.2)
+
+        self.assertEqual(regressions, [
+            'package list: queries 3 -> 4', 'calculate_delivery_cost sql: 1000 -> 500 rows/sec',
+        ])
+
+
+def scrape(text):
+    """Stand-in for a Prometheus scraper: {(sample name, sorted label pairs): value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        sample, value = line.rsplit(' ', 1)
+        name, _, labels = sample.partition('{')
+        pairs = tuple(sorted(
+            tuple(pair.split('=', 1)) for pair in labels.rstrip('}').replace('"', '').split(',') if pair
+        ))
+        samples[(name, pairs)] = float(value)
+    return samples
+
+
+class MetricsTests(CacheClearingMixin, APITestCase):
+    fixtures = ['subjects.json']
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    def tearDown(self):
+        usd_rate_provider._local = None
+        super().tearDown()
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return scrape(response.content.decode())
+
+    def test_request_latency_and_queries(self):
+        owner_session(self.client)
+        for _ in range(3):
+            self.client.get(reverse('package-list'), {'page_size': 1})
+
+        samples = self.scrape()
+
+        labels = (('method', 'GET'), ('status', '200'), ('view', 'package-list'))
+        self.assertEqual(samples[('http_request_duration_seconds_count', labels)], 3)
+        self.assertEqual(samples[('http_request_duration_seconds_bucket', (('le', '+Inf'),) + labels)], 3)
+        self.assertEqual(samples[('http_request_db_queries_count', (('view', 'package-list'),))], 3)
+        self.assertGreater(samples[('http_request_db_queries_sum', (('view', 'package-list'),))], 0)
+
+    def test_rate_lookups_fetches_and_pricing(self):
+        usd_rate_provider._local = None
+        usd_rate_provider.cached()
+        usd_rate_provider.store(89)
+        usd_rate_provider.cached()
+        with StubRatesServer(status_code=404) as server, override_settings(CBR_DAILY_URL=server.url):
+            usd_rate_provider.fetch()
+        Package.objects.create(name='package', weight='1.000', cost_in_usd='1.00', type_package_id=1)
+        cache.set('usd_rate_in_rub', 89)
+        calculate_delivery_cost_for_all_packages_task()
+
+        samples = self.scrape()
+
+        self.assertEqual(samples[('usd_rate_cache_lookups_total', (('result', 'miss'),))], 1)
+        self.assertEqual(samples[('usd_rate_cache_lookups_total', (('result', 'local'),))], 1)
+        self.assertEqual(samples[('cbr_fetch_failures_total', ())], 1)
+        self.assertEqual(samples[('cbr_fetch_duration_seconds_count', (('result', 'failure'),))], 1)
+        job = (('job', 'calculate_delivery_cost_for_all_packages'),)
+        self.assertEqual(samples[('pricing_job_rows_total', job)], 1)
+        self.assertIn(('pricing_job_rows_per_second', job), samples)
+
+    def test_snapshots_of_processes_are_merged(self):
+        metrics.cbr_fetch_failures.inc()
+        other = metrics.registry.snapshot()
+        cache.set('metrics:process:other:1', other)
+        cache.set(metrics.PROCESSES_KEY, {'metrics:process:other:1', 'metrics:process:gone:2'})
+
+        samples = self.scrape()
+
+        self.assertEqual(samples[('cbr_fetch_failures_total', ())], 2)
+        self.assertEqual(cache.get(metrics.PROCESSES_KEY), {'metrics:process:other:1', metrics.registry.process_key()})
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@skipUnless('replica' in settings.DATABASES, 'needs a replica database, see config/test_settings.py')
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(CacheClearingMixin, APITransactionTestCase):
+    """Not wrapped in a transaction, reads inside one always go to the primary"""
+    databases = {'default', 'replica'} & set(settings.DATABASES)
+
+    def setUp(self):
+        super().setUp()
+        cache.set('usd_rate_in_rub', 89)
+        self.type_package = TypePackage.objects.create(name=TypePackage.CLOTH)
+
+    def test_router(self):
+        self.assertEqual(router.db_for_read(Package), 'default')
+        self.assertEqual(router.db_for_write(Package), 'default')
+        with replica_reads():
+            self.assertEqual(router.db_for_read(Package), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Package), 'default')
+            with primary_reads():
+                self.assertEqual(router.db_for_read(Package), 'default')
+
+    def archive_package(self, owner):
+        ArchivedPackage.objects.create(
+            id=uuid.uuid4(), name='archived', weight='1.000', cost_in_usd='1.00', type_package=self.type_package,
+            owner=owner, created_at=timezone.now(), updated_at=timezone.now(), archived_at=timezone.now(),
+        )
+
+    def test_safe_requests_read_from_replica(self):
+        owner = owner_session(self.client)
+        self.archive_package(owner)
+
+        response = self.client.get(reverse('archivedpackage-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+        self.assertEqual(ArchivedPackage.objects.using('replica').count(), 0)
+
+    def test_cached_responses_are_built_from_primary(self):
+        owner = owner_session(self.client)
+        Package.objects.create(
+            name='package', weight='1.000', cost_in_usd='1.00', type_package=self.type_package, owner=owner,
+        )
+
+        response = self.client.get(reverse('package-list'))
+
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(Package.objects.using('replica').count(), 0)
+
+    def test_client_reads_its_writes_until_the_window_ends(self):
+        response = self.client.post(reverse('package-list'), {
+            'name': 'package', 'weight': '1.000', 'cost_in_usd': '1.00', 'type_package': self.type_package.pk,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn(settings.DATABASE_STICKY_COOKIE_NAME, response.cookies)
+        self.archive_package(self.client.session[OWNER_SESSION_KEY])
+
+        self.assertEqual(len(self.client.get(reverse('archivedpackage-list')).data['results']), 1)
+
+        self.client.cookies[settings.DATABASE_STICKY_COOKIE_NAME] = str(time.time() - 1)
+        self.assertEqual(self.client.get(reverse('archivedpackage-list')).data['results'], [])
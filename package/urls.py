@@ -2,13 +2,15 @@ from django.urls import include, path
 from rest_framework import routers
 
 from package.views import (
-    PackageViewSet, TypePackageViewSet, DeliveryCompanyViewSet,
-    calculate_delivery_cost_for_all_packages, update_usd_rate_in_rub
+    PackageViewSet, ArchivedPackageViewSet, TypePackageViewSet, DeliveryCompanyViewSet,
+    calculate_delivery_cost_for_all_packages, update_usd_rate_in_rub, job_status, export_packages,
+    delivery_cost_analytics, metrics_view, currency_rate,
 )
 
 
 router = routers.DefaultRouter()
 router.register(r'package', PackageViewSet)
+router.register(r'package_archive', ArchivedPackageViewSet)
 router.register(r'type_package', TypePackageViewSet)
 router.register(r'delivery_company', DeliveryCompanyViewSet)
 
@@ -17,4 +19,9 @@ urlpatterns = [
     path('', include(router.urls)),
     path('update_usd_rate/', update_usd_rate_in_rub),
     path('calculate_delivery_cost/', calculate_delivery_cost_for_all_packages),
+    path('rates/', currency_rate, name='currency-rate'),
+    path('jobs/<str:job_id>/', job_status, name='job-status'),
+    path('export/packages.<str:file_format>', export_packages, name='export-packages'),
+    path('analytics/delivery_cost/', delivery_cost_analytics, name='delivery-cost-analytics'),
+    path('metrics', metrics_view, name='metrics'),
 ]
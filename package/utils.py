@@ -1,10 +1,12 @@
-from django.core.cache import cache
-
+from package.rates import usd_rate_provider
 from package.tasks import update_usd_rate_in_rub_task
 
 
 def get_usd_rate():
-    rate = cache.get('usd_rate_in_rub')
-    if rate is None:
-        rate = update_usd_rate_in_rub_task()
-    return rate
+    """Never blocks on the rate endpoint once a rate is known, a stale rate is refreshed in the background"""
+    return usd_rate_provider.get_rate(refresh=update_usd_rate_in_rub_task)
+
+
+async def aget_usd_rate():
+    """get_usd_rate for async views, the rate endpoint is requested with the pooled async client"""
+    return await usd_rate_provider.aget_rate(refresh=update_usd_rate_in_rub_task)
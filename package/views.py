@@ -1,33 +1,154 @@
 from rest_framework import status
 from rest_framework import mixins, viewsets
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 
-from django.db import transaction
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.db import router, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_filters.rest_framework import DjangoFilterBackend
 
-from package.models import Package, TypePackage, DeliveryCompany
-from package.tasks import calculate_delivery_cost_for_all_packages_task, update_usd_rate_in_rub_task
+from package import assignment, metrics, rollups
+from package.exporting import EXPORT_CONTENT_TYPES, EXPORT_FORMATS, export_chunks, export_filtersets
+from package.filters import PackageFilter
+from package.locks import SingleFlight
+from package.models import ArchivedPackage, Package, TypePackage, DeliveryCompany
+from package.owners import ensure_owner, get_owner
+from package.pagination import PackageCursorPagination
+from package.parsers import NDJSONParser
+from package.progress import JobProgress
+from package.rate_history import rate_history
+from package.rates import usd_rate_provider
+from package.reference import reference_data
+from package.response_cache import cached_response, invalidate_sessions
+from package.tasks import (
+    calculate_delivery_cost_for_all_packages_task, calculate_delivery_cost_in_parallel_task,
+    update_usd_rate_in_rub_task, price_created_packages, PRICING_FLIGHT,
+)
 from package.serializers import (
     ListPackageSerializer, TypePackageSerializer,
     DeliveryCompanySerializer, CreatePackageSerializer,
-    RetrievePackageSerializer, AddCompanySerializer,
+    RetrievePackageSerializer, AddCompanySerializer, AssignCompanySerializer, DeliveryCostAnalyticsSerializer,
+    CurrencyRateSerializer, ArchivedPackageSerializer,
 )
 
 
 @api_view(['GET'])
 def update_usd_rate_in_rub(request):
-    """Run update usd rate task"""
-    update_usd_rate_in_rub_task.delay()
-    return Response({'message': 'Задача обновления курса доллара запущена.'}, status=status.HTTP_200_OK)
+    """Run update usd rate task or return the id of the run in progress"""
+    job_id, created = SingleFlight('update_usd_rate_in_rub').enqueue(update_usd_rate_in_rub_task)
+    if created:
+        message = 'Задача обновления курса доллара запущена.'
+    else:
+        message = 'Задача обновления курса доллара уже выполняется.'
+    return Response({'message': message, 'job_id': job_id}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 def calculate_delivery_cost_for_all_packages(request):
-    """Run calculate delivery cost task"""
-    calculate_delivery_cost_for_all_packages_task.delay()
-    return Response({'message': 'Задача пересчета стоимости доставки запущена.'}, status=status.HTTP_200_OK)
+    """Run calculate delivery cost task or return the id of the run in progress.
+
+    ?parallel=1 splits the packages into pk ranges priced on all workers.
+    """
+    if request.query_params.get('parallel') in ('1', 'true'):
+        name, task = 'calculate_delivery_cost_in_parallel', calculate_delivery_cost_in_parallel_task
+    else:
+        name, task = 'calculate_delivery_cost_for_all_packages', calculate_delivery_cost_for_all_packages_task
+    job_id, created = SingleFlight(PRICING_FLIGHT).enqueue(task, job_name=name)
+    if created:
+        message = 'Задача пересчета стоимости доставки запущена.'
+    else:
+        message = 'Задача пересчета стоимости доставки уже выполняется.'
+    return Response({'message': message, 'job_id': job_id}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def currency_rate(request):
+    """Rate of a currency in force at a moment, from the saved snapshots without calling the rates endpoint.
+
+    ?char_code= defaults to USD, ?at= is an ISO datetime and defaults to now.
+    """
+    char_code = request.query_params.get('char_code', 'USD').upper()
+    at = request.query_params.get('at')
+    try:
+        moment = parse_datetime(at) if at else timezone.now()
+    except ValueError:
+        moment = None
+    if moment is None:
+        return Response({'at': ['Неправильный формат datetime.']}, status=status.HTTP_400_BAD_REQUEST)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    entry = rate_history.entries_at([moment], char_code)[0]
+    if entry is None:
+        return Response({'message': 'Не найдено'}, status=status.HTTP_404_NOT_FOUND)
+    effective_at, value = entry
+    serializer = CurrencyRateSerializer({'char_code': char_code, 'effective_at': effective_at, 'value': value})
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def job_status(request, job_id):
+    """Progress of a background job: rows done, rows/sec, ETA and errors"""
+    report = JobProgress(job_id).report()
+    if report is None:
+        return Response({'message': 'Не найдено'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(report, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export_packages(request, file_format):
+    """Streams all packages as CSV or NDJSON for staff users, the live ones and then the archived ones.
+
+    ?type_package=, ?delivery_company=, ?priced=true|false and the ISO datetimes
+    ?created_after=, ?created_before= filter the rows, ?archived=true|false keeps only the archived
+    or only the live packages.
+    """
+    if file_format not in EXPORT_FORMATS:
+        raise Http404
+    filtersets = export_filtersets(request.query_params)
+    if not filtersets[0].is_valid():
+        return Response(filtersets[0].errors, status=status.HTTP_400_BAD_REQUEST)
+    # the rows are streamed after the middleware returns, so the database is chosen here
+    querysets = [filterset.qs.using(router.db_for_read(filterset.qs.model)) for filterset in filtersets]
+    content = export_chunks(querysets, file_format, settings.PACKAGE_EXPORT_CHUNK_SIZE)
+    response = StreamingHttpResponse(
+        (chunk.encode() for chunk in content), content_type=EXPORT_CONTENT_TYPES[file_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="packages.{file_format}"'
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def delivery_cost_analytics(request):
+    """Count, weight, cost and delivery cost totals per type and company for staff users.
+
+    Read from the rollups, so the cost does not depend on the number of packages.
+    ?group_by=type_package|delivery_company sums the groups over the other dimension.
+    """
+    group_by = request.query_params.get('group_by') or None
+    if group_by not in rollups.GROUP_BY:
+        return Response({'group_by': [f'Значения "{group_by}" нет среди допустимых вариантов.']},
+                        status=status.HTTP_400_BAD_REQUEST)
+    serializer = DeliveryCostAnalyticsSerializer(rollups.delivery_cost_analytics(group_by))
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """Metrics of all web and worker processes in the Prometheus text format.
+
+    With METRICS_TOKEN set the scraper has to send it as a bearer token.
+    """
+    if settings.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {settings.METRICS_TOKEN}':
+        return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+    return HttpResponse(
+        metrics.render(metrics.registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
 
 
 class PackageViewSet(mixins.ListModelMixin,
@@ -37,16 +158,27 @@ class PackageViewSet(mixins.ListModelMixin,
                      viewsets.GenericViewSet):
     queryset = Package.objects.all()
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = ['type_package', 'delivery_cost']
-
-    def __get_session_id(self):
-        if self.request.session.session_key is None:
-            self.request.session.save()
-        return self.request.session.session_key
+    filterset_class = PackageFilter
+    read_fields = (
+        'id', 'owner', 'name', 'type_package', 'weight', 'cost_in_usd', 'delivery_cost', 'delivery_company',
+    )
 
     def get_queryset(self):
-        session_id = self.__get_session_id()
-        return Package.objects.filter(session_id=session_id)
+        owner = get_owner(self.request)
+        if owner is None:
+            # requests without an owner token see nothing and write nothing
+            return Package.objects.none()
+        queryset = Package.objects.filter(owner=owner)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.only(*self.read_fields).order_by('pk')
+        return queryset
+
+    @property
+    def paginator(self):
+        """?pagination=cursor switches the list to cursor pagination for large sessions"""
+        if not hasattr(self, '_paginator') and self.request.query_params.get('pagination') == 'cursor':
+            self._paginator = PackageCursorPagination()
+        return super().paginator
 
     def get_serializer_class(self):
         serializer_map = {
@@ -54,6 +186,7 @@ class PackageViewSet(mixins.ListModelMixin,
             'create': CreatePackageSerializer,
             'retrieve': RetrievePackageSerializer,
             'add_company': AddCompanySerializer,
+            'assign_company': AssignCompanySerializer,
         }
         serializer = serializer_map.get(self.action)
         assert serializer is not None
@@ -64,48 +197,176 @@ class PackageViewSet(mixins.ListModelMixin,
         """Binds the parcel to a company if no company is selected"""
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        company = get_object_or_404(DeliveryCompany, pk=serializer.data['company_id'])
-        with transaction.atomic():
-            package_list = Package.objects.select_for_update().filter(pk=kwargs['pk'], delivery_company__isnull=True)
-            if len(package_list):
-                package_list.update(delivery_company=company)
-                return Response({'message': f'Компания {company.name} выбрана перевозчиком.'},
-                                status=status.HTTP_200_OK)
+        company = reference_data.get_delivery_company(serializer.data['company_id'])
+        if company is None:
+            raise Http404
+        if assignment.assign_company(kwargs['pk'], company.pk):
+            return Response({'message': f'Компания {company.name} выбрана перевозчиком.'},
+                            status=status.HTTP_200_OK)
         return Response(
             {'message': f'Компания {company.name} не может быть выбрана перевозчиком либо уже выбрана.'},
             status=status.HTTP_200_OK
         )
 
+    @action(methods=['post'], detail=False, url_path='assign_company', url_name='assign-company')
+    def assign_company(self, request, *args, **kwargs):
+        """Binds session packages without company to a company in batches.
+
+        Packages are given by package_ids or selected by the list filters of the query string,
+        the response lists assigned packages and packages already taken by another company.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        company = reference_data.get_delivery_company(serializer.validated_data['company_id'])
+        if company is None:
+            raise Http404
+        queryset = self.filter_queryset(self.get_queryset())
+        package_ids = serializer.validated_data.get('package_ids')
+        if package_ids is not None:
+            queryset = queryset.filter(pk__in=package_ids)
+        assigned, taken = assignment.assign_company_in_batches(
+            queryset, company.pk, settings.PACKAGE_ASSIGN_BATCH_SIZE
+        )
+        data = {
+            'message': f'Компания {company.name} выбрана перевозчиком для {len(assigned)} посылок.',
+            'assigned': [str(pk) for pk in assigned],
+            'taken': [str(pk) for pk in taken],
+        }
+        if package_ids is not None:
+            data['not_found'] = sorted({str(pk) for pk in package_ids} - set(data['assigned']) - set(data['taken']))
+        return Response(data, status=status.HTTP_200_OK)
+
+    def list(self, request, *args, **kwargs):
+        """List of session packages, cached until the packages of the session change"""
+        owner = get_owner(request)
+        return cached_response(request, owner, lambda: super(PackageViewSet, self).list(request, *args, **kwargs))
+
     def retrieve(self, request, *args, **kwargs):
         """Detail view for Package instance"""
-        session_id = self.__get_session_id()
-        instance = self.get_object()
-        if session_id == str(instance.session_id):
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data)
-        return Response({'message': 'Не найдено'}, status=status.HTTP_404_NOT_FOUND)
+        owner = get_owner(request)
+
+        def retrieve_instance():
+            instance = self.get_object()
+            if owner is not None and owner == instance.owner:
+                serializer = self.get_serializer(instance)
+                return Response(serializer.data)
+            return Response({'message': 'Не найдено'}, status=status.HTTP_404_NOT_FOUND)
+
+        return cached_response(request, owner, retrieve_instance)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        invalidate_sessions([instance.owner])
 
     def create(self, request, *args, **kwargs):
         """Create Package instance"""
-        session_id = self.__get_session_id()
+        owner = ensure_owner(request)
 
         new_data = request.data.copy()
-        new_data.update(session=session_id)
+        new_data.update(owner=owner)
 
         serializer = self.get_serializer(data=new_data)
         serializer.is_valid(raise_exception=True)
 
         self.perform_create(serializer)
+        invalidate_sessions([owner])
+        package_pk = serializer.instance.pk
+        transaction.on_commit(lambda: price_created_packages([package_pk]))
         headers = self.get_success_headers(serializer.data)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    @action(methods=['post'], detail=False, url_path='bulk_create', url_name='bulk-create',
+            parser_classes=[JSONParser, NDJSONParser])
+    def bulk_create(self, request, *args, **kwargs):
+        """Create Package instances from a JSON array or NDJSON in one transaction.
+
+        ?partial=1 creates valid items and returns errors of the others,
+        ?price=1 prices the packages at once if the usd rate is cached.
+        """
+        if not isinstance(request.data, list):
+            return Response({'message': 'Ожидается список посылок.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > settings.PACKAGE_BULK_CREATE_MAX_ITEMS:
+            return Response(
+                {'message': f'Не больше {settings.PACKAGE_BULK_CREATE_MAX_ITEMS} посылок за один запрос.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        owner = ensure_owner(request)
+        items = [
+            {key: value for key, value in item.items() if key != 'owner'} if isinstance(item, dict) else item
+            for item in request.data
+        ]
+        context = self.get_serializer_context()
+        if request.query_params.get('price') in ('1', 'true'):
+            context['usd_rate_in_rub'] = usd_rate_provider.cached()[0]
+        serializer = CreatePackageSerializer(data=items, many=True, context=context)
+
+        if request.query_params.get('partial') in ('1', 'true'):
+            validated_data, errors = serializer.validate_items()
+        else:
+            serializer.is_valid(raise_exception=True)
+            validated_data, errors = serializer.validated_data, []
+        for attrs in validated_data:
+            attrs['owner'] = owner
+        packages = serializer.create(validated_data) if validated_data else []
+        invalidate_sessions([owner])
+        unpriced_pks = [package.pk for package in packages if package.delivery_cost is None]
+        if unpriced_pks:
+            transaction.on_commit(lambda: price_created_packages(unpriced_pks))
+
+        response_status = status.HTTP_201_CREATED if packages or not errors else status.HTTP_400_BAD_REQUEST
+        return Response(
+            {
+                'created': CreatePackageSerializer(packages, many=True).data,
+                'errors': [{'index': index, 'errors': error} for index, error in enumerate(errors) if error],
+            },
+            status=response_status,
+        )
+
+
+class ReferenceDataMixin:
+    """Serves list and retrieve from the in-process reference data instead of the database"""
+    reference_list = None
+    reference_get = None
+
+    def list(self, request, *args, **kwargs):
+        objects = getattr(reference_data, self.reference_list)()
+        page = self.paginate_queryset(objects)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(objects, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = getattr(reference_data, self.reference_get)(kwargs[self.lookup_field])
+        if instance is None:
+            raise Http404
+        return Response(self.get_serializer(instance).data)
+
+
+class ArchivedPackageViewSet(mixins.ListModelMixin,
+                             mixins.RetrieveModelMixin,
+                             viewsets.GenericViewSet):
+    """Read only archive of the session packages moved out of the package list when settled"""
+    queryset = ArchivedPackage.objects.all()
+    serializer_class = ArchivedPackageSerializer
+    pagination_class = PackageCursorPagination
+
+    def get_queryset(self):
+        owner = get_owner(self.request)
+        if owner is None:
+            return ArchivedPackage.objects.none()
+        return ArchivedPackage.objects.filter(owner=owner)
+
 
-class TypePackageViewSet(viewsets.ReadOnlyModelViewSet):
+class TypePackageViewSet(ReferenceDataMixin, viewsets.ReadOnlyModelViewSet):
     queryset = TypePackage.objects.all()
     serializer_class = TypePackageSerializer
+    reference_list = 'type_packages'
+    reference_get = 'get_type_package'
 
 
-class DeliveryCompanyViewSet(viewsets.ModelViewSet):
+class DeliveryCompanyViewSet(ReferenceDataMixin, viewsets.ModelViewSet):
     queryset = DeliveryCompany.objects.all()
     serializer_class = DeliveryCompanySerializer
+    reference_list = 'delivery_companies'
+    reference_get = 'get_delivery_company'